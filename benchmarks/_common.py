@@ -0,0 +1,206 @@
+"""
+Shared helpers for the benchmark scripts.
+
+Each script produces a list of result dicts and hands them to report(), which
+prints a table and optionally writes them to a JSON file. A previous JSON file
+can be passed to compare against, in which case regressions beyond a threshold
+make the script exit with a non-zero status.
+
+"""
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from typing import Any, Callable, Dict, List  # noqa
+
+
+def add_arguments(parser):
+    # type: (argparse.ArgumentParser) -> None
+    parser.add_argument('-o', '--out', help="Write results to this JSON file.")
+    parser.add_argument('-c', '--compare', help="Compare against results in this JSON file.")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Fractional slowdown that counts as a regression. [%(default)s]")
+
+
+def percentile(values, fraction):
+    # type: (List[float], float) -> float
+    """ Returns the value at fraction (0 to 1) of the sorted values. """
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+
+    return ordered[index]
+
+
+def latency_stats(latencies, elapsed):
+    # type: (List[float], float) -> Dict[str, float]
+    """ Summarizes per-operation latencies (in seconds) from a timed run. """
+    return {
+        'ops': len(latencies),
+        'rps': (len(latencies) / elapsed) if (elapsed > 0) else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def allocations(func, repeat=1):
+    # type: (Callable[[], Any], int) -> Dict[str, float]
+    """
+    Measures memory allocated by func().
+
+    Returns the average bytes and blocks still allocated after each call and
+    the peak traced memory across all calls. This is measured separately from
+    timing because tracing allocations slows everything down.
+
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        for _ in range(repeat):
+            func()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    diffs = after.compare_to(before, 'filename')
+    retained = sum(max(diff.size_diff, 0) for diff in diffs)
+    blocks = sum(max(diff.count_diff, 0) for diff in diffs)
+
+    return {
+        'retained_bytes_per_op': retained / float(repeat),
+        'retained_blocks_per_op': blocks / float(repeat),
+        'peak_bytes': peak - base,
+    }
+
+
+def timed(func):
+    # type: (Callable[[], Any]) -> float
+    """ Returns the wall time (in seconds) of func(). """
+    start = time.perf_counter()
+    func()
+
+    return time.perf_counter() - start
+
+
+def report(name, results, args, stream=sys.stdout):
+    # type: (str, List[Dict[str, Any]], argparse.Namespace, Any) -> int
+    """
+    Prints results and writes/compares them as requested by args.
+
+    Returns an exit status: 1 if any regressions were found.
+
+    """
+    columns = _columns(results)
+    print('  '.join('{:>20}'.format(column) for column in columns), file=stream)
+    for result in results:
+        print('  '.join('{:>20}'.format(_format(result.get(column))) for column in columns), file=stream)
+
+    document = {
+        'suite': name,
+        'metadata': metadata(),
+        'results': results,
+    }
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+
+    status = 0
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(baseline['results'], results, args.threshold)
+        for line in regressions:
+            print("REGRESSION: {}".format(line), file=stream)
+        status = 1 if regressions else 0
+
+    return status
+
+
+def compare(baseline, results, threshold):
+    # type: (List[Dict[str, Any]], List[Dict[str, Any]], float) -> List[str]
+    """
+    Returns descriptions of results that got worse than baseline by more than
+    threshold. Results are matched on their 'name' and 'mode' keys.
+    """
+    # For each metric, whether bigger is better.
+    metrics = {
+        'rps': True,
+        'p50_ms': False,
+        'p99_ms': False,
+        'wall_s': False,
+        'retained_bytes_per_op': False,
+        'peak_bytes': False,
+        'peak_rss_kb': False,
+    }
+
+    previous = {(r.get('name'), r.get('mode')): r for r in baseline}
+    regressions = []
+
+    for result in results:
+        old = previous.get((result.get('name'), result.get('mode')))
+        if old is None:
+            continue
+        for metric, higher_is_better in metrics.items():
+            if (metric not in result) or not old.get(metric):
+                continue
+            change = (result[metric] - old[metric]) / float(old[metric])
+            if higher_is_better:
+                change = -change
+            if change > threshold:
+                regressions.append('{} {} {}: {} -> {} ({:+.0%})'.format(
+                    result.get('name'), result.get('mode', ''), metric,
+                    _format(old[metric]), _format(result[metric]), change
+                ))
+
+    return regressions
+
+
+def metadata():
+    # type: () -> Dict[str, Any]
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'commit': commit,
+    }
+
+
+def _columns(results):
+    # type: (List[Dict[str, Any]]) -> List[str]
+    columns = []  # type: List[str]
+    for result in results:
+        for key in result:
+            if key not in columns:
+                columns.append(key)
+
+    return columns
+
+
+def _format(value):
+    # type: (Any) -> str
+    if isinstance(value, float):
+        text = '{:.3f}'.format(value)
+    elif value is None:
+        text = ''
+    else:
+        text = str(value)
+
+    return text
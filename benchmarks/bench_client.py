@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Throughput and latency of the server API client.
+
+Drives Server.retrieve, get_pki, wireguard_peers and request_certificate
+against a local stand-in API over real sockets, sequentially, from a thread
+pool and from asyncio.
+
+    python benchmarks/bench_client.py -n 500 --peers 1000 -o client.json
+
+"""
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import time
+
+from oscrypto import asymmetric
+from typing import Any, Callable, Dict, List  # noqa
+
+from cloak.serverapi.server import Server
+from cloak.serverapi.tests.standin import StandInServer
+from cloak.serverapi.utils import http
+
+import _common
+
+
+MODES = ['sequential', 'threaded', 'asyncio']
+
+
+def main(argv=None):
+    # type: (List[str]) -> int
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--requests', type=int, default=200, help="Requests per benchmark. [%(default)s]")
+    parser.add_argument('-j', '--concurrency', type=int, default=8, help="Threads or tasks for concurrent modes. [%(default)s]")
+    parser.add_argument('--peers', type=int, default=100, help="WireGuard peers served by the stand-in. [%(default)s]")
+    parser.add_argument('--latency', type=float, default=0, help="Simulated API latency in seconds. [%(default)s]")
+    parser.add_argument('--mode', action='append', choices=MODES, help="Only run these modes.")
+    parser.add_argument('--op', action='append', help="Only run these operations.")
+    _common.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with StandInServer(latency=args.latency, peers=args.peers) as standin:
+        client = http.Client(base_url=standin.base_url, pool_size=args.concurrency)
+        server_id, auth_token = standin.session.provision()
+        server = Server.retrieve(server_id, auth_token, client=client)
+
+        _, privkey = asymmetric.generate_pair('rsa', bit_size=2048)
+        key_pem = asymmetric.dump_private_key(privkey, None, 'pem')
+
+        ops = {
+            'retrieve': lambda: Server.retrieve(server_id, auth_token, client=client),
+            'get_pki': lambda: server.get_pki(),
+            'wireguard_peers': lambda: Server.wireguard_peers(server_id, auth_token, client=client),
+            'request_certificate': lambda: server.request_certificate(key_pem),
+        }  # type: Dict[str, Callable[[], Any]]
+
+        results = []
+        for name, op in ops.items():
+            if args.op and (name not in args.op):
+                continue
+            for mode in (args.mode or MODES):
+                results.append(run(name, op, mode, args))
+
+    return _common.report('client', results, args)
+
+
+def run(name, op, mode, args):
+    # type: (str, Callable[[], Any], str, argparse.Namespace) -> Dict[str, Any]
+    # Warm up the connection pool.
+    for _ in range(min(args.concurrency, args.requests)):
+        op()
+
+    if mode == 'sequential':
+        latencies, elapsed = sequential(op, args.requests)
+    elif mode == 'threaded':
+        latencies, elapsed = threaded(op, args.requests, args.concurrency)
+    else:
+        latencies, elapsed = asyncio_run(op, args.requests, args.concurrency)
+
+    result = {'name': name, 'mode': mode}  # type: Dict[str, Any]
+    result.update(_common.latency_stats(latencies, elapsed))
+    if mode == 'sequential':
+        result.update(_common.allocations(op, repeat=min(args.requests, 50)))
+
+    return result
+
+
+def sequential(op, count):
+    # type: (Callable[[], Any], int) -> Any
+    latencies = []
+
+    start = time.perf_counter()
+    for _ in range(count):
+        latencies.append(_common.timed(op))
+    elapsed = time.perf_counter() - start
+
+    return (latencies, elapsed)
+
+
+def threaded(op, count, concurrency):
+    # type: (Callable[[], Any], int, int) -> Any
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = list(executor.map(lambda i: _common.timed(op), range(count)))
+    elapsed = time.perf_counter() - start
+
+    return (latencies, elapsed)
+
+
+def asyncio_run(op, count, concurrency):
+    # type: (Callable[[], Any], int, int) -> Any
+    async def run_all():
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(concurrency)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                return await loop.run_in_executor(executor, _common.timed, op)
+
+        try:
+            return await asyncio.gather(*(one() for _ in range(count)))
+        finally:
+            executor.shutdown()
+
+    start = time.perf_counter()
+    latencies = asyncio.run(run_all())
+    elapsed = time.perf_counter() - start
+
+    return (list(latencies), elapsed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
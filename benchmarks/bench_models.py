@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for JSON decoding and the API result models.
+
+Generates synthetic server and WireGuard peer payloads with 10, 1k and 100k
+elements and measures decode and encode time (with the standard library and
+with codec's JSON implementation), ApiResult attribute access, peak memory
+and the _print_server rendering path.
+
+    python benchmarks/bench_models.py -o models.json
+
+"""
+import argparse
+import io
+import json
+import sys
+import time
+
+import requests
+from typing import Any, Callable, Dict, List  # noqa
+
+from cloak.serverapi.cli.commands._base import BaseCommand
+from cloak.serverapi.server import Server
+from cloak.serverapi.tests.mock import MockSession
+from cloak.serverapi.utils import codec
+
+import _common
+
+
+SIZES = [10, 1000, 100000]
+
+
+def main(argv=None):
+    # type: (List[str]) -> int
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, action='append', help="Payload sizes to test. {}".format(SIZES))
+    parser.add_argument('--min-time', type=float, default=0.5, help="Minimum seconds to spend on each measurement. [%(default)s]")
+    _common.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in (args.size or SIZES):
+        server_bytes = json.dumps(server_payload(size)).encode('utf-8')
+        peers = peers_payload(size)
+        peers_bytes = json.dumps(peers).encode('utf-8')
+
+        results.extend([
+            measure('decode_server', size, lambda: json.loads(server_bytes), args),
+            measure('decode_server_response', size, lambda: response(server_bytes).json(), args),
+            measure('decode_peers', size, lambda: json.loads(peers_bytes), args),
+            measure('decode_peers_response', size, lambda: response(peers_bytes).json(), args),
+            measure('decode_peers_codec', size, lambda: codec.loads(peers_bytes), args),
+            measure('encode_peers_json', size, lambda: json.dumps(peers), args),
+            measure('encode_peers_codec', size, lambda: codec.dumps_compact(peers), args),
+        ])
+
+        server = Server('srv_benchmark', 'token', json.loads(server_bytes))
+        command = BaseCommand(io.StringIO(), io.StringIO())
+
+        results.extend([
+            measure('wrap_server', size, lambda: Server('srv_benchmark', 'token', json.loads(server_bytes)), args),
+            measure('access_server', size, lambda: access(server), args),
+            measure('print_server', size, lambda: render(command, server), args),
+        ])
+
+    return _common.report('models', results, args)
+
+
+def measure(name, size, func, args):
+    # type: (str, int, Callable[[], Any], argparse.Namespace) -> Dict[str, Any]
+    # Run at least once, and until we've spent min_time.
+    times = []
+    deadline = time.perf_counter() + args.min_time
+    while (not times) or (time.perf_counter() < deadline):
+        times.append(_common.timed(func))
+
+    result = {
+        'name': name,
+        'mode': str(size),
+        'ops': len(times),
+        'best_ms': min(times) * 1000,
+        'p50_ms': _common.percentile(times, 0.5) * 1000,
+    }  # type: Dict[str, Any]
+    result.update(_common.allocations(func))
+
+    return result
+
+
+#
+# Payloads
+#
+
+def server_payload(size):
+    # type: (int) -> Dict[str, Any]
+    """ A server result with size OpenVPN and IKEv2 targets. """
+    session = MockSession(def_target_id='tgt_benchmark')
+    session.provision()
+    result = session._server_result()
+
+    openvpn = result['target']['openvpn'][0]
+    ikev2 = result['target']['ikev2'][0]
+    result['target']['openvpn'] = [dict(openvpn, port=1024 + i) for i in range(size)]
+    result['target']['ikev2'] = [dict(ikev2, fqdn='{}.{}'.format(i, ikev2['fqdn'])) for i in range(size)]
+    result['target']['wireguard'] = [
+        {'fqdn': '{}.wg.example.com'.format(i), 'public_key': 'A' * 43 + '='}
+        for i in range(size)
+    ]
+
+    return result
+
+
+def peers_payload(size):
+    # type: (int) -> List[Dict[str, Any]]
+    session = MockSession(def_target_id='tgt_benchmark')
+    session.generate_wireguard_peers(size)
+
+    return session.wireguard_peers
+
+
+def response(content):
+    # type: (bytes) -> requests.Response
+    """ A requests.Response with content, as the HTTP layer would see it. """
+    result = requests.Response()
+    result.status_code = 200
+    result._content = content
+    result.encoding = None
+    result.headers['Content-Type'] = 'application/json'
+
+    return result
+
+
+#
+# Operations
+#
+
+def access(server):
+    # type: (Server) -> None
+    """ Reads every field that _print_server() uses. """
+    target = server.target
+    target.name, target.target_id, server.name, server.server_id
+    for openvpn in target.openvpn:
+        openvpn.fqdn, openvpn.proto, openvpn.port, openvpn.cipher, openvpn.digest
+    for ikev2 in target.ikev2:
+        ikev2.fqdn, ikev2.server_id, ikev2.client_ca_dn
+    for wireguard in target.wireguard:
+        wireguard.fqdn, wireguard.public_key
+
+
+def render(command, server):
+    # type: (BaseCommand, Server) -> None
+    command.stdout.seek(0)
+    command.stdout.truncate()
+    command._print_server(server)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+End-to-end simulation of an endpoint sync cycle at production scale.
+
+Starts a local stand-in API with many WireGuard peers and large CRLs, then
+runs the pki, crls and wireguard commands the way cron would: each in its own
+process. The cycle is run cold, again with nothing changed, and once more
+after a PKI rotation and a CRL refresh. With --sync, each cycle is a single
+run of the sync command instead.
+
+    python benchmarks/bench_sync.py --peers 10000 --crls 50 -o sync.json
+
+"""
+import argparse
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Any, Dict, List  # noqa
+
+from cloak.serverapi.tests.mock import make_crl
+from cloak.serverapi.tests.standin import StandInServer
+
+import _common
+
+
+def main(argv=None):
+    # type: (List[str]) -> int
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--peers', type=int, default=10000, help="WireGuard peers. [%(default)s]")
+    parser.add_argument('--crls', type=int, default=50, help="CRL URLs. [%(default)s]")
+    parser.add_argument('--crl-revoked', type=int, default=64000, help="Revoked certificates per CRL (32 bytes each). [%(default)s]")
+    parser.add_argument('--changed-crls', type=int, default=5, help="CRLs to update between cycles. [%(default)s]")
+    parser.add_argument('--latency', type=float, default=0, help="Simulated API latency in seconds. [%(default)s]")
+    parser.add_argument('--sync', action='store_true', help="Use the sync command instead of pki, crls and wireguard.")
+    parser.add_argument('--keep', action='store_true', help="Keep the working directory.")
+    _common.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    work = tempfile.mkdtemp(prefix='cloak-bench-sync-')
+    try:
+        with StandInServer(latency=args.latency, peers=args.peers, crls=args.crls,
+                           crl_revoked=args.crl_revoked) as standin:
+            cycle = SyncCycle(standin, work, args.sync)
+
+            results = [cycle.run('cold')]
+            results.append(cycle.run('unchanged'))
+
+            standin.session.rotate_pki()
+            for i in range(min(args.changed_crls, args.crls)):
+                name = 'crl{}.crl'.format(i)
+                standin.set_crl(name, make_crl('CA {} renewed'.format(i), args.crl_revoked))
+            results.append(cycle.run('rotated'))
+    finally:
+        if args.keep:
+            print("Working directory: {}".format(work), file=sys.stderr)
+        else:
+            shutil.rmtree(work)
+
+    return _common.report('sync', results, args)
+
+
+class SyncCycle:
+    """
+    Runs pki, crls and wireguard against a stand-in, like a cron job would.
+    """
+    def __init__(self, standin, work, combined=False):
+        # type: (StandInServer, str, bool) -> None
+        self.standin = standin
+        self.work = work
+        self.combined = combined
+
+        self.config_path = os.path.join(work, 'encryptme.conf')
+        self.pki_dir = os.path.join(work, 'pki')
+        self.crl_dir = os.path.join(work, 'crls')
+        self.hook_log = os.path.join(work, 'hooks.log')
+        os.mkdir(self.pki_dir)
+        os.mkdir(self.crl_dir)
+
+        server_id, auth_token = standin.session.provision()
+        with open(self.config_path, 'w') as f:
+            f.write('[serverapi]\n')
+            f.write('base_url = {}\n'.format(standin.base_url))
+            f.write('server_id = {}\n'.format(server_id))
+            f.write('auth_token = {}\n'.format(auth_token))
+
+    def run(self, name):
+        # type: (str) -> Dict[str, Any]
+        bytes_before = self.standin.bytes_sent
+        requests_before = self.standin.requests
+        hooks_before = self._hook_count()
+
+        if self.combined:
+            commands = [
+                ['sync', '--pki-out', self.pki_dir, '--crl-out', self.crl_dir,
+                 '--peers-out', os.path.join(self.work, 'peers.json'),
+                 '--pki-hook', self._hook('pki'), '--crls-hook', self._hook('crls')],
+            ]
+        else:
+            commands = [
+                ['pki', '--out', self.pki_dir, '--post-hook', self._hook('pki')],
+                ['crls', '--infile', os.path.join(self.pki_dir, 'crl_urls.txt'), '--out', self.crl_dir, '--post-hook', self._hook('crls')],
+                ['wireguard'],
+            ]
+
+        start = time.perf_counter()
+        peak_rss = 0
+        for argv in commands:
+            peak_rss = max(peak_rss, self._cli(argv))
+        wall = time.perf_counter() - start
+
+        return {
+            'name': 'sync_command' if self.combined else 'sync_cycle',
+            'mode': name,
+            'wall_s': wall,
+            'peak_rss_kb': peak_rss,
+            'requests': self.standin.requests - requests_before,
+            'bytes_transferred': self.standin.bytes_sent - bytes_before,
+            'hooks': self._hook_count() - hooks_before,
+        }
+
+    def _cli(self, argv):
+        # type: (List[str]) -> int
+        """
+        Runs cloak-server in a new process and returns its peak RSS in KiB.
+        """
+        argv = [sys.executable, '-m', 'cloak.serverapi.cli', '--config', self.config_path] + argv
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen(argv, stdout=devnull)
+            _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        if process.returncode != 0:
+            raise RuntimeError("{} exited with status {}".format(' '.join(argv), process.returncode))
+
+        # ru_maxrss is in KiB on Linux, but bytes on macOS.
+        peak = rusage.ru_maxrss
+        if sys.platform == 'darwin':
+            peak //= 1024
+
+        return peak
+
+    def _hook(self, name):
+        # type: (str) -> str
+        return 'echo {} >> {}'.format(name, self.hook_log)
+
+    def _hook_count(self):
+        # type: () -> int
+        try:
+            with open(self.hook_log, 'r') as f:
+                count = sum(1 for _ in f)
+        except IOError:
+            count = 0
+
+        return count
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,9 +2,12 @@ import argparse  # noqa
 import sys
 
 from six.moves.configparser import ConfigParser, NoOptionError  # noqa
-from typing import Any, Tuple, IO  # noqa
+from typing import Any, Dict, IO, List, Tuple  # noqa
 
 from cloak.serverapi.server import Server  # noqa
+from cloak.serverapi.utils import http  # noqa
+from cloak.serverapi.utils.apiresult import ApiResult  # noqa
+from cloak.serverapi.utils.hooks import HookRunner  # noqa
 
 
 class BaseCommand:
@@ -23,11 +26,22 @@ class BaseCommand:
     All commands MUST send output to self.stdout and self.stderr. This is
     important for testing and to properly support the --quiet flag.
 
+    API requests should go through self.client, which is configured from the
+    global options before handle() is called. Likewise, post-hooks should be
+    run with self._run_hook().
+
     """
     brief = None  # type: str
     description = None  # type: str
     epilog = None  # type: str
 
+    # Whether the serve command may run this on behalf of a client.
+    servable = True
+
+    # Set by the CLI before handle() is called.
+    client = None  # type: http.Client
+    hooks = None  # type: HookRunner
+
     def add_arguments(self, parser, group):
         # type: (argparse.ArgumentParser, argparse._ArgumentGroup) -> None
         """
@@ -54,6 +68,15 @@ class BaseCommand:
         """
         raise NotImplementedError()
 
+    def check_servable(self, **options):
+        # type: (**Any) -> None
+        """
+        Raises CommandError if the serve command shouldn't run this with these
+        options. By default, that's decided by servable.
+        """
+        if not self.servable:
+            raise CommandError("This command can't be served.")
+
     #
     # Utils
     #
@@ -78,35 +101,69 @@ class BaseCommand:
 
         return (server_id, auth_token)
 
+    def _run_hook(self, command):
+        # type: (str) -> None
+        """
+        Runs a post-hook with self.hooks.
+
+        Raises CommandError if the hook fails or times out.
+
+        """
+        result = self.hooks.run(command)
+
+        if result is None:
+            pass  # Another process will run it.
+        elif result.timed_out:
+            raise CommandError("{} timed out after {} seconds".format(command, self.hooks.timeout))
+        elif result.returncode != 0:
+            raise CommandError("{} exited with status {}".format(command, result.returncode))
+
     def _print_server(self, server):
         # type: (Server) -> None
         """
         Prints information in a Server instance to stdout.
         """
         target = server.target
+        endpoints = self._endpoints(server)
 
         print("Target: {} ({})".format(target.name, target.target_id), file=self.stdout)
         print("Server: {} ({})".format(server.name, server.server_id), file=self.stdout)
         print("", file=self.stdout)
 
-        for openvpn in target.openvpn:
+        for openvpn in endpoints['openvpn']:
             print("OpenVPN: {}  {}/{}  {}/{}".format(
                 openvpn.fqdn, openvpn.proto, openvpn.port,
                 openvpn.cipher, openvpn.digest
             ), file=self.stdout)
 
-        for ikev2 in target.ikev2:
+        for ikev2 in endpoints['ikev2']:
             print("IKEv2: {}  leftid: {}  rightca: {}".format(
                 ikev2.fqdn, ikev2.server_id, ikev2.client_ca_dn
             ), file=self.stdout)
 
+        for wireguard in endpoints['wireguard']:
+            print("Wireguard: {}  public_key: {}".format(
+                wireguard.fqdn, wireguard.public_key
+            ), file=self.stdout)
+
+    def _endpoints(self, server):
+        # type: (Server) -> Dict[str, List[ApiResult]]
+        """
+        Returns the VPN endpoints of a Server instance's target by protocol:
+        'openvpn', 'ikev2' and 'wireguard'.
+        """
+        target = server.target
+
         try:
-            for wireguard in target.wireguard:
-                print("Wireguard: {}  public_key: {}".format(
-                    wireguard.fqdn, wireguard.public_key
-                ), file=self.stdout)
+            wireguard = target.wireguard
         except AttributeError:
-            pass
+            wireguard = []
+
+        return {
+            'openvpn': target.openvpn,
+            'ikev2': target.ikev2,
+            'wireguard': wireguard,
+        }
 
     #
     # Internal
@@ -1,89 +1,306 @@
-from hashlib import sha1
+from collections import namedtuple
+from hashlib import sha1, sha256
 import os
 import os.path
-import subprocess
+import queue
+import sys
+import threading
+import time
 
-from asn1crypto import pem
+from asn1crypto import crl, pem
 import requests
 from six.moves.configparser import ConfigParser, NoOptionError  # noqa
 from six.moves.urllib.parse import urlsplit
-from typing import Any, List, Dict, Tuple  # noqa
+from typing import Any, Callable, IO, List, Dict, Optional, Tuple  # noqa
 
-from ._base import BaseCommand, CommandError
+from cloak.serverapi.utils.crlbundle import CRLBundle, HashedDir
+from cloak.serverapi.utils.files import atomic_write
+from cloak.serverapi.utils.sharedcache import SharedCache  # noqa
+
+from ._base import BaseCommand
 
 
 CONFIG_SECTION = 'serverapi:crls'
 
+# Seconds to give each mirror before starting the next one.
+DEFAULT_STAGGER = 0.5
+
+# The latency (in seconds) we remember for a mirror that failed.
+FAILED_LATENCY = 30.0
+
 
 class Command(BaseCommand):
     brief = "Refresh CRLs"
     description = """
         Downloads updated copies of one or more CRLs. This doesn't interact
         with the API, but it's provided as a convenience. This saves ETags to
-        the config file to minimize traffic and detect changes.
+        the config file to minimize traffic and detect changes. With
+        --shared-dir, CRLs are downloaded through a cache shared with other
+        containers. With --cache-dir, interrupted downloads are resumed.
+    """
+    epilog = """
+        If a CRL is published in several places, list its mirrors together,
+        separated by spaces (quoted on the command line). Mirrors are tried
+        fastest first, and if one hasn't answered within --stagger seconds,
+        the next one is started as well. The first valid CRL wins. The CRL
+        is named after the first mirror listed.
     """
+    stagger = DEFAULT_STAGGER
+
+    # Where to keep interrupted downloads, if anywhere.
+    partial_dir = None  # type: str
+
+    def __init__(self, stdout=sys.stdout, stderr=sys.stderr):
+        # type: (IO[str], IO[str]) -> None
+        super().__init__(stdout, stderr)
+
+        # The content of each CRL that we've saved, by path.
+        self._saved = {}  # type: Dict[str, bytes]
 
     def add_arguments(self, parser, group):
-        group.add_argument('-i', '--infile', help="Path to a file with URLs (one per line).")
+        group.add_argument('-i', '--infile', help="Path to a file with URLs (one CRL per line).")
         group.add_argument('-o', '--out', default=os.getcwd(), help="Where to download the CRLs. Defaults to the current directory.")
         group.add_argument('-f', '--format', dest='fmt', choices=['der', 'pem'], default='pem', help="The format to output. [%(default)s]")
-        group.add_argument('-p', '--post-hook', help="Command to run if any CRLs were updated. This will be run in a shell.")
-        group.add_argument('urls', nargs='*', metavar='url', help="A CRL to download.")
+        group.add_argument('-p', '--post-hook', help="Command to run if any CRLs were updated. This is run in a shell if it uses shell syntax.")
+        group.add_argument('--bundle', help="Also keep every CRL in this one PEM file.")
+        group.add_argument('--hash-dir', help="Also keep links to the CRLs in this directory, named by issuer hash (like c_rehash).")
+        group.add_argument('--stagger', type=float, default=DEFAULT_STAGGER, metavar='SECONDS', help="How long to wait for one mirror before trying the next. [%(default)s]")
+        group.add_argument('urls', nargs='*', metavar='url', help="A CRL to download, or several mirrors of one.")
 
-    def handle(self, config, infile, out, fmt, post_hook, urls, **options):
+    def handle(self, config, infile, out, fmt, post_hook, bundle, hash_dir, stagger, urls, cache_dir=None, **options):
         if not config.has_section(CONFIG_SECTION):
             config.add_section(CONFIG_SECTION)
 
+        self.stagger = stagger
+        if cache_dir is not None:
+            self.partial_dir = os.path.join(cache_dir, 'crls')
+
         if infile is not None:
             with open(infile, 'rt') as f:
-                urls.extend(filter(None, (url.strip() for url in f)))
+                urls.extend(f)
+
+        groups = list(filter(None, (url.split() for url in urls)))
 
         any_updated = False
-        for url in urls:
-            updated = self._fetch_crl(config, url, out, fmt)
+        for mirrors in groups:
+            updated = self._fetch_crl(config, mirrors, out, fmt)
             any_updated = any_updated or updated
 
+        paths = [self._crl_path(mirrors[0], out, fmt) for mirrors in groups]
+        if self._update_combined(paths, bundle, hash_dir):
+            any_updated = True
+
         if any_updated and (post_hook is not None):
-            returncode = subprocess.call(post_hook, shell=True)
-            if returncode != 0:
-                raise CommandError("{} exited with status {}".format(post_hook, returncode))
+            self._run_hook(post_hook)
 
-    def _fetch_crl(self, config, url, out, fmt):
-        # type: (ConfigParser, str, str, str) -> bool
-        updated = False
+    def _fetch_crl(self, config, mirrors, out, fmt, session=None):
+        # type: (ConfigParser, List[str], str, str, requests.Session) -> bool
+        """
+        Downloads a CRL if it's changed. Returns True if it was updated.
+
+        mirrors: One or more URLs for the CRL.
+        session: An optional requests.Session to download with.
+
+        """
+        get = session.get if (session is not None) else requests.get
+
+        shared_cache = getattr(self.client, 'shared_cache', None)
+        if shared_cache is not None:
+            return self._fetch_shared_crl(shared_cache, config, mirrors, out, fmt, get)
+
+        etags = {}  # type: Dict[str, str]
+        for url in mirrors:
+            try:
+                etags[url] = config.get(CONFIG_SECTION, _url_hash(url))
+            except NoOptionError:
+                pass
+
+        try:
+            url, response = self._race(config, mirrors, etags, get)
+        except _DownloadError as e:
+            self._print_error(e.url, e.response)
+            return False
+
+        if response.status_code == 304:
+            return False
+
+        if 'ETag' in response.headers:
+            config.set(CONFIG_SECTION, _url_hash(url), response.headers['ETag'])
 
-        url_hash = sha1(url.encode('utf-8')).hexdigest()
-        headers = {}  # type: Dict[str, str]
+        return self._update_crl(config, mirrors[0], response.content, out, fmt)
+
+    def _fetch_shared_crl(self, shared_cache, config, mirrors, out, fmt, get):
+        # type: (SharedCache, ConfigParser, List[str], str, str, Callable[..., requests.Response]) -> bool
+        """
+        Gets a CRL through a cache shared with other containers.
+
+        Only one container downloads each CRL per interval.
+
+        """
+        def download(meta):
+            # type: (Dict[str, Any]) -> Optional[Tuple[bytes, Dict[str, Any]]]
+            url, response = self._race(config, mirrors, meta.get('etags', {}), get)
+            if response.status_code == 304:
+                return None
+
+            return (response.content, {'etags': {url: response.headers.get('ETag')}})
 
         try:
-            etag = config.get(CONFIG_SECTION, url_hash)
-        except NoOptionError:
-            pass
-        else:
-            headers = {'If-None-Match': etag}
-
-        response = requests.get(url, headers=headers)
-
-        if response.status_code == 200:
-            crl_name = os.path.basename(urlsplit(url).path)
-            crl_name, content = self._format_crl(crl_name, response.content, fmt)
-            crl_path = os.path.join(out, crl_name)
-            with open(crl_path, 'wb') as f:
-                f.write(content)
-            print(crl_path, file=self.stdout)
-            updated = True
-
-            if 'ETag' in response.headers:
-                config.set(CONFIG_SECTION, url_hash, response.headers['ETag'])
-        elif response.status_code == 304:
-            pass
-        else:
-            print("Error {} downloading {}: {}".format(
-                response.status_code, url, response.content
-            ), file=self.stderr)
+            content, meta = shared_cache.fetch(' '.join(mirrors), download)
+        except _DownloadError as e:
+            self._print_error(e.url, e.response)
+            return False
+
+        return self._update_crl(config, mirrors[0], content, out, fmt)
+
+    def _update_crl(self, config, url, content, out, fmt):
+        # type: (ConfigParser, str, bytes, str, str) -> bool
+        """
+        Saves a CRL unless it's the one we saved last. Returns True if it
+        was saved.
+
+        We remember the digest of the copy that we saved, so that a CRL that
+        we get from a different mirror (or through the shared cache) doesn't
+        count as a change.
+
+        """
+        option = '{}-sha256'.format(_url_hash(url))
+        digest = sha256(content).hexdigest()
+        if config.has_option(CONFIG_SECTION, option) and (config.get(CONFIG_SECTION, option) == digest):
+            return False
+
+        self._save_crl(url, content, out, fmt)
+        config.set(CONFIG_SECTION, option, digest)
+
+        return True
+
+    def _race(self, config, mirrors, etags, get):
+        # type: (ConfigParser, List[str], Dict[str, str], Callable[..., requests.Response]) -> Tuple[str, _Response]
+        """
+        Downloads a CRL from whichever mirror answers first.
+
+        etags: ETags to send to each mirror, by URL.
+
+        Mirrors are started in order of their remembered latency (new ones
+        first, so that we learn it), each
+        self.stagger seconds after the last, or right away if the last one
+        failed. The first one to return a valid CRL (or a 304) wins, and the
+        rest are abandoned: the ones that haven't started never will, and
+        the ones in progress stop reading. With self.partial_dir, what they've
+        read is kept, as it is when a download is interrupted, and the next
+        request to the same mirror resumes it.
+
+        Returns (url, response). If every mirror fails, this raises the last
+        failure.
+
+        """
+        latencies = {url: self._get_latency(config, url) for url in mirrors}
+        waiting = sorted(mirrors, key=lambda url: latencies[url] or 0)
+
+        results = queue.Queue()  # type: queue.Queue
+        cancelled = threading.Event()
+        started = {}  # type: Dict[str, float]
+        finished = {}  # type: Dict[str, float]
+        winner = None  # type: Tuple[str, _Response]
+        failure = None  # type: Exception
+
+        try:
+            while (winner is None) and (waiting or (len(finished) < len(started))):
+                if waiting:
+                    url = waiting.pop(0)
+                    headers = {'If-None-Match': etags[url]} if etags.get(url) else {}
+                    partial = _Partial(os.path.join(self.partial_dir, _url_hash(url))) if self.partial_dir else None
+                    started[url] = time.monotonic()
+                    threading.Thread(
+                        target=_download, args=(get, url, headers, partial, cancelled, results), daemon=True
+                    ).start()
+
+                try:
+                    url, outcome, elapsed = results.get(timeout=(self.stagger if waiting else None))
+                except queue.Empty:
+                    continue
+
+                if isinstance(outcome, Exception):
+                    finished[url] = FAILED_LATENCY
+                    failure = outcome
+                else:
+                    finished[url] = elapsed
+                    winner = (url, outcome)
+        finally:
+            cancelled.set()
+
+        # Learn which mirrors are fastest. The ones still in progress are at
+        # least as slow as they've been so far.
+        if len(mirrors) > 1:
+            now = time.monotonic()
+            for url, start in started.items():
+                latency = finished.get(url)
+                if latency is None:
+                    latency = max(now - start, latencies[url] or 0)
+                self._set_latency(config, url, latency, latencies[url])
+
+        if winner is None:
+            raise failure
+
+        return winner
+
+    def _get_latency(self, config, url):
+        # type: (ConfigParser, str) -> Optional[float]
+        try:
+            return config.getfloat(CONFIG_SECTION, '{}-latency'.format(_url_hash(url)))
+        except (NoOptionError, ValueError):
+            return None
+
+    def _set_latency(self, config, url, latency, previous):
+        # type: (ConfigParser, str, float, Optional[float]) -> None
+        """ Remembers a moving average of each mirror's latency. """
+        if previous is not None:
+            latency = (latency + previous) / 2
+
+        config.set(CONFIG_SECTION, '{}-latency'.format(_url_hash(url)), '{:.3f}'.format(latency))
+
+    def _save_crl(self, url, content, out, fmt):
+        # type: (str, bytes, str, str) -> None
+        crl_path = self._crl_path(url, out, fmt)
+        _, formatted = self._format_crl(os.path.basename(crl_path), content, fmt)
+        atomic_write(crl_path, formatted)
+        self._saved[crl_path] = content
+        print(crl_path, file=self.stdout)
+
+    def _crl_path(self, url, out, fmt):
+        # type: (str, str, str) -> str
+        base, _ = os.path.splitext(os.path.basename(urlsplit(url).path))
+
+        return os.path.join(out, base + ('.pem' if (fmt == 'pem') else '.crl'))
+
+    def _update_combined(self, paths, bundle, hash_dir):
+        # type: (List[str], str, str) -> bool
+        """
+        Updates the CRL bundle and hashed directory, if we have them, with
+        the CRLs that we've saved. Returns True if either one changed.
+
+        paths: Every CRL that they should include.
+
+        """
+        updated = False
+
+        if bundle is not None:
+            if CRLBundle(bundle).update(paths, self._saved, _read_file):
+                print(bundle, file=self.stdout)
+                updated = True
+
+        if hash_dir is not None:
+            if HashedDir(hash_dir).update(paths, self._saved):
+                updated = True
 
         return updated
 
+    def _print_error(self, url, response):
+        # type: (str, requests.Response) -> None
+        print("Error {} downloading {}: {}".format(
+            response.status_code, url, response.content
+        ), file=self.stderr)
+
     def _format_crl(self, name, content, fmt):
         # type: (str, bytes, str) -> Tuple[str, bytes]
         """
@@ -109,3 +326,172 @@ class Command(BaseCommand):
                 _, _, content = pem.unarmor(content)
 
         return (base + ext, content)
+
+
+_Response = namedtuple('_Response', ['status_code', 'headers', 'content'])
+
+
+class _DownloadError(Exception):
+    def __init__(self, url, response):
+        # type: (str, _Response) -> None
+        super().__init__(url, response.status_code)
+        self.url = url
+        self.response = response
+
+
+def _download(get, url, headers, partial, cancelled, results):
+    # type: (Callable[..., requests.Response], str, Dict[str, str], Optional[_Partial], threading.Event, queue.Queue) -> None
+    """
+    Downloads a CRL from one mirror for Command._race.
+
+    partial: Where to keep the download if it's interrupted, if anywhere.
+        If it has part of this CRL already, we only request the rest.
+
+    Puts (url, outcome, elapsed) on results, where outcome is a _Response or
+    an exception. A 206 is completed and reported as a 200. Nothing is put
+    if we're cancelled first.
+
+    """
+    if partial is not None:
+        headers = dict(headers, **partial.headers())
+
+    start = time.monotonic()
+    try:
+        response = get(url, headers=headers, stream=True)
+        with response:
+            chunks = [partial.begin(response) if (partial is not None) else b'']
+            try:
+                # Small chunks, because a chunk is lost if the connection drops.
+                for chunk in response.iter_content(8 * 1024):
+                    if cancelled.is_set():
+                        return
+                    chunks.append(chunk)
+                    if partial is not None:
+                        partial.write(chunk)
+            finally:
+                if partial is not None:
+                    partial.close()
+
+            status_code = 200 if (response.status_code == 206) else response.status_code
+            outcome = _Response(status_code, response.headers, b''.join(chunks))
+
+        if outcome.status_code not in [200, 304]:
+            raise _DownloadError(url, outcome)
+        if outcome.status_code == 200:
+            if partial is not None:
+                partial.discard()
+            if not _is_crl(outcome.content):
+                raise _DownloadError(url, outcome._replace(content=b"This isn't a CRL."))
+    except Exception as e:
+        outcome = e
+
+    if not cancelled.is_set():
+        results.put((url, outcome, time.monotonic() - start))
+
+
+class _Partial:
+    """
+    Part of a CRL from one mirror, kept so that we can resume it.
+
+    path: Where to keep it, without an extension. The content goes in
+        path.part and the ETag that it belongs to in path.etag.
+
+    We only keep content with a strong ETag, which we send back in If-Range
+    so that a CRL that's changed in the meantime is sent in full.
+
+    """
+    def __init__(self, path):
+        # type: (str) -> None
+        self.path = path
+
+        try:
+            with open(path + '.etag', 'r') as f:
+                self.etag = f.read()  # type: Optional[str]
+            self.offset = os.path.getsize(path + '.part')
+        except (IOError, OSError):
+            self.etag = None
+            self.offset = 0
+
+        self._file = None  # type: Optional[IO[bytes]]
+
+    def headers(self):
+        # type: () -> Dict[str, str]
+        """ Headers to request the rest of the CRL. """
+        if (self.etag is None) or (self.offset == 0):
+            return {}
+
+        return {'Range': 'bytes={}-'.format(self.offset), 'If-Range': self.etag}
+
+    def begin(self, response):
+        # type: (requests.Response) -> bytes
+        """
+        Prepares to save the content of response. Returns any content that
+        it continues.
+        """
+        etag = response.headers.get('ETag')
+
+        if response.status_code == 206:
+            content_range = response.headers.get('Content-Range', '')
+            if (etag == self.etag) and content_range.startswith('bytes {}-'.format(self.offset)):
+                with open(self.path + '.part', 'rb') as f:
+                    content = f.read(self.offset)
+                self._file = open(self.path + '.part', 'ab')
+                return content
+        elif response.status_code not in [200, 304, 416]:
+            # Keep it for next time.
+            return b''
+
+        self.discard()
+
+        if (response.status_code == 200) and etag and not etag.startswith('W/'):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            atomic_write(self.path + '.etag', etag)
+            self._file = open(self.path + '.part', 'wb')
+
+        return b''
+
+    def write(self, chunk):
+        # type: (bytes) -> None
+        if self._file is not None:
+            self._file.write(chunk)
+
+    def close(self):
+        # type: () -> None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        # type: () -> None
+        self.close()
+        for ext in ['.part', '.etag']:
+            try:
+                os.unlink(self.path + ext)
+            except OSError:
+                pass
+
+
+def _is_crl(content):
+    # type: (bytes) -> bool
+    try:
+        if pem.detect(content):
+            _, _, content = pem.unarmor(content)
+        crl.CertificateList.load(content)['tbs_cert_list']['this_update'].native
+    except (ValueError, TypeError, KeyError):
+        return False
+
+    return True
+
+
+def _read_file(path):
+    # type: (str) -> Optional[bytes]
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def _url_hash(url):
+    # type: (str) -> str
+    return sha1(url.encode('utf-8')).hexdigest()
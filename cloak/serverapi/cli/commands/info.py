@@ -1,8 +1,7 @@
-import json
-
 import six
 
 from cloak.serverapi.server import Server
+from cloak.serverapi.utils import codec
 from cloak.serverapi.utils.encoding import force_text
 
 from ._base import BaseCommand
@@ -18,9 +17,9 @@ class Command(BaseCommand):
     def handle(self, config, **options):
         server_id, auth_token = self._require_credentials(config)
 
-        server = Server.retrieve(server_id, auth_token)
+        server = Server.retrieve(server_id, auth_token, client=self.client)
 
         if options['json']:
-            json.dump(server, self.stdout)
+            codec.dump(server, self.stdout)
         else:
             self._print_server(server)
@@ -0,0 +1,24 @@
+from cloak.serverapi.utils.keypool import KEY_TYPES, KeyPool
+
+from ._base import BaseCommand
+
+
+class Command(BaseCommand):
+    brief = "Pregenerate private keys"
+    description = """
+        Fills a pool of private keys for req --key-pool, so that requesting
+        a certificate doesn't have to wait for a new key. This doesn't
+        interact with the API.
+    """
+
+    def add_arguments(self, parser, group):
+        group.add_argument('--key-pool', required=True, help="The directory of pregenerated keys.")
+        group.add_argument('-t', '--key-type', choices=sorted(KEY_TYPES), action='append', help="The type of key to generate. This may be given more than once. [rsa]")
+        group.add_argument('--pool-size', type=int, default=2, help="The number of keys of each type to keep. [%(default)s]")
+
+    def handle(self, config, key_pool, key_type, pool_size, **options):
+        pool = KeyPool(key_pool, pool_size)
+
+        for name in (key_type or ['rsa']):
+            count = pool.fill(name)
+            print("Generated {} {} key{}.".format(count, name, '' if (count == 1) else 's'), file=self.stdout)
@@ -1,14 +1,13 @@
 import os
 import os.path
-import subprocess
 import time
 
 from six.moves.configparser import ConfigParser, NoOptionError  # noqa
 from typing import cast
 
-from cloak.serverapi.server import Server, PKI
+from cloak.serverapi.server import Bundle, Server, PKI  # noqa
 
-from ._base import BaseCommand, CommandError
+from ._base import BaseCommand
 
 
 class Command(BaseCommand):
@@ -19,19 +18,21 @@ class Command(BaseCommand):
         group.add_argument('-o', '--out', default=os.getcwd(), help="Where to download the certificates. Defaults to the current directory.")
         group.add_argument('-f', '--force', action='store_true', help="Ignore any existing tag and always download the certificates.")
         group.add_argument('-w', '--wait', action='store_true', help="If a certificate request is pending, wait for it to be approved.")
-        group.add_argument('-p', '--post-hook', help="Command to run if the certificates were updated. This will be run in a shell.")
+        group.add_argument('-p', '--post-hook', help="Command to run if the certificates were updated. This is run in a shell if it uses shell syntax.")
 
     def handle(self, config, out, force, wait, post_hook, **options):
         server_id, auth_token = self._require_credentials(config)
 
-        server = Server.retrieve(server_id, auth_token)
+        tag = self._get_tag(config) if (not force) else None
 
-        while wait and server.csr_pending:
+        # The server state and PKI come back together, in one request if the
+        # API supports it.
+        bundle = self._fetch(server_id, auth_token, tag)
+        while wait and bundle.server.csr_pending:
             time.sleep(5)
-            server = Server.retrieve(server_id, auth_token)
+            bundle = self._fetch(server_id, auth_token, tag)
 
-        tag = self._get_tag(config) if (not force) else None
-        result = server.get_pki(tag)
+        result = bundle.pki
 
         if result is not PKI.NOT_MODIFIED:
             pki = cast(PKI, result)
@@ -44,6 +45,13 @@ class Command(BaseCommand):
         else:
             print("Not modified. Pass -f to download anyway.", file=self.stdout)
 
+    def _fetch(self, server_id, auth_token, tag):
+        # type: (str, str, str) -> Bundle
+        return Server.bundle(
+            server_id, auth_token, parts=['server', 'pki'], pki_tag=tag,
+            client=self.client
+        )
+
     def _get_tag(self, config):
         # type: (ConfigParser) -> str
         try:
@@ -58,9 +66,7 @@ class Command(BaseCommand):
         self._write_pki(pki, out)
 
         if post_hook is not None:
-            returncode = subprocess.call(post_hook, shell=True)
-            if returncode != 0:
-                raise CommandError("{} exited with status {}".format(post_hook, returncode))
+            self._run_hook(post_hook)
 
         config.set('serverapi', 'pki_tag', pki.tag)
 
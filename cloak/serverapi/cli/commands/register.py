@@ -32,7 +32,7 @@ class Command(BaseCommand):
         if key is None:
             key = input("Enter your Encrypt.me private end-point server authorization key: ")
 
-        server = Server.register(key, name)
+        server = Server.register(key, name, client=self.client)
 
         config.set('serverapi', 'server_id', server.server_id)
         config.set('serverapi', 'auth_token', server.auth_token)
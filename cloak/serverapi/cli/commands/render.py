@@ -0,0 +1,252 @@
+from hashlib import sha1
+import json
+import os
+import os.path
+import string
+
+from six.moves.configparser import ConfigParser, NoOptionError  # noqa
+from typing import Any, Dict, List, Set, Tuple  # noqa
+
+from cloak.serverapi.server import Server
+from cloak.serverapi.utils.files import atomic_write
+
+from ._base import BaseCommand, CommandError
+
+
+# The daemons that we render configs for, in the order that we report them.
+DAEMONS = [
+    ('openvpn', "OpenVPN"),
+    ('ikev2', "IKEv2 (strongSwan)"),
+    ('wireguard', "WireGuard"),
+]
+
+# Remembers the files that each template was rendered to, so that the ones it
+# no longer produces can be removed.
+CONFIG_SECTION = 'serverapi:render'
+
+
+class Command(BaseCommand):
+    brief = "Write VPN configs from templates"
+    description = """
+        Renders templates with this server's OpenVPN, IKEv2 and WireGuard
+        settings. Files are only written if they've changed. Prints the
+        daemons whose configs changed, which need to be reloaded.
+    """
+    epilog = """
+        Templates refer to values as $name or ${name}: target_id,
+        target_name, server_id, server_name and the settings of each
+        endpoint (see info --json), which take precedence. If an output
+        path has {name} fields, a file is written for each endpoint (e.g.
+        openvpn-{proto}-{port}.conf); otherwise the endpoints are rendered
+        one after another into one file. Files that a template rendered
+        last time but no longer produces, because an endpoint went away or
+        OUT changed, are removed.
+    """
+
+    def add_arguments(self, parser, group):
+        for daemon, name in DAEMONS:
+            group.add_argument(
+                '--{}'.format(daemon), nargs=2, action='append', default=[], metavar=('TEMPLATE', 'OUT'),
+                help="Render TEMPLATE to OUT for each {} endpoint. This may be given more than once.".format(name)
+            )
+        group.add_argument(
+            '--reload-hook', nargs=2, action='append', default=[], metavar=('DAEMON', 'COMMAND'),
+            help="Command to run if DAEMON's configs changed. This is run in a shell if it uses shell syntax."
+        )
+
+    def handle(self, config, reload_hook, **options):
+        server_id, auth_token = self._require_credentials(config)
+
+        hooks = {}  # type: Dict[str, List[str]]
+        for daemon, command in reload_hook:
+            if daemon not in dict(DAEMONS):
+                raise CommandError("Unknown daemon for --reload-hook: {}".format(daemon))
+            hooks.setdefault(daemon, []).append(command)
+
+        server = Server.retrieve(server_id, auth_token, client=self.client)
+        endpoints = self._endpoints(server)
+        common = {
+            'target_id': server.target.target_id,
+            'target_name': server.target.name,
+            'server_id': server.server_id,
+            'server_name': server.name,
+        }
+
+        # Render everything before we write anything.
+        rendered = []  # type: List[Tuple[str, Dict[str, str]]]
+        outputs = {}  # type: Dict[Tuple[str, str], Set[str]]
+        for daemon, _ in DAEMONS:
+            files = {}  # type: Dict[str, str]
+            for template_path, out in options[daemon]:
+                template = _load_template(template_path)
+                paths = outputs.setdefault((daemon, template_path), set())
+                for path, content in self._render(template, out, endpoints[daemon], common):
+                    files[path] = files.get(path, '') + content
+                    paths.add(os.path.abspath(path))
+            rendered.append((daemon, files))
+
+        written = [daemon for daemon, files in rendered if self._write(files)]
+        removed = self._remove_stale(config, outputs)
+        changed = [daemon for daemon, _ in DAEMONS if (daemon in written) or (daemon in removed)]
+
+        for daemon in changed:
+            print(daemon, file=self.stdout)
+
+        for daemon in changed:
+            for command in hooks.get(daemon, []):
+                self._run_hook(command)
+
+    def _render(self, template, out, endpoints, common):
+        # type: (_Template, str, List[Dict[str, Any]], Dict[str, Any]) -> List[Tuple[str, str]]
+        """
+        Renders a template for each endpoint. Returns a list of (path,
+        content).
+        """
+        rendered = []
+        for index, endpoint in enumerate(endpoints):
+            values = dict(common)
+            values.update(endpoint)
+            values.setdefault('index', index)
+            try:
+                path = out.format(**values)
+                content = template.render(values)
+            except (KeyError, IndexError) as e:
+                raise CommandError("{} isn't a setting of this endpoint.".format(e))
+            except ValueError as e:
+                raise CommandError("Error rendering {}: {}".format(out, e))
+
+            rendered.append((path, content))
+
+        return rendered
+
+    def _write(self, files):
+        # type: (Dict[str, str]) -> bool
+        """
+        Writes the files that have changed. Returns True if any were written.
+        """
+        updated = False
+
+        for path, content in sorted(files.items()):
+            try:
+                with open(path, 'r') as f:
+                    current = f.read()
+            except IOError:
+                current = None
+
+            if content != current:
+                atomic_write(path, content)
+                updated = True
+
+        return updated
+
+    def _remove_stale(self, config, outputs):
+        # type: (ConfigParser, Dict[Tuple[str, str], Set[str]]) -> Set[str]
+        """
+        Removes the files that each template rendered last time but not this
+        time, and remembers what it rendered now. Returns the daemons that
+        lost any files.
+        """
+        if not config.has_section(CONFIG_SECTION):
+            config.add_section(CONFIG_SECTION)
+
+        current = set()  # type: Set[str]
+        for paths in outputs.values():
+            current.update(paths)
+
+        removed = set()  # type: Set[str]
+        for (daemon, template_path), paths in sorted(outputs.items()):
+            option = _template_hash(daemon, template_path)
+            try:
+                previous = json.loads(config.get(CONFIG_SECTION, option))
+            except (NoOptionError, ValueError):
+                previous = []
+
+            for path in previous:
+                if path not in current:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass  # Already gone.
+                    else:
+                        removed.add(daemon)
+
+            config.set(CONFIG_SECTION, option, json.dumps(sorted(paths)))
+
+        return removed
+
+
+def _template_hash(daemon, template_path):
+    # type: (str, str) -> str
+    return sha1('{}:{}'.format(daemon, os.path.abspath(template_path)).encode('utf-8')).hexdigest()
+
+
+#
+# Templates
+#
+
+class _Template:
+    """
+    A template in string.Template syntax, parsed once so that rendering it is
+    just a join.
+    """
+    def __init__(self, text):
+        # type: (str) -> None
+        self._literals = []  # type: List[str]
+        self._names = []  # type: List[str]
+
+        literal = ''
+        pos = 0
+        for match in string.Template.pattern.finditer(text):
+            literal += text[pos:match.start()]
+            pos = match.end()
+
+            if match.group('escaped') is not None:
+                literal += '$'
+            elif match.group('invalid') is not None:
+                raise ValueError("Invalid placeholder on line {}".format(text.count('\n', 0, match.start()) + 1))
+            else:
+                self._literals.append(literal)
+                self._names.append(match.group('named') or match.group('braced'))
+                literal = ''
+
+        self._literals.append(literal + text[pos:])
+
+    def render(self, values):
+        # type: (Dict[str, Any]) -> str
+        """ Raises KeyError for a missing value. """
+        chunks = [self._literals[0]]
+        for name, literal in zip(self._names, self._literals[1:]):
+            chunks.append(str(values[name]))
+            chunks.append(literal)
+
+        return ''.join(chunks)
+
+
+# Templates by path, with the (mtime, size) of the file they came from. This
+# matters when commands are served by a long-running process.
+_templates = {}  # type: Dict[str, Tuple[Tuple[int, int], _Template]]
+
+
+def _load_template(path):
+    # type: (str) -> _Template
+    """
+    Returns the template at path, parsing it only if it's new or changed.
+    """
+    try:
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+
+        cached = _templates.get(path)
+        if (cached is not None) and (cached[0] == key):
+            return cached[1]
+
+        with open(path, 'r') as f:
+            template = _Template(f.read())
+    except IOError as e:
+        raise CommandError("Error reading template {}: {}".format(path, e))
+    except ValueError as e:
+        raise CommandError("Error in template {}: {}".format(path, e))
+
+    _templates[path] = (key, template)
+
+    return template
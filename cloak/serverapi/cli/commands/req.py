@@ -4,6 +4,7 @@ from oscrypto import asymmetric
 import six
 
 from cloak.serverapi.server import Server
+from cloak.serverapi.utils.keypool import KEY_TYPES, KeyPool, generate_key
 
 from ._base import BaseCommand, CommandError
 
@@ -11,16 +12,25 @@ from ._base import BaseCommand, CommandError
 class Command(BaseCommand):
     brief = "Request a server certificate"
     description = "Request a server certificate. You should only need to do this once."
+    epilog = """
+        EC keys are much faster to generate and to use, but the API may not
+        accept them for every team. With --key-pool, a new key is taken from
+        a pool of pregenerated keys if there is one. The pool isn't refilled;
+        run the keys command for that, for instance from a timer.
+    """
 
     def add_arguments(self, parser, group):
         group.add_argument('-k', '--key', required=True, help="Path to the private key. They key will be created if it doesn't exist.")
+        group.add_argument('-t', '--key-type', choices=sorted(KEY_TYPES), default='rsa', help="The type of key to create. [%(default)s]")
+        group.add_argument('--key-pool', help="A directory of pregenerated keys to take a new key from.")
 
-    def handle(self, config, key, **options):
+    def handle(self, config, key, key_type, key_pool, **options):
         server_id, auth_token = self._require_credentials(config)
 
-        key_pem = self._load_key(six.text_type(key))
+        pool = KeyPool(key_pool) if (key_pool is not None) else None
+        key_pem = self._load_key(six.text_type(key), key_type, pool)
 
-        server = Server.retrieve(server_id, auth_token)
+        server = Server.retrieve(server_id, auth_token, client=self.client)
         success = server.request_certificate(key_pem)
 
         if success:
@@ -32,12 +42,12 @@ class Command(BaseCommand):
     # Key management
     #
 
-    def _load_key(self, path):
-        # type: (str) -> str
+    def _load_key(self, path, key_type='rsa', pool=None):
+        # type: (str, str, KeyPool) -> str
         if os.path.exists(path):
             key_pem = self._read_key(path)
         else:
-            key_pem = self._generate_key(path)
+            key_pem = self._generate_key(path, key_type, pool)
 
         return key_pem
 
@@ -52,12 +62,13 @@ class Command(BaseCommand):
 
         return key_pem
 
-    def _generate_key(self, path):
-        # type: (str) -> str
+    def _generate_key(self, path, key_type='rsa', pool=None):
+        # type: (str, str, KeyPool) -> str
         try:
             with open(path, 'wb') as f:
-                _, privkey = asymmetric.generate_pair('rsa', bit_size=2048)
-                key_pem = asymmetric.dump_private_key(privkey, None, 'pem')
+                key_pem = pool.take(key_type) if (pool is not None) else None
+                if key_pem is None:
+                    key_pem = generate_key(key_type)
                 f.write(key_pem)
         except IOError:
             raise CommandError("{} is not a path to a writable file.".format(path))
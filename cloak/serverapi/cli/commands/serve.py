@@ -0,0 +1,203 @@
+from contextlib import redirect_stderr, redirect_stdout
+import io
+import json
+import os
+import os.path
+import signal
+import socket
+import socketserver
+import threading
+
+from six.moves.configparser import ConfigParser  # noqa
+from typing import Any, Dict, List, Tuple  # noqa
+
+from cloak.serverapi.cli.main import main
+from cloak.serverapi.utils import http
+
+from ._base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    brief = "Answer commands over a Unix socket"
+    description = """
+        Listens on a Unix socket and runs other commands on behalf of
+        cloak-server-client. Commands run in this process, so they skip
+        interpreter startup, reuse API connections and share API results for
+        a few seconds.
+    """
+    epilog = """
+        Anyone who can connect to the socket can run commands as this user,
+        including post-hooks, so keep it private.
+    """
+    servable = False
+
+    def add_arguments(self, parser, group):
+        group.add_argument('-s', '--socket', dest='socket_path', default=default_socket_path(), help="The socket to listen on. [%(default)s]")
+        group.add_argument('--mode', type=lambda value: int(value, 8), default=0o600, help="Permissions for the socket, in octal. [600]")
+        group.add_argument('--ttl', type=float, default=5, help="Seconds to share API results between commands. [%(default)s]")
+
+    def handle(self, config, config_path, socket_path, mode, ttl, **options):
+        client = http.Client(
+            base_url=self.client.base_url,
+            api_version=self.client.api_version,
+            container_version=self.client.container_version,
+            session=self.client.session,
+            timeout=self.client.timeout,
+            single_flight=True,
+            single_flight_ttl=ttl,
+            fallback=self.client.fallback,
+            rate_limiter=self.client.rate_limiter,
+            shared_cache=self.client.shared_cache,
+        )
+
+        server = CommandServer(socket_path, config_path, client, mode)
+        print("Listening on {}".format(socket_path), file=self.stdout)
+        self.stdout.flush()
+
+        # Shut down cleanly when we're stopped as a service.
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+        # The commands we served have been updating the config file. Reload
+        # it so that their changes aren't overwritten when we return.
+        for section in config.sections():
+            config.remove_section(section)
+        config.read([config_path])
+
+
+class CommandServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Runs cloak-server commands for clients of a Unix socket.
+
+    path: The socket to listen on. A stale socket is replaced.
+    config_path: The config file for every command.
+    client: The http.Client for every command.
+    mode: Permissions for the socket.
+
+    Each request is a JSON object with an "argv" list, on a line of its own.
+    Each response is a JSON object with "returncode", "stdout" and "stderr",
+    also on a line of its own. A connection can make any number of requests.
+
+    Commands run one at a time.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, path, config_path, client, mode=0o600):
+        # type: (str, str, http.Client, int) -> None
+        self._prepare(path)
+
+        # Don't let anyone in before we've set the permissions.
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, _Handler)
+        finally:
+            os.umask(umask)
+        os.chmod(path, mode)
+
+        self.path = path
+        self.config_path = config_path
+        self.client = client
+
+        self._lock = threading.Lock()
+
+    def run(self, argv):
+        # type: (List[str]) -> Tuple[int, str, str]
+        """
+        Runs a command and returns (returncode, stdout, stderr).
+        """
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+
+        # argparse writes usage and errors to sys.stdout and sys.stderr.
+        with self._lock, redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                returncode = main(['--config', self.config_path] + argv, stdout, stderr, client=self.client)
+            except SystemExit as e:
+                if isinstance(e.code, int) or (e.code is None):
+                    returncode = e.code or 0
+                else:
+                    print(e.code, file=stderr)
+                    returncode = 1
+
+        return (returncode, stdout.getvalue(), stderr.getvalue())
+
+    def server_close(self):
+        # type: () -> None
+        super().server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _prepare(self, path):
+        # type: (str) -> None
+        if os.path.exists(path):
+            try:
+                call(path, ['--help'], timeout=5)
+            except (OSError, ValueError):
+                os.unlink(path)
+            else:
+                raise CommandError("Another server is already listening on {}.".format(path))
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, 0o700)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server = None  # type: CommandServer
+
+    def handle(self):
+        # type: () -> None
+        for line in self.rfile:
+            try:
+                argv = json.loads(line.decode('utf-8'))['argv']
+                if not all(isinstance(arg, str) for arg in argv):
+                    raise ValueError(argv)
+            except (ValueError, KeyError, TypeError):
+                response = {'returncode': 2, 'stdout': '', 'stderr': "Bad request.\n"}
+            else:
+                returncode, stdout, stderr = self.server.run(argv)
+                response = {'returncode': returncode, 'stdout': stdout, 'stderr': stderr}
+
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+def call(path, argv, timeout=None):
+    # type: (str, List[str], float) -> Tuple[int, str, str]
+    """
+    Runs a command through the server at path.
+
+    Returns (returncode, stdout, stderr). bin/cloak-server-client does the
+    same thing without importing this package, which is much faster.
+
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps({'argv': list(argv)}).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            response = json.loads(f.readline().decode('utf-8'))  # type: Dict[str, Any]
+
+    return (response['returncode'], response['stdout'], response['stderr'])
+
+
+def default_socket_path():
+    # type: () -> str
+    path = os.getenv('CLOAK_SERVER_SOCKET', None)
+    if path is None:
+        if os.geteuid() == 0:
+            path = '/run/encryptme/cloak-server.sock'
+        else:
+            path = os.path.expanduser('~/.encryptme.sock')
+
+    return path
@@ -0,0 +1,99 @@
+import os.path
+import subprocess
+import sys
+
+import requests
+
+from cloak.serverapi.errors import ServerApiError
+from cloak.serverapi.server import Server
+from cloak.serverapi.utils.peerstats import StatsSpool, parse_dump
+from cloak.serverapi.utils.ratelimit import parse_retry_after
+
+from ._base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    brief = "Report WireGuard peer statistics"
+    description = """
+        Collects the latest handshake and traffic of each WireGuard peer
+        from 'wg show dump' and uploads what changed since the last run.
+        Run this on a schedule, e.g. every minute from cron.
+    """
+    epilog = """
+        Each run adds a batch to the spool, which is uploaded along with any
+        others once the oldest is --upload-interval seconds old. Uploads are
+        gzipped, so thousands of peers cost one small request. If the API
+        is unavailable, uploads back off and the oldest batches are merged
+        to keep at most --max-batches.
+    """
+
+    # This runs wg and reads local files.
+    servable = False
+
+    def add_arguments(self, parser, group):
+        group.add_argument('-i', '--interface', default='all', help="The WireGuard interface to report. [%(default)s]")
+        group.add_argument('--dump', metavar='FILE', help="Read 'wg show dump' output from FILE (- for stdin) instead of running wg.")
+        group.add_argument('--spool', help="Keep statistics here until they're uploaded. Defaults to a directory under --cache-dir.")
+        group.add_argument('--upload-interval', type=float, default=300, help="The least seconds between uploads. [%(default)s]")
+        group.add_argument('--max-batches', type=int, default=24, help="The most batches to keep while the API is unavailable. [%(default)s]")
+        group.add_argument('--flush', action='store_true', help="Upload now, regardless of --upload-interval.")
+
+    def handle(self, config, interface, dump, spool, upload_interval, max_batches, flush, cache_dir=None, **options):
+        server_id, auth_token = self._require_credentials(config)
+
+        if spool is None:
+            if cache_dir is None:
+                raise CommandError("stats needs --spool or --cache-dir.")
+            spool = os.path.join(cache_dir, 'peer-stats')
+
+        try:
+            samples = parse_dump(self._read_dump(interface, dump))
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        stats = StatsSpool(spool, max_batches=max_batches)
+        changed = stats.collect(samples)
+        print("Collected {} of {} peers.".format(changed, len(samples)), file=self.stdout)
+
+        if flush or stats.due(upload_interval):
+            self._upload(stats, server_id, auth_token, upload_interval)
+
+    def _read_dump(self, interface, dump):
+        # type: (str, str) -> str
+        if dump == '-':
+            return sys.stdin.read()
+
+        if dump is not None:
+            try:
+                with open(dump, 'r') as f:
+                    return f.read()
+            except IOError as e:
+                raise CommandError("Error reading {}: {}".format(dump, e))
+
+        try:
+            return subprocess.check_output(['wg', 'show', interface, 'dump'], universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise CommandError("Error running wg: {}".format(e))
+
+    def _upload(self, stats, server_id, auth_token, upload_interval):
+        # type: (StatsSpool, str, str, float) -> None
+        batches = stats.batches
+        if not batches:
+            return
+
+        try:
+            Server.upload_peer_stats(server_id, auth_token, batches, client=self.client)
+        except ServerApiError as e:
+            if e.response.status_code in [400, 413, 422]:
+                # Sending these again won't help.
+                stats.uploaded(len(batches))
+                print("The API refused {} batches: {}".format(len(batches), e), file=self.stderr)
+            else:
+                delay = stats.failed(upload_interval, parse_retry_after(e.response.headers.get('Retry-After')))
+                print("Error uploading statistics, retrying in {:.0f}s: {}".format(delay, e), file=self.stderr)
+        except requests.RequestException as e:
+            delay = stats.failed(upload_interval)
+            print("Error uploading statistics, retrying in {:.0f}s: {}".format(delay, e), file=self.stderr)
+        else:
+            stats.uploaded(len(batches))
+            print("Uploaded {} batches.".format(len(batches)), file=self.stdout)
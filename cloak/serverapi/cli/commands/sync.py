@@ -0,0 +1,366 @@
+from concurrent.futures import Future, ThreadPoolExecutor  # noqa
+from functools import partial
+import os
+import os.path
+import signal
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from six.moves.configparser import ConfigParser, NoOptionError, RawConfigParser  # noqa
+from typing import Any, Callable, Dict, List, Set, Tuple  # noqa
+
+from cloak.serverapi.errors import ServerApiError
+from cloak.serverapi.server import WATCH_TIMEOUT, Bundle, PKI, Server  # noqa
+from cloak.serverapi.utils import codec
+from cloak.serverapi.utils.files import atomic_write
+from cloak.serverapi.utils.peerindex import write_index
+
+from . import crls, pki
+from ._base import BaseCommand, CommandError
+
+
+# Kinds of changes, in the order that their hooks run.
+CHANGES = [
+    ('pki', "certificates"),
+    ('crls', "CRLs"),
+    ('peers', "WireGuard peers"),
+]
+
+# With --watch, the least time between requests for changes, in case the API
+# answers them early.
+WATCH_MIN_INTERVAL = 1.0
+
+# With --watch, how long to wait after a failed request for changes.
+WATCH_RETRY_DELAY = 30.0
+
+
+class Command(BaseCommand):
+    brief = "Update certificates, CRLs and WireGuard peers"
+    description = """
+        Does the work of pki, crls and wireguard in a single run. The server,
+        PKI and WireGuard peers are requested together, while the CRLs are
+        downloaded in parallel. Each kind of change can have its own
+        post-hook; a hook given for more than one kind of change only runs
+        once.
+    """
+    epilog = """
+        With --watch, this keeps running and syncs again as soon as the API
+        reports that the certificates or peers have changed, and at least
+        every --interval seconds for the CRLs. If the API can't report
+        changes, this polls every --interval seconds instead.
+    """
+
+    def add_arguments(self, parser, group):
+        group.add_argument('--pki-out', default=os.getcwd(), help="Where to download the certificates. Defaults to the current directory.")
+        group.add_argument('--crl-out', help="Where to download the CRLs. CRLs are only refreshed if this is given.")
+        group.add_argument('--crl-format', choices=['der', 'pem'], default='pem', help="The format to save CRLs in. [%(default)s]")
+        group.add_argument('--crl-bundle', help="Also keep every CRL in this one PEM file.")
+        group.add_argument('--crl-hash-dir', help="Also keep links to the CRLs in this directory, named by issuer hash (like c_rehash).")
+        group.add_argument('--peers-out', help="Save the WireGuard peers to this file as JSON. Peers are only requested if this is given.")
+        group.add_argument('--peers-index', help="Also keep an index of the WireGuard peers in this file, for wireguard lookup.")
+        group.add_argument('-f', '--force', action='store_true', help="Ignore any existing tags and always download the certificates and peers.")
+        group.add_argument('-j', '--jobs', type=int, default=8, help="The number of CRLs to download at once. [%(default)s]")
+        group.add_argument('--pki-hook', help="Command to run if the certificates were updated.")
+        group.add_argument('--crls-hook', help="Command to run if any CRLs were updated.")
+        group.add_argument('--peers-hook', help="Command to run if the WireGuard peers were updated.")
+        group.add_argument('--reload-hook', help="Command to run once if anything was updated.")
+        group.add_argument('-w', '--watch', action='store_true', help="Keep running and sync whenever something changes.")
+        group.add_argument('--interval', type=float, default=300, help="With --watch, the most seconds between syncs. [%(default)s]")
+
+    def handle(self, config, pki_out, crl_out, crl_format, crl_bundle, crl_hash_dir, peers_out,
+               peers_index, force, jobs, pki_hook, crls_hook, peers_hook, reload_hook, watch, interval,
+               config_path=None, cache_dir=None, **options):
+        server_id, auth_token = self._require_credentials(config)
+
+        if not config.has_section(crls.CONFIG_SECTION):
+            config.add_section(crls.CONFIG_SECTION)
+
+        self._crls = crls.Command(self.stdout, self.stderr)
+        self._crls.client = self.client
+        if cache_dir is not None:
+            self._crls.partial_dir = os.path.join(cache_dir, 'crls')
+        self._pki = pki.Command(self.stdout, self.stderr)
+
+        # One pool of CRL connections for every sync, so that --watch doesn't
+        # reconnect to every CRL host each time.
+        with self._crl_session(jobs) as session:
+            sync = partial(
+                self._sync, config, server_id, auth_token, pki_out, crl_out, crl_format, crl_bundle,
+                crl_hash_dir, peers_out, peers_index, jobs, session,
+                {'pki': pki_hook, 'crls': crls_hook, 'peers': peers_hook}, reload_hook,
+            )
+            sync(force)
+
+            if watch:
+                parts = ['pki'] if (peers_out is None) else ['pki', 'wireguard_peers']
+                self._watch(config, config_path, server_id, auth_token, parts, interval, sync)
+
+    def check_servable(self, watch, **options):
+        super().check_servable(**options)
+
+        # This would never return, holding the server.
+        if watch:
+            raise CommandError("sync --watch can't be served.")
+
+    def _sync(self, config, server_id, auth_token, pki_out, crl_out, crl_format, crl_bundle,
+              crl_hash_dir, peers_out, peers_index, jobs, session, hooks, reload_hook, force):
+        # type: (ConfigParser, str, str, str, str, str, str, str, str, str, int, requests.Session, Dict[str, str], str, bool) -> None
+        changed = set()  # type: Set[str]
+        with ThreadPoolExecutor(jobs) as executor:
+            fetches = {}  # type: Dict[str, Future]
+
+            # Refresh the CRLs that we already know about while we wait for
+            # the API.
+            if crl_out is not None:
+                for url in self._read_crl_urls(pki_out):
+                    fetches[url] = self._submit_crl(executor, config, url, crl_out, crl_format, session)
+
+            bundle = self._fetch(config, server_id, auth_token, pki_out, peers_out, force)
+
+            if self._save_pki(bundle, config, pki_out):
+                changed.add('pki')
+
+                # The PKI may list new CRLs.
+                if crl_out is not None:
+                    for url in bundle.pki.crls:
+                        if url not in fetches:
+                            fetches[url] = self._submit_crl(executor, config, url, crl_out, crl_format, session)
+
+            if self._save_peers(bundle, config, peers_out):
+                changed.add('peers')
+            if peers_index is not None:
+                self._index_peers(bundle, peers_out, peers_index)
+
+            if any([self._finish_crl(config, future) for future in fetches.values()]):
+                changed.add('crls')
+
+        if crl_out is not None:
+            paths = [self._crls._crl_path(url, crl_out, crl_format) for url in fetches]
+            if self._crls._update_combined(paths, crl_bundle, crl_hash_dir):
+                changed.add('crls')
+
+        self._run_hooks(changed, hooks, reload_hook)
+
+    def _submit_crl(self, executor, config, url, crl_out, crl_format, session):
+        # type: (ThreadPoolExecutor, ConfigParser, str, str, str, requests.Session) -> Future
+        """
+        Starts downloading a CRL on executor.
+
+        ConfigParser isn't thread-safe, so the worker gets its own copy of
+        the CRL state (ETags, latencies and digests), and _finish_crl()
+        copies it back on this thread.
+
+        """
+        scratch = RawConfigParser()
+        scratch.add_section(crls.CONFIG_SECTION)
+        for option, value in config.items(crls.CONFIG_SECTION, raw=True):
+            scratch.set(crls.CONFIG_SECTION, option, value)
+
+        def fetch():
+            # type: () -> Tuple[bool, ConfigParser]
+            return (self._crls._fetch_crl(scratch, [url], crl_out, crl_format, session), scratch)
+
+        return executor.submit(fetch)
+
+    def _finish_crl(self, config, future):
+        # type: (ConfigParser, Future) -> bool
+        """
+        Waits for a download from _submit_crl() and saves its state. Returns
+        True if the CRL was updated.
+        """
+        updated, scratch = future.result()
+        for option, value in scratch.items(crls.CONFIG_SECTION, raw=True):
+            if (not config.has_option(crls.CONFIG_SECTION, option)) or (config.get(crls.CONFIG_SECTION, option, raw=True) != value):
+                config.set(crls.CONFIG_SECTION, option, value)
+
+        return updated
+
+    def _watch(self, config, config_path, server_id, auth_token, parts, interval, sync):
+        # type: (ConfigParser, str, str, str, List[str], float, Callable[[bool], None]) -> None
+        """
+        Calls sync(False) whenever parts change, and at least every
+        interval seconds. Returns when we're interrupted or terminated.
+        """
+        # Stop cleanly when we're stopped as a service.
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+        try:
+            while True:
+                # Save the tags from each sync in case we're killed.
+                if config_path is not None:
+                    with open(config_path, 'w') as f:
+                        config.write(f)
+                self.stdout.flush()
+
+                deadline = time.monotonic() + interval
+                while not self._wait_for_changes(config, server_id, auth_token, parts, deadline):
+                    pass
+
+                try:
+                    sync(False)
+                except (ServerApiError, requests.RequestException, CommandError) as e:
+                    print("Error syncing: {}".format(e), file=self.stderr)
+        except KeyboardInterrupt:
+            pass
+
+    def _wait_for_changes(self, config, server_id, auth_token, parts, deadline):
+        # type: (ConfigParser, str, str, List[str], float) -> bool
+        """
+        Waits for any of parts to change, until deadline at most. Returns
+        True if they changed or we reached the deadline.
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return True
+
+        tags = {part: self._get_option(config, '{}_tag'.format(part)) for part in parts}
+        start = time.monotonic()
+        try:
+            changed = Server.wait_for_changes(
+                server_id, auth_token, tags, timeout=min(remaining, WATCH_TIMEOUT), client=self.client
+            )
+        except (ServerApiError, requests.RequestException) as e:
+            print("Error waiting for changes: {}".format(e), file=self.stderr)
+            time.sleep(min(remaining, WATCH_RETRY_DELAY))
+            return False
+
+        if changed is None:
+            # Fall back to polling.
+            time.sleep(remaining)
+            return True
+
+        if not changed:
+            time.sleep(max(WATCH_MIN_INTERVAL - (time.monotonic() - start), 0))
+
+        return bool(changed)
+
+    def _fetch(self, config, server_id, auth_token, pki_out, peers_out, force):
+        # type: (ConfigParser, str, str, str, str, bool) -> Bundle
+        parts = ['pki']
+        pki_tag = None  # type: str
+        peers_tag = None  # type: str
+
+        # Don't trust a tag if we've lost the files that it describes.
+        if not (force or self._missing(pki_out, 'server.pem')):
+            pki_tag = self._get_option(config, 'pki_tag')
+
+        if peers_out is not None:
+            parts.append('wireguard_peers')
+            if not (force or self._missing(peers_out)):
+                peers_tag = self._get_option(config, 'wireguard_peers_tag')
+
+        return Server.bundle(
+            server_id, auth_token, parts=parts, pki_tag=pki_tag,
+            wireguard_peers_tag=peers_tag, client=self.client
+        )
+
+    def _save_pki(self, bundle, config, out):
+        # type: (Bundle, ConfigParser, str) -> bool
+        """
+        Saves the PKI if it's changed. Returns True if it was.
+        """
+        result = bundle.pki
+
+        if result is PKI.NOT_MODIFIED:
+            return False
+
+        if result.entity is None:
+            print("No certificate available. Request one with req.", file=self.stdout)
+            return False
+
+        self._pki._write_pki(result, out)
+        config.set('serverapi', 'pki_tag', result.tag)
+        print("Certificates saved to {}.".format(out), file=self.stdout)
+
+        return True
+
+    def _save_peers(self, bundle, config, path):
+        # type: (Bundle, ConfigParser, str) -> bool
+        """
+        Saves the WireGuard peers if they've changed. Returns True if they
+        were.
+        """
+        peers = bundle.wireguard_peers
+
+        if (peers is None) or (peers is Bundle.NOT_MODIFIED):
+            return False
+
+        atomic_write(path, codec.dumps(peers))
+        config.set('serverapi', 'wireguard_peers_tag', bundle.tags['wireguard_peers'])
+        print("WireGuard peers saved to {}.".format(path), file=self.stdout)
+
+        return True
+
+    def _index_peers(self, bundle, peers_out, path):
+        # type: (Bundle, str, str) -> None
+        """
+        Updates the peer index if the peers have changed or it's missing.
+        """
+        peers = bundle.wireguard_peers
+
+        if (peers is None) or (peers is Bundle.NOT_MODIFIED):
+            if (peers_out is None) or not self._missing(path):
+                return
+            with open(peers_out, 'rb') as f:
+                peers = codec.loads(f.read())
+
+        write_index(path, peers)
+
+    def _run_hooks(self, changed, hooks, reload_hook):
+        # type: (Set[str], Dict[str, str], str) -> None
+        commands = []  # type: List[str]
+        for name, _ in CHANGES:
+            if (name in changed) and (hooks[name] is not None):
+                commands.append(hooks[name])
+        if changed and (reload_hook is not None):
+            commands.append(reload_hook)
+
+        if changed:
+            print("Updated {}.".format(', '.join(
+                label for name, label in CHANGES if name in changed
+            )), file=self.stdout)
+        else:
+            print("No changes.", file=self.stdout)
+
+        # Each hook runs once, no matter how many changes asked for it.
+        for command in sorted(set(commands), key=commands.index):
+            self._run_hook(command)
+
+    #
+    # Utils
+    #
+
+    def _read_crl_urls(self, pki_out):
+        # type: (str) -> List[str]
+        try:
+            with open(os.path.join(pki_out, 'crl_urls.txt'), 'rt') as f:
+                urls = list(filter(None, (url.strip() for url in f)))
+        except IOError:
+            urls = []
+
+        return urls
+
+    def _crl_session(self, jobs):
+        # type: (int) -> requests.Session
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        return session
+
+    def _get_option(self, config, name):
+        # type: (ConfigParser, str) -> str
+        try:
+            value = config.get('serverapi', name)
+        except NoOptionError:
+            value = None
+
+        return value
+
+    def _missing(self, *path):
+        # type: (*str) -> bool
+        return not os.path.exists(os.path.join(*path))
@@ -1,8 +1,7 @@
-import json
-
 import six
 
 from cloak.serverapi.server import Server
+from cloak.serverapi.utils import codec
 from cloak.serverapi.utils.encoding import force_text
 
 from ._base import BaseCommand
@@ -21,7 +20,7 @@ class Command(BaseCommand):
     def handle(self, config, name, api_version, wireguard_public_key,**options):
         server_id, auth_token = self._require_credentials(config)
 
-        server = Server.retrieve(server_id, auth_token)
+        server = Server.retrieve(server_id, auth_token, client=self.client)
         server.update_server(
             name=name,
             api_version=api_version,
@@ -29,6 +28,6 @@ class Command(BaseCommand):
         )
 
         if options['json']:
-            json.dump(server, self.stdout)
+            codec.dump(server, self.stdout)
         else:
             self._print_server(server)
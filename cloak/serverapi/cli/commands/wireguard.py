@@ -1,28 +1,99 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import json
-
-import six
+import ipaddress
 
 from cloak.serverapi.server import Server
-from cloak.serverapi.utils.encoding import force_text
+from cloak.serverapi.utils import codec
+from cloak.serverapi.utils.cidr import aggregate_peers, aggregate_routes, count_allowed_ips
+from cloak.serverapi.utils.peerindex import PeerIndex, write_index
 
-from ._base import BaseCommand
+from ._base import BaseCommand, CommandError
 
 
 class Command(BaseCommand):
     brief = "Retreives information about WireGuard peers"
     description = "Retreives information about WireGuard peers."
+    epilog = """
+        With --index, the peers are also indexed by public key and allowed
+        IP, so that 'wireguard --index PATH lookup' can find the peer for a
+        tunnel address without the API.
+
+        --aggregate and --routes report how many entries they saved on
+        stderr.
+    """
 
     def add_arguments(self, parser, group):
-        pass
+        group.add_argument('--index', help="Keep an index of the peers in this file.")
+        group.add_argument(
+            '--aggregate', action='store_true',
+            help="Collapse each peer's allowed IPs into fewer prefixes, where that doesn't change the peer that any address is routed to."
+        )
+        group.add_argument(
+            '--routes', action='store_true',
+            help="Print the fewest prefixes that cover every peer, one per line, instead of the peers. These are the routes to the WireGuard interface."
+        )
+
+        actions = parser.add_subparsers(dest='action', metavar='action', title="actions")
+        lookup = actions.add_parser(
+            'lookup', help="Find a peer in --index.",
+            description="Finds the peer with a public key, or the peer whose allowed IPs best match an address, in --index."
+        )
+        lookup.add_argument('query', metavar='ip|key', help="A tunnel IP address or a peer's public key.")
+
+    def handle(self, config, index, aggregate, routes, action=None, **options):
+        if action == 'lookup':
+            self._lookup(index, options['query'])
+            return
 
-    def handle(self, config, **options):
         server_id, auth_token = self._require_credentials(config)
 
-        peers = Server.wireguard_peers(server_id, auth_token)
+        peers = Server.wireguard_peers(server_id, auth_token, client=self.client)
+
+        try:
+            if aggregate:
+                aggregated = aggregate_peers(peers)
+                self._report("allowed IPs", count_allowed_ips(peers), count_allowed_ips(aggregated))
+                peers = aggregated
+
+            if index is not None:
+                write_index(index, peers)
+
+            if routes:
+                prefixes = aggregate_routes(peers)
+                self._report("routes", count_allowed_ips(peers), len(prefixes))
+        except ValueError as e:
+            raise CommandError("Bad WireGuard peers: {}".format(e))
 
-        if six.PY3:
-            json.dump(peers, self.stdout)
+        if routes:
+            for prefix in prefixes:
+                print(prefix, file=self.stdout)
         else:
-            print(force_text(json.dumps(peers)), file=self.stdout)
+            codec.dump(peers, self.stdout)
+
+    def _report(self, name, before, after):
+        # type: (str, int, int) -> None
+        print("Aggregated {} {} into {} ({} saved).".format(before, name, after, before - after), file=self.stderr)
+
+    def _lookup(self, index, query):
+        # type: (str, str) -> None
+        if index is None:
+            raise CommandError("lookup needs an --index.")
+
+        try:
+            peer_index = PeerIndex(index)
+        except (IOError, ValueError) as e:
+            raise CommandError("Can't read the index: {}".format(e))
+
+        with peer_index:
+            try:
+                peer = peer_index.find_ip(ipaddress.ip_address(query))
+            except ValueError:
+                try:
+                    peer = peer_index.find_key(query)
+                except ValueError:
+                    raise CommandError("{} isn't an IP address or a public key.".format(query))
+
+        if peer is None:
+            raise CommandError("No peer matches {}.".format(query))
+
+        print(codec.dumps(peer), file=self.stdout)
@@ -4,55 +4,143 @@ import io
 import os
 import os.path
 import sys
+import time
 
 import six
-from six.moves.configparser import RawConfigParser
+from six.moves.configparser import NoOptionError, RawConfigParser
 from typing import IO  # noqa
 
 from cloak.serverapi.cli.commands._base import BaseCommand, CommandError  # noqa
 from cloak.serverapi.errors import ServerApiError
 from cloak.serverapi.server import default_api_version
+from cloak.serverapi.utils import http
 from cloak.serverapi.utils.encoding import force_text
-import cloak.serverapi.utils.http
+from cloak.serverapi.utils.fallback import LastKnownGood
+from cloak.serverapi.utils.hooks import HookRunner
+from cloak.serverapi.utils.profiling import Profiler
+from cloak.serverapi.utils.ratelimit import RateLimiter, jitter
+from cloak.serverapi.utils.sharedcache import SharedCache
 
 
 COMMANDS = [
     'crls',
     'info',
+    'keys',
     'pki',
     'register',
+    'render',
     'req',
+    'serve',
+    'stats',
+    'sync',
     'update',
     'wireguard',
 ]
 
-DEFAULT_BASE_URL = 'https://app.encrypt.me/'
+DEFAULT_BASE_URL = http.DEFAULT_BASE_URL
 
+# Global options that configure the API client, by dest. A served command uses
+# the server's client, so it can't honor them.
+CLIENT_OPTIONS = [
+    ('base_url', '--base_url'),
+    ('timeout', '--timeout'),
+    ('cache_dir', '--cache-dir'),
+    ('deadline', '--deadline'),
+    ('max_rate', '--max-rate'),
+    ('shared_dir', '--shared-dir'),
+    ('shared_ttl', '--shared-ttl'),
+    ('profile_http', '--profile-http'),
+]
+
+
+def main(argv=None, stdout=sys.stdout, stderr=sys.stderr, client=None):
+    # type: (List[str], IO[str], IO[str], http.Client) -> int
+    """
+    Runs a cloak-server command and returns its exit status.
+
+    client: An http.Client to use instead of one configured from the command
+        line. This is how the serve command shares its warm client.
 
-def main(argv=None, stdout=sys.stdout, stderr=sys.stderr):
-    # type: (List[str], IO[str], IO[str]) -> int
+    """
     returncode = 0
 
     try:
         args = parse_args(argv, stdout, stderr)
+        if client is not None:
+            _check_served(args)
+
         config = get_config(args.config_path)
 
         # Changing the base_url is really just for internal use.
         if args.base_url:
-             config.set('serverapi', 'base_url', args.base_url)
-        cloak.serverapi.utils.http.base_url = config.get('serverapi', 'base_url')
+            config.set('serverapi', 'base_url', args.base_url)
+
+        # Serve the last known results if the API is down or too slow.
+        fallback = None  # type: LastKnownGood
+        if args.cache_dir is not None:
+            fallback = LastKnownGood(args.cache_dir, deadline=args.deadline)
+
+        # Downloads shared with other containers on the host.
+        shared_cache = None  # type: SharedCache
+        if args.shared_dir is not None:
+            shared_cache = SharedCache(args.shared_dir, ttl=args.shared_ttl)
+
+        # Hooks are coalesced through a directory shared between runs.
+        hook_dir = args.hook_dir
+        if (hook_dir is None) and (args.cache_dir is not None):
+            hook_dir = os.path.join(args.cache_dir, 'hooks')
+        if args.hook_window and (hook_dir is None):
+            raise CommandError("--hook-window requires --hook-dir or --cache-dir.")
+        args.cmd.hooks = HookRunner(timeout=args.hook_timeout, window=args.hook_window, state_dir=hook_dir)
 
-        # The CLI layer always wants the API version that it was built for.
-        cloak.serverapi.utils.http.default_api_version = default_api_version
+        profiler = None  # type: Profiler
+        if args.profile is not None:
+            profiler = Profiler(
+                args.profile, name=args.cmd.__module__.rpartition('.')[2],
+                top=args.profile_top, http=args.profile_http,
+            )
+
+        # The CLI layer always wants the API version that it was built for. We
+        # share the module's session so that it can be replaced in tests.
+        args.cmd.client = client or http.Client(
+            base_url=config.get('serverapi', 'base_url'),
+            api_version=default_api_version,
+            session=http.session,
+            timeout=args.timeout,
+            fallback=fallback,
+            rate_limiter=RateLimiter(rate=args.max_rate, burst=max(int(args.max_rate), 1)),
+            profiler=profiler if args.profile_http else None,
+            shared_cache=shared_cache,
+        )
+
+        # Spread scheduled runs across the fleet.
+        if args.jitter:
+            _sleep_jitter(config, args.jitter)
 
         # In quiet mode, we just swallow stdout.
         if args.quiet:
             args.cmd.stdout = io.StringIO()
 
-        args.cmd.handle(config=config, **vars(args))
+        try:
+            if profiler is not None:
+                with profiler:
+                    args.cmd.handle(config=config, **vars(args))
+            else:
+                args.cmd.handle(config=config, **vars(args))
+        finally:
+            if profiler is not None:
+                for path in profiler.paths:
+                    print("Profile written to {}".format(path), file=stderr)
 
         with open(args.config_path, 'w') as f:
             config.write(f)
+
+        # Let any background revalidation refresh the cache before we exit.
+        if fallback is not None:
+            fallback.wait()
+
+        if (shared_cache is not None) and shared_cache.written:
+            shared_cache.prune()
     except ServerApiError as e:
         try:
             result = e.response.json()
@@ -76,17 +164,7 @@ def parse_args(argv, stdout, stderr):
     parser = argparse.ArgumentParser(
         prog='cloak-server',
     )
-    parser.add_argument(
-        '--config', dest='config_path', default=default_config_path(),
-        help="Path to config file. [%(default)s]"
-    )
-    parser.add_argument(
-        '--base_url', dest='base_url',
-        help="Set the URL for the Encrypt.me server."
-    )
-    parser.add_argument(
-        '-q', '--quiet', action='store_true', help="Suppress normal output."
-    )
+    _add_global_arguments(parser)
 
     subparsers = parser.add_subparsers(description="Pass -h to one of the subcommands for more information.")
     for name in COMMANDS:
@@ -110,6 +188,107 @@ def parse_args(argv, stdout, stderr):
     return args
 
 
+def _add_global_arguments(parser):
+    # type: (argparse.ArgumentParser) -> None
+    parser.add_argument(
+        '--config', dest='config_path', default=default_config_path(),
+        help="Path to config file. [%(default)s]"
+    )
+    parser.add_argument(
+        '--base_url', dest='base_url',
+        help="Set the URL for the Encrypt.me server."
+    )
+    parser.add_argument(
+        '-q', '--quiet', action='store_true', help="Suppress normal output."
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=60,
+        help="Seconds to wait for each API request. [%(default)s]"
+    )
+    parser.add_argument(
+        '--cache-dir', dest='cache_dir',
+        help="Keep the last known good API results here and use them if the API is unavailable."
+    )
+    parser.add_argument(
+        '--deadline', type=float,
+        help="With --cache-dir, seconds to wait for the API before using cached results. The cache is refreshed in the background."
+    )
+    parser.add_argument(
+        '--max-rate', dest='max_rate', type=_positive_float, default=10,
+        help="Maximum API requests per second. Requests rejected with Retry-After are retried. [%(default)s]"
+    )
+    parser.add_argument(
+        '--jitter', type=float, metavar='SECONDS',
+        help="Wait up to this many seconds before starting. The delay is fixed for each server, which spreads scheduled jobs across a fleet."
+    )
+    parser.add_argument(
+        '--shared-dir', dest='shared_dir', metavar='DIR',
+        help="Share CRL downloads and API results with other containers through this directory."
+    )
+    parser.add_argument(
+        '--shared-ttl', dest='shared_ttl', type=float, default=60, metavar='SECONDS',
+        help="With --shared-dir, how long a download is reused before it's refreshed. [%(default)s]"
+    )
+    parser.add_argument(
+        '--hook-timeout', dest='hook_timeout', type=float, default=300, metavar='SECONDS',
+        help="Kill post-hooks that run longer than this. [%(default)s]"
+    )
+    parser.add_argument(
+        '--hook-window', dest='hook_window', type=float, default=0, metavar='SECONDS',
+        help="Wait this long for other commands to request the same post-hook before running it, so that it only runs once. [%(default)s]"
+    )
+    parser.add_argument(
+        '--hook-dir', dest='hook_dir', metavar='DIR',
+        help="Keep post-hook locks and statistics here. Commands sharing this directory coalesce their post-hooks. Defaults to a directory under --cache-dir, if given."
+    )
+    parser.add_argument(
+        '--profile', metavar='DIR',
+        help="Profile the command and write a pstats file and an allocation report to this directory."
+    )
+    parser.add_argument(
+        '--profile-top', dest='profile_top', type=int, default=25, metavar='N',
+        help="With --profile, the number of lines to report memory still allocated by. [%(default)s]"
+    )
+    parser.add_argument(
+        '--profile-http', dest='profile_http', action='store_true',
+        help="With --profile, also report the timing of each API request."
+    )
+
+
+def _positive_float(value):
+    # type: (str) -> float
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError("{} is not a positive number".format(value))
+
+    return number
+
+
+def _check_served(args):
+    # type: (argparse.Namespace) -> None
+    """
+    Raises CommandError if the serve command can't run this command as given.
+    """
+    defaults = argparse.ArgumentParser()
+    _add_global_arguments(defaults)
+
+    given = [option for dest, option in CLIENT_OPTIONS if getattr(args, dest) != defaults.get_default(dest)]
+    if given:
+        raise CommandError("{} can't be given to a served command.".format(', '.join(given)))
+
+    args.cmd.check_servable(**vars(args))
+
+
+def _sleep_jitter(config, window):
+    # type: (RawConfigParser, float) -> None
+    try:
+        server_id = config.get('serverapi', 'server_id')
+    except NoOptionError:
+        pass
+    else:
+        time.sleep(jitter(server_id, window))
+
+
 def default_config_path():
     # type: () -> str
     """
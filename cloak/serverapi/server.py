@@ -1,31 +1,55 @@
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+from hashlib import sha1
+import json
+import math
 import socket
+import weakref
 
 from asn1crypto import keys, pem
 from csrbuilder import CSRBuilder
 import six
-from typing import Tuple, Any, Union  # noqa
+from typing import Tuple, Any, Callable, Dict, Iterable, List, Optional, Union  # noqa
 
-from cloak.serverapi.utils import http
+from cloak.serverapi.errors import ServerApiError
+from cloak.serverapi.utils import codec, http
 from cloak.serverapi.utils.apiresult import ApiResult
 
 
 # The default API version for registering new servers.
 default_api_version = '2017-02-28'
 
+# The parts of a bundle, in the order the API expects them.
+BUNDLE_PARTS = ('server', 'pki', 'wireguard_peers')
+
+# How long the API may hold a request for changes, in seconds. This is under
+# the idle timeout of most proxies.
+WATCH_TIMEOUT = 55
+
+# Extra time to wait for the answer to a request for changes.
+_WATCH_GRACE = 10
+
+# Clients that have talked to an API without bundle support.
+_no_bundle_clients = weakref.WeakSet()  # type: weakref.WeakSet
+
+# Clients that have talked to an API that can't report changes.
+_no_changes_clients = weakref.WeakSet()  # type: weakref.WeakSet
+
 
 class Server(ApiResult):
     # Populated on instances.
     server_id = None  # type: str
     auth_token = None  # type: str
+    client = None  # type: http.Client
 
     #
     # Constructors
     #
 
     @classmethod
-    def register(cls, reg_key, name=None, api_version=default_api_version):
-        # type: (str, str, str, str, str) -> Server
+    def register(cls, reg_key, name=None, api_version=default_api_version, client=None):
+        # type: (str, str, str, http.Client) -> Server
         """
         Registers a new server to a team.
 
@@ -33,6 +57,8 @@ class Server(ApiResult):
         name: Name of the server. Defaults to the host fqdn.
         api_version: Optional API version. Defaults to the latest version known to
             this package.
+        client: Optional http.Client to send requests through. The returned
+            server will keep using it.
 
         """
         if name is None:
@@ -43,34 +69,224 @@ class Server(ApiResult):
             'name': name,
         }
 
-        result = http.post('servers/', api_version=api_version, data=data).json()
+        client = _get_client(client)
+        result = http.decode(client.post('servers/', api_version=api_version, data=data))
 
         server_id = result['server_id']
         auth_token = result['auth_token']
         server_result = result['server']
 
-        return cls(server_id, auth_token, server_result)
+        return cls(server_id, auth_token, server_result, client=client)
 
     @classmethod
-    def retrieve(cls, server_id, auth_token):
-        # type: (str, str) -> Server
+    def retrieve(cls, server_id, auth_token, client=None):
+        # type: (str, str, http.Client) -> Server
         """
         Retrieves the state of an existing server.
         """
-        result = http.get('server/', auth=(server_id, auth_token)).json()
+        client = _get_client(client)
+        key = _cache_key(client, server_id, 'server')
 
-        return cls(server_id, auth_token, result)
+        def fetch():
+            result = client.get_json('server/', auth=(server_id, auth_token))
+            _cache_put(client, key, result)
+            return result
+
+        result = _with_fallback(client, fetch, lambda: client.fallback.get(key))
+
+        return cls(server_id, auth_token, result, client=client)
 
     @classmethod
-    def wireguard_peers(cls, server_id, auth_token):
-        # type: (str, str) -> Server
+    def wireguard_peers(cls, server_id, auth_token, client=None):
+        # type: (str, str, http.Client) -> Any
         """
         Returns the WireGuard peers to help with self-configuration.
+
+        These are requested as MessagePack if msgpack is installed, which is
+        smaller and faster to decode.
+
+        """
+        client = _get_client(client)
+        key = _cache_key(client, server_id, 'wireguard_peers')
+
+        def fetch():
+            result = client.get_json(
+                'server/wireguard-peers/', auth=(server_id, auth_token),
+                headers={'Accept': codec.ACCEPT_COMPACT}
+            )
+            _cache_put(client, key, result)
+            return result
+
+        return _with_fallback(client, fetch, lambda: client.fallback.get(key))
+
+    @classmethod
+    def bundle(cls, server_id, auth_token, parts=BUNDLE_PARTS, server_tag=None,
+               pki_tag=None, wireguard_peers_tag=None, client=None):
+        # type: (str, str, Iterable[str], str, str, str, http.Client) -> Bundle
+        """
+        Retrieves the server, its PKI and its WireGuard peers together.
+
+        parts: The parts to include: any of 'server', 'pki' and
+            'wireguard_peers'.
+        server_tag, pki_tag, wireguard_peers_tag: Tags from a previous
+            Bundle. Each part whose tag is unchanged will be
+            Bundle.NOT_MODIFIED.
+
+        This is a single request to server/bundle/. If the API doesn't
+        support bundles, the parts are requested individually in parallel,
+        with the same conditional semantics.
+
+        """
+        client = _get_client(client)
+        parts = [part for part in BUNDLE_PARTS if part in parts]
+        tags = {
+            'server': server_tag,
+            'pki': pki_tag,
+            'wireguard_peers': wireguard_peers_tag,
+        }
+        keys = {part: _cache_key(client, server_id, part) for part in parts}
+
+        def fetch():
+            result = cls._fetch_bundle(server_id, auth_token, parts, tags, client)
+            for part, item in result.items():
+                if item.get('result') is not None:
+                    _cache_put(client, keys[part], item['result'])
+            return result
+
+        def fallback():
+            result = {}
+            for part in parts:
+                cached = client.fallback.get(keys[part])
+                tag = cached.get('tag') if (part == 'pki') else content_tag(cached)
+                if (tag is not None) and (tag == tags[part]):
+                    cached = None
+                result[part] = {'tag': tag, 'result': cached}
+            return result
+
+        result = _with_fallback(client, fetch, fallback)
+
+        return Bundle(server_id, auth_token, result, client)
+
+    @classmethod
+    def wait_for_changes(cls, server_id, auth_token, tags, timeout=WATCH_TIMEOUT, client=None):
+        # type: (str, str, Dict[str, str], float, http.Client) -> Optional[Dict[str, str]]
+        """
+        Waits for the server, its PKI or its WireGuard peers to change.
+
+        tags: The tags that we have for the parts to watch, as in
+            Bundle.tags. A tag of None means that we don't have that part.
+        timeout: The longest that the API should hold the request, in
+            seconds.
+
+        This is a long poll of server/changes/. Returns the new tags of the
+        parts that changed, or an empty dict if none did before the timeout.
+        Returns None if the API can't report changes, in which case callers
+        should fall back to polling bundle().
+
+        """
+        client = _get_client(client)
+        if client in _no_changes_clients:
+            return None
+
+        parts = [part for part in BUNDLE_PARTS if part in tags]
+        params = {'include': ','.join(parts), 'timeout': max(int(math.ceil(timeout)), 1)}
+        params.update(
+            ('{}_tag'.format(part), tags[part]) for part in parts
+            if tags[part] is not None
+        )
+
+        try:
+            response = client.get(
+                'server/changes/', params=params, auth=(server_id, auth_token),
+                timeout=params['timeout'] + _WATCH_GRACE
+            )
+        except ServerApiError as e:
+            if e.response.status_code != 404:
+                raise
+            _no_changes_clients.add(client)
+            return None
+
+        if response.status_code == 304:
+            return {}
+
+        return {
+            part: tag for part, tag in http.decode(response).items()
+            if (part in tags) and (tag != tags[part])
+        }
+
+    @classmethod
+    def upload_peer_stats(cls, server_id, auth_token, batches, client=None):
+        # type: (str, str, List[Dict[str, Any]], http.Client) -> Dict[str, Any]
+        """
+        Uploads batches of WireGuard peer statistics, as from StatsSpool.
+
+        The batches go in one gzipped JSON request, which is small even with
+        thousands of peers. Returns the API's result. Raises ServerApiError
+        if the API refuses them.
+
         """
-        result = http.get('server/wireguard-peers/', auth=(server_id, auth_token)).json()
+        client = _get_client(client)
+        content = gzip.compress(codec.encode({'batches': batches}))
+        headers = {'Content-Type': codec.JSON, 'Content-Encoding': 'gzip'}
+
+        return http.decode(
+            client.post('server/peer-stats/', data=content, headers=headers, auth=(server_id, auth_token))
+        )
+
+    @classmethod
+    def _fetch_bundle(cls, server_id, auth_token, parts, tags, client):
+        # type: (str, str, Iterable[str], Dict[str, str], http.Client) -> Dict[str, Any]
+        result = None  # type: Dict[str, Any]
+        if client not in _no_bundle_clients:
+            params = {'include': ','.join(parts)}
+            params.update(
+                ('{}_tag'.format(part), tags[part]) for part in parts
+                if tags[part] is not None
+            )
+            try:
+                result = client.get_json('server/bundle/', params=params, auth=(server_id, auth_token))
+            except ServerApiError as e:
+                if e.response.status_code != 404:
+                    raise
+                _no_bundle_clients.add(client)
+
+        if result is None:
+            result = cls._unbundled(server_id, auth_token, parts, tags, client)
 
         return result
 
+    @classmethod
+    def _unbundled(cls, server_id, auth_token, parts, tags, client):
+        # type: (str, str, Iterable[str], Dict[str, str], http.Client) -> Dict[str, Any]
+        """
+        Emulates server/bundle/ with individual requests.
+        """
+        def fetch(part):
+            # type: (str) -> Dict[str, Any]
+            auth = (server_id, auth_token)
+            if part == 'pki':
+                pki = _fetch_pki(client, auth, tags['pki'])
+                if pki is PKI.NOT_MODIFIED:
+                    item = {'tag': tags['pki'], 'result': None}
+                else:
+                    item = {'tag': pki.get('tag'), 'result': pki}
+            else:
+                if part == 'server':
+                    result = client.get_json('server/', auth=auth)
+                else:
+                    result = client.get_json(
+                        'server/wireguard-peers/', auth=auth, headers={'Accept': codec.ACCEPT_COMPACT}
+                    )
+                tag = content_tag(result)
+                item = {'tag': tag, 'result': result if (tag != tags[part]) else None}
+
+            return item
+
+        with ThreadPoolExecutor(len(parts) or 1) as executor:
+            items = list(executor.map(fetch, parts))
+
+        return dict(zip(parts, items))
+
     #
     # Operations
     #
@@ -91,7 +307,7 @@ class Server(ApiResult):
         }
 
         if len(updates) > 0:
-            result = http.post('server/', data=updates, auth=self._api_auth).json()
+            result = http.decode(self.client.post('server/', data=updates, auth=self._api_auth))
 
             # We're a dict, so just replace the contents.
             self.clear()
@@ -102,7 +318,8 @@ class Server(ApiResult):
         """
         Requests a new certificate for this server.
 
-        key_pem: the PEM-encoded private key (byte string).
+        key_pem: the PEM-encoded private key (byte string). This may be an
+            RSA or EC key.
 
         Returns True if the request was accepted, raises ServerApiError otherwise.
 
@@ -114,13 +331,16 @@ class Server(ApiResult):
             {'common_name': six.text_type(self.server_id)},
             privkey.public_key_info
         )
+        # csrbuilder doesn't offer SHA-384, so the larger curves get SHA-512.
+        if (privkey.algorithm == 'ec') and (privkey.bit_size > 256):
+            builder.hash_algo = 'sha512'
         csr = builder.build(privkey)
 
         data = {
             'csr': b64encode(csr.dump())
         }
 
-        http.post('server/csr/', data=data, auth=self._api_auth)
+        self.client.post('server/csr/', data=data, auth=self._api_auth)
 
         return True
 
@@ -134,27 +354,34 @@ class Server(ApiResult):
         certificate renewal. If not, this will return PKI.NOT_MODIFIED.
 
         """
-        params = {}
-        if tag is not None:
-            params['tag'] = tag
+        client = self.client
+        key = _cache_key(client, self.server_id, 'pki')
 
-        response = http.get('server/pki/', params=params, auth=self._api_auth)
+        def fetch():
+            pki = _fetch_pki(client, self._api_auth, tag)
+            if pki is not PKI.NOT_MODIFIED:
+                _cache_put(client, key, pki)
+            return pki
 
-        if response.status_code == 304:
-            pki = PKI.NOT_MODIFIED
-        else:
-            pki = PKI(response.json())
+        def fallback():
+            cached = client.fallback.get(key)
+            if (tag is not None) and (cached.get('tag') == tag):
+                pki = PKI.NOT_MODIFIED
+            else:
+                pki = PKI(cached)
+            return pki
 
-        return pki
+        return _with_fallback(client, fetch, fallback)
 
     #
     # Private
     #
 
-    def __init__(self, server_id, auth_token, *args, **kwargs):
-        # type: (str, str, *Any, **Any) -> None
+    def __init__(self, server_id, auth_token, *args, client=None, **kwargs):
+        # type: (str, str, *Any, http.Client, **Any) -> None
         self.server_id = server_id
         self.auth_token = auth_token
+        self.client = _get_client(client)
 
         super().__init__(*args, **kwargs)
 
@@ -166,3 +393,97 @@ class Server(ApiResult):
 
 class PKI(ApiResult):
     NOT_MODIFIED = object()
+
+
+class Bundle:
+    """
+    The result of Server.bundle().
+
+    server: A Server, NOT_MODIFIED or None if it wasn't requested.
+    pki: A PKI, NOT_MODIFIED or None if it wasn't requested.
+    wireguard_peers: The WireGuard peers, NOT_MODIFIED or None if they
+        weren't requested.
+    tags: The current tag of each part that was requested. Pass these back to
+        Server.bundle() to detect changes.
+
+    """
+    NOT_MODIFIED = PKI.NOT_MODIFIED
+
+    def __init__(self, server_id, auth_token, result, client):
+        # type: (str, str, Dict[str, Any], http.Client) -> None
+        self.tags = {}  # type: Dict[str, str]
+        self.server = self._part(result, 'server', lambda r: Server(server_id, auth_token, r, client=client))
+        self.pki = self._part(result, 'pki', PKI)
+        self.wireguard_peers = self._part(result, 'wireguard_peers', lambda r: r)
+
+    def _part(self, result, name, wrap):
+        # type: (Dict[str, Any], str, Any) -> Any
+        try:
+            item = result[name]
+        except KeyError:
+            return None
+
+        self.tags[name] = item.get('tag')
+        if item.get('result') is None:
+            value = self.NOT_MODIFIED
+        else:
+            value = wrap(item['result'])
+
+        return value
+
+
+def content_tag(result):
+    # type: (Any) -> str
+    """ Returns a tag that changes when a decoded API result changes. """
+    encoded = json.dumps(result, sort_keys=True, separators=(',', ':'))
+
+    return sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def _fetch_pki(client, auth, tag):
+    # type: (http.Client, Tuple[str, str], str) -> Any
+    params = {}
+    if tag is not None:
+        params['tag'] = tag
+
+    response = client.get('server/pki/', params=params, auth=auth)
+
+    if response.status_code == 304:
+        pki = PKI.NOT_MODIFIED
+    else:
+        pki = PKI(http.decode(response))
+
+    return pki
+
+
+def _with_fallback(client, fetch, fallback):
+    # type: (http.Client, Callable[[], Any], Callable[[], Any]) -> Any
+    """
+    Returns fetch(), falling back to cached results if the client allows it.
+    """
+    if client.fallback is None:
+        result = fetch()
+    else:
+        result = client.fallback.call(fetch, fallback)
+
+    return result
+
+
+def _cache_key(client, server_id, name):
+    # type: (http.Client, str, str) -> str
+    return ' '.join([client.base_url, server_id, name])
+
+
+def _cache_put(client, key, result):
+    # type: (http.Client, str, Any) -> None
+    if client.fallback is not None:
+        client.fallback.put(key, result)
+
+
+def _get_client(client):
+    # type: (http.Client) -> http.Client
+    """ Returns client, or the module-level default if it's None. """
+    if client is None:
+        client = http.default_client
+
+    return client
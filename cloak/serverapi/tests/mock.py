@@ -2,18 +2,22 @@
 A mocking layer for the API.
 """
 
-from base64 import b64decode
+from base64 import b64decode, b64encode
+from datetime import datetime, timedelta, timezone
+import gzip
 import io
-import json
+import ipaddress
 import random
 import string
 
+from asn1crypto import crl, x509
 import requests
 from six.moves import xrange
-from six.moves.urllib.parse import parse_qs, urljoin, urlparse
-from typing import Any, Dict  # noqa
+from six.moves.urllib.parse import parse_qs, urlparse
+from typing import Any, Dict, List, Tuple  # noqa
 
-from cloak.serverapi.utils import http
+from cloak.serverapi.server import content_tag
+from cloak.serverapi.utils import codec
 from cloak.serverapi.utils.encoding import force_text
 
 
@@ -26,7 +30,8 @@ class MockSession:
     Maintains the API state over a series of serverapi requests.
 
     An instance of this class can stand in for
-    cloak.serverapi.utils.http.session.
+    cloak.serverapi.utils.http.session or be passed as the session of an
+    http.Client.
 
     """
     def __init__(self, def_target_id):
@@ -43,17 +48,39 @@ class MockSession:
 
         self.csr = None                     # type: str
         self.pki_tag = None                 # type: str
+        self.crl_urls = ['http://crl.example.com/server.crl']
+
+        self.wireguard_peers = []           # type: List[Dict[str, Any]]
+
+        # Batches of peer statistics that have been uploaded.
+        self.peer_stats = []                # type: List[Dict[str, Any]]
+
+        # Set this to False to emulate an API without server/bundle/.
+        self.bundle_supported = True
+
+        # Set this to False to emulate an API without server/changes/.
+        self.changes_supported = True
+
+        # (status, headers) pairs to answer the next requests with.
+        self.injected = []                  # type: List[Tuple[int, Dict[str, str]]]
 
     def get(self, url, **kwargs):
         # type: (str, **Any) -> requests.Response
-        request = requests.Request('GET', url, **kwargs)
-        prepped = self.session.prepare_request(request)
+        prepped = self._prepare('GET', url, kwargs)
 
         path = self._url_path(url)
-        if path == 'server/':
+        if self.injected:
+            response = self._injected_response(prepped)
+        elif path == 'server/':
             response = self._get_server(prepped)
         elif path == 'server/pki/':
             response = self._get_server_pki(prepped)
+        elif path == 'server/wireguard-peers/':
+            response = self._get_server_wireguard_peers(prepped)
+        elif path == 'server/bundle/':
+            response = self._get_server_bundle(prepped)
+        elif path == 'server/changes/':
+            response = self._get_server_changes(prepped)
         else:
             raise NotImplementedError(('GET', path))
 
@@ -61,21 +88,70 @@ class MockSession:
 
     def post(self, url, **kwargs):
         # type: (str, **Any) -> requests.Response
-        request = requests.Request('POST', url, **kwargs)
-        prepped = self.session.prepare_request(request)
+        prepped = self._prepare('POST', url, kwargs)
 
         path = self._url_path(url)
-        if path == 'servers/':
+        if self.injected:
+            response = self._injected_response(prepped)
+        elif path == 'servers/':
             response = self._post_servers(prepped)
         elif path == 'server/':
             response = self._post_server(prepped)
         elif path == 'server/csr/':
             response = self._post_server_csr(prepped)
+        elif path == 'server/peer-stats/':
+            response = self._post_server_peer_stats(prepped)
         else:
             raise NotImplementedError(('POST', path))
 
         return response
 
+    #
+    # State
+    #
+
+    def provision(self, name='server.example.com'):
+        # type: (str) -> Tuple[str, str]
+        """
+        Registers a server with an issued certificate, bypassing the API.
+
+        Returns (server_id, auth_token).
+
+        """
+        self.server_id = self._public_id('srv')
+        self.auth_token = ''.join(random.choice(mixed_alphabet) for i in xrange(20))
+        self.name = name
+        self.target_id = self.def_target_id
+        self.csr = '<csr>'
+        self.pki_tag = ''.join(random.choice(mixed_alphabet) for i in xrange(16))
+
+        return (self.server_id, self.auth_token)
+
+    def rotate_pki(self):
+        # type: () -> None
+        """ Issues a new certificate, as if the old one was renewed. """
+        self.pki_tag = ''.join(random.choice(mixed_alphabet) for i in xrange(16))
+
+    def generate_wireguard_peers(self, count, seed=0):
+        # type: (int, int) -> None
+        """
+        Replaces the WireGuard peers with count synthetic peers.
+
+        Each peer gets a single tunnel address, allocated sequentially from
+        100.64.0.0/10.
+
+        """
+        rand = random.Random(seed)
+        base = ipaddress.IPv4Address('100.64.0.2')
+
+        self.wireguard_peers = [
+            {
+                'public_key': b64encode(bytes(rand.getrandbits(8) for _ in xrange(32))).decode('ascii'),
+                'allowed_ips': ['{}/32'.format(base + i)],
+            }
+            for i in xrange(count)
+        ]
+
     #
     # Implementation
     #
@@ -92,34 +168,81 @@ class MockSession:
 
     def _get_server_pki(self, request):
         # type: (requests.PreparedRequest) -> requests.Response
-        query = parse_qs(force_text(urlparse(request.url).query))
+        tag = self._query_param(request, 'tag')
 
-        try:
-            tag = query['tag'][0]
-        except LookupError:
-            tag = None
+        if self._authenticate(request):
+            status, result = self._pki_result(tag)
+            response = self._response(request, status, result)
+        else:
+            response = self._response(request, 401)
 
+        return response
+
+    def _get_server_wireguard_peers(self, request):
+        # type: (requests.PreparedRequest) -> requests.Response
         if self._authenticate(request):
-            result = None  # type: Dict[str, Any]
-
-            if self.csr is None:
-                result = {
-                    'anchor': None, 'server_ca': None, 'client_ca': None,
-                    'entity': None, 'crls': [], 'tag': None,
-                }
-                response = self._response(request, 200, result)
-            elif (tag is not None) and (tag == self.pki_tag):
-                response = self._response(request, 304)
+            response = self._response(request, 200, self.wireguard_peers, content_type=self._content_type(request))
+        else:
+            response = self._response(request, 401)
+
+        return response
+
+    def _get_server_bundle(self, request):
+        # type: (requests.PreparedRequest) -> requests.Response
+        if not self.bundle_supported:
+            response = self._response(request, 404)
+        elif self._authenticate(request):
+            include = self._query_param(request, 'include') or 'server,pki,wireguard_peers'
+            result = {}  # type: Dict[str, Any]
+
+            for part in include.split(','):
+                tag = self._query_param(request, '{}_tag'.format(part))
+                if part == 'pki':
+                    status, pki = self._pki_result(tag)
+                    if status == 304:
+                        result[part] = {'tag': tag, 'result': None}
+                    else:
+                        result[part] = {'tag': pki['tag'], 'result': pki}
+                else:
+                    if part == 'server':
+                        value = self._server_result()
+                    else:
+                        value = self.wireguard_peers
+                    value_tag = content_tag(value)
+                    if value_tag == tag:
+                        value = None
+                    result[part] = {'tag': value_tag, 'result': value}
+
+            response = self._response(request, 200, result)
+        else:
+            response = self._response(request, 401)
+
+        return response
+
+    def _get_server_changes(self, request):
+        # type: (requests.PreparedRequest) -> requests.Response
+        """
+        Answers at once: with the parts that changed, or with 304 as if the
+        long poll timed out.
+        """
+        if not self.changes_supported:
+            response = self._response(request, 404)
+        elif self._authenticate(request):
+            include = self._query_param(request, 'include') or 'server,pki,wireguard_peers'
+            tags = {
+                'server': content_tag(self._server_result()),
+                'pki': self.pki_tag if (self.csr is not None) else None,
+                'wireguard_peers': content_tag(self.wireguard_peers),
+            }
+            changed = {
+                part: tags[part] for part in include.split(',')
+                if self._query_param(request, '{}_tag'.format(part)) != tags[part]
+            }
+
+            if changed:
+                response = self._response(request, 200, changed)
             else:
-                result = {
-                    'anchor': self._cert_result('anchor'),
-                    'server_ca': self._cert_result('server_ca'),
-                    'client_ca': self._cert_result('client_ca'),
-                    'entity': self._cert_result('entity'),
-                    'crls': ['http://crl.example.com/server.crl'],
-                    'tag': self.pki_tag,
-                }
-                response = self._response(request, 200, result)
+                response = self._response(request, 304)
         else:
             response = self._response(request, 401)
 
@@ -173,21 +296,88 @@ class MockSession:
 
         return response
 
+    def _post_server_peer_stats(self, request):
+        # type: (requests.PreparedRequest) -> requests.Response
+        if self._authenticate(request):
+            content = request.body
+            if request.headers.get('Content-Encoding') == 'gzip':
+                content = gzip.decompress(content)
+            batches = codec.loads(content)['batches']
+            self.peer_stats.extend(batches)
+            response = self._response(request, 202, {'accepted': len(batches)})
+        else:
+            response = self._response(request, 401)
+
+        return response
+
     #
     # Utils
     #
 
+    def _injected_response(self, request):
+        # type: (requests.PreparedRequest) -> requests.Response
+        status, headers = self.injected.pop(0)
+
+        return self._response(request, status, headers=headers)
+
+    def _pki_result(self, tag):
+        # type: (str) -> Tuple[int, Dict[str, Any]]
+        """ Returns (status, result) for a PKI request. """
+        result = None  # type: Dict[str, Any]
+
+        if self.csr is None:
+            status = 200
+            result = {
+                'anchor': None, 'server_ca': None, 'client_ca': None,
+                'entity': None, 'crls': [], 'tag': None,
+            }
+        elif (tag is not None) and (tag == self.pki_tag):
+            status = 304
+        else:
+            status = 200
+            result = {
+                'anchor': self._cert_result('anchor'),
+                'server_ca': self._cert_result('server_ca'),
+                'client_ca': self._cert_result('client_ca'),
+                'entity': self._cert_result('entity'),
+                'crls': list(self.crl_urls),
+                'tag': self.pki_tag,
+            }
+
+        return (status, result)
+
+    def _query_param(self, request, name):
+        # type: (requests.PreparedRequest, str) -> str
+        query = parse_qs(force_text(urlparse(request.url).query))
+
+        try:
+            value = query[name][0]
+        except LookupError:
+            value = None
+
+        return value
+
+    # Arguments to Session.request() that only affect sending.
+    SEND_KWARGS = ['timeout', 'allow_redirects', 'proxies', 'stream', 'verify', 'cert']
+
+    def _prepare(self, method, url, kwargs):
+        # type: (str, str, Dict[str, Any]) -> requests.PreparedRequest
+        kwargs = {k: v for k, v in kwargs.items() if k not in self.SEND_KWARGS}
+        request = requests.Request(method, url, **kwargs)
+
+        return self.session.prepare_request(request)
+
     def _public_id(self, prefix):
         # type: (str) -> str
         return '{}_{}'.format(prefix, ''.join(random.choice(lower_alphabet) for i in xrange(16)))
 
     def _url_path(self, url):
         # type: (str) -> str
-        base_url = urljoin(http.base_url, '/api/server/')
-        if url.startswith(base_url):
-            path = url[len(base_url):]
-        else:
-            path = url
+        """ Returns the API path of url, regardless of the base URL. """
+        path = urlparse(url).path
+        prefix, sep, rest = path.partition('/api/server/')
+        if sep:
+            path = rest
 
         return path
 
@@ -226,15 +416,27 @@ class MockSession:
         # type: (str, str, str) -> Dict[str, str]
         return {'name': name, 'serial': serial, 'pem': pem}
 
-    def _response(self, request, status, result=None, headers={}):
-        # type: (requests.PreparedRequest, int, Any, Dict[str, str]) -> requests.Response
+    def _content_type(self, request):
+        # type: (requests.PreparedRequest) -> str
+        """ Negotiates JSON or MessagePack (if we have msgpack). """
+        if (codec.msgpack is not None) and codec.accepts_msgpack(request.headers.get('Accept')):
+            content_type = codec.MSGPACK
+        else:
+            content_type = codec.JSON
+
+        return content_type
+
+    def _response(self, request, status, result=None, headers={}, content_type=codec.JSON):
+        # type: (requests.PreparedRequest, int, Any, Dict[str, str], str) -> requests.Response
         response = requests.Response()
         response.status_code = status
         response.url = request.url
 
         if result is not None:
-            response.raw = io.BytesIO(json.dumps(result).encode('utf-8'))
+            response.raw = io.BytesIO(codec.encode(result, content_type))
             response.encoding = 'utf-8'
+            if content_type != codec.JSON:
+                response.headers['Content-Type'] = content_type
         else:
             response.raw = io.BytesIO(b'')
             response.encoding = 'latin1'
@@ -242,3 +444,51 @@ class MockSession:
         response.headers.update(headers)
 
         return response
+
+
+def make_crl(issuer, revoked=0, this_update=None):
+    # type: (str, int, datetime) -> bytes
+    """
+    Returns a DER-encoded CRL with a bogus signature.
+
+    issuer: The common name of the issuer.
+    revoked: The number of revoked certificates to list. Each one adds 32
+        bytes, so this is a cheap way to build large CRLs.
+
+    """
+    if this_update is None:
+        this_update = datetime.now(timezone.utc).replace(microsecond=0)
+
+    revocation_date = x509.Time({'utc_time': this_update}).dump()
+    entries = b''.join(
+        _der(0x30, _der(0x02, (1 << 96 | i).to_bytes(13, 'big')) + revocation_date)
+        for i in xrange(revoked)
+    )
+
+    tbs = {
+        'version': 'v2',
+        'signature': {'algorithm': 'sha256_rsa'},
+        'issuer': x509.Name.build({'common_name': issuer}),
+        'this_update': x509.Time({'utc_time': this_update}),
+        'next_update': x509.Time({'utc_time': this_update + timedelta(days=7)}),
+    }  # type: Dict[str, Any]
+    if revoked > 0:
+        tbs['revoked_certificates'] = crl.RevokedCertificates.load(_der(0x30, entries))
+
+    return crl.CertificateList({
+        'tbs_cert_list': tbs,
+        'signature_algorithm': {'algorithm': 'sha256_rsa'},
+        'signature': b'\0' * 256,
+    }).dump()
+
+
+def _der(tag, content):
+    # type: (int, bytes) -> bytes
+    length = len(content)
+    if length < 0x80:
+        header = bytes([tag, length])
+    else:
+        encoded = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+        header = bytes([tag, 0x80 | len(encoded)]) + encoded
+
+    return header + content
@@ -0,0 +1,357 @@
+"""
+A local HTTP(S) stand-in for the server API.
+
+This serves the MockSession state model over real sockets so that the client
+can be load tested and benchmarked with connection pooling, TLS and
+concurrency, without any outside service. It can also serve CRLs under
+/crls/, with ETags. Requests for server/changes/ are held open until
+something changes, like the real API's long poll.
+
+Run it directly to get a provisioned server to point cloak-server at:
+
+    python -m cloak.serverapi.tests.standin --port 8000 --peers 10000
+
+"""
+import argparse
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import random
+import socket
+import socketserver
+import ssl
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from typing import Any, Dict, List, Tuple  # noqa
+
+from cloak.serverapi.tests.mock import MockSession, make_crl
+
+
+# How often a held request for changes checks the state, in seconds.
+CHANGES_CHECK_INTERVAL = 0.05
+
+
+class StandInServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    Serves a MockSession over HTTP.
+
+    host, port: The address to listen on. Port 0 picks a free port.
+    latency: Seconds to wait before answering each request.
+    error_rate: The fraction of requests (0 to 1) to fail with a 503.
+    peers: The number of synthetic WireGuard peers to serve.
+    crls: The number of synthetic CRLs to serve. The PKI will list them.
+    crl_revoked: The number of revoked certificates in each CRL.
+    crl_drop_after: Drop each CRL connection after sending this many bytes,
+        to simulate a bad link. Range requests are supported, so a client
+        can resume.
+    certfile, keyfile: Serve HTTPS with this certificate and key.
+
+    The server runs in a background thread between start() and stop(), or
+    use it as a context manager. Each connection is handled in its own thread,
+    including the TLS handshake, and requests that only read the state are
+    answered concurrently.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0,
+                 peers=0, crls=0, crl_revoked=0, crl_drop_after=0, certfile=None,
+                 keyfile=None, def_target_id='tgt_standin'):
+        # type: (str, int, float, float, int, int, int, int, str, str, str) -> None
+        super().__init__((host, port), _Handler)
+
+        self.context = None  # type: ssl.SSLContext
+        if certfile is not None:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.context.load_cert_chain(certfile, keyfile)
+
+        self.scheme = 'https' if (self.context is not None) else 'http'
+        self.latency = latency
+        self.error_rate = error_rate
+        self.crl_drop_after = crl_drop_after
+
+        self.session = MockSession(def_target_id=def_target_id)
+        if peers > 0:
+            self.session.generate_wireguard_peers(peers)
+
+        # Statistics.
+        self.requests = 0
+        self.bytes_sent = 0
+
+        self._lock = threading.Lock()
+        self._thread = None  # type: threading.Thread
+
+        # CRL name -> (content, etag)
+        self.crls = {}  # type: Dict[str, Tuple[bytes, str]]
+        if crls > 0:
+            self.session.crl_urls = [
+                self.set_crl('crl{}.crl'.format(i), make_crl('CA {}'.format(i), crl_revoked))
+                for i in range(crls)
+            ]
+
+    @property
+    def base_url(self):
+        # type: () -> str
+        host, port = self.server_address[:2]
+
+        return '{}://{}:{}/'.format(self.scheme, host, port)
+
+    def start(self):
+        # type: () -> StandInServer
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        # type: () -> None
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        # type: () -> StandInServer
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        # type: (*Any) -> None
+        self.stop()
+
+    def finish_request(self, request, client_address):
+        # type: (socket.socket, Tuple[str, int]) -> None
+        # This runs in the connection's thread, so a slow handshake doesn't
+        # hold up the others.
+        if self.context is None:
+            super().finish_request(request, client_address)
+        else:
+            request = self.context.wrap_socket(request, server_side=True)
+            try:
+                super().finish_request(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def set_crl(self, name, content):
+        # type: (str, bytes) -> str
+        """
+        Serves content as a CRL and returns its URL.
+        """
+        with self._lock:
+            self.crls[name] = (content, '"{}"'.format(sha1(content).hexdigest()))
+
+        return '{}crls/{}'.format(self.base_url, name)
+
+    def dispatch(self, method, url, headers, body):
+        # type: (str, str, Dict[str, str], bytes) -> requests.Response
+        """
+        Answers a request from the mock state.
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.requests += 1
+            failed = random.random() < self.error_rate
+
+        if failed:
+            return _error_response(url, 503, {'Retry-After': '1'})
+
+        deadline = time.monotonic() + _long_poll_timeout(method, url)
+        while True:
+            # GETs only read the state, so they can run together. POSTs
+            # change it, so they have it to themselves.
+            if method == 'GET':
+                response = self.session.get(url, headers=headers)
+            elif method == 'POST':
+                with self._lock:
+                    response = self.session.post(url, headers=headers, data=body)
+            else:
+                raise NotImplementedError(method)
+
+            # The mock answers 304 when nothing has changed yet.
+            if (response.status_code != 304) or (time.monotonic() >= deadline):
+                break
+            time.sleep(CHANGES_CHECK_INTERVAL)
+
+        return response
+
+    def dispatch_crl(self, name, headers):
+        # type: (str, Dict[str, str]) -> Tuple[int, Dict[str, str], bytes]
+        """
+        Answers a CRL request with (status, headers, content).
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.requests += 1
+            try:
+                content, etag = self.crls[name]
+            except KeyError:
+                return (404, {}, b'')
+
+        start = _range_start(headers.get('Range'))
+
+        if headers.get('If-None-Match') == etag:
+            result = (304, {'ETag': etag}, b'')
+        elif (start is not None) and (headers.get('If-Range') == etag):
+            if start < len(content):
+                result = (206, {
+                    'ETag': etag,
+                    'Content-Type': 'application/pkix-crl',
+                    'Content-Range': 'bytes {}-{}/{}'.format(start, len(content) - 1, len(content)),
+                }, content[start:])
+            else:
+                result = (416, {'Content-Range': 'bytes */{}'.format(len(content))}, b'')
+        else:
+            result = (200, {'ETag': etag, 'Content-Type': 'application/pkix-crl'}, content)
+
+        return result
+
+    def record_sent(self, count):
+        # type: (int) -> None
+        with self._lock:
+            self.bytes_sent += count
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections alive, like the real API. Headers and body are written
+    # separately, so Nagle's algorithm would stall every response.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    server = None  # type: StandInServer
+
+    def do_GET(self):
+        # type: () -> None
+        self._handle('GET')
+
+    def do_POST(self):
+        # type: () -> None
+        self._handle('POST')
+
+    def _handle(self, method):
+        # type: (str) -> None
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if (length > 0) else None
+        url = self.server.base_url.rstrip('/') + self.path
+
+        if self.path.startswith('/crls/'):
+            status, headers, content = self.server.dispatch_crl(self.path[6:], dict(self.headers))
+            self._send(status, headers, content, self.server.crl_drop_after)
+            return
+
+        try:
+            response = self.server.dispatch(method, url, dict(self.headers), body)
+        except NotImplementedError:
+            self._send(404, {}, b'')
+        else:
+            self._send(response.status_code, response.headers, response.content)
+
+    def _send(self, status, headers, content, drop_after=0):
+        # type: (int, Dict[str, str], bytes, int) -> None
+        """
+        Sends a response. With drop_after, the connection is closed after
+        that many bytes of content.
+        """
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if content and ('Content-Type' not in headers):
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+        if 0 < drop_after < len(content):
+            content = content[:drop_after]
+            self.close_connection = True
+        self.wfile.write(content)
+
+        self.server.record_sent(len(content))
+
+    def log_message(self, format, *args):
+        # type: (str, *Any) -> None
+        pass
+
+
+def _error_response(url, status, headers):
+    # type: (str, int, Dict[str, str]) -> requests.Response
+    """ A response with no content, for a simulated failure. """
+    response = requests.Response()
+    response.status_code = status
+    response.url = url
+    response.headers.update(headers)
+    response.raw = io.BytesIO(b'')
+
+    return response
+
+
+def _long_poll_timeout(method, url):
+    # type: (str, str) -> float
+    """ How long to hold a request, which is 0 unless it's for changes. """
+    parsed = urlparse(url)
+    if (method != 'GET') or not parsed.path.endswith('/server/changes/'):
+        return 0
+
+    try:
+        return float(parse_qs(parsed.query)['timeout'][0])
+    except (LookupError, ValueError):
+        return 0
+
+
+def _range_start(value):
+    # type: (str) -> int
+    """ The start of a Range header of the form bytes=start-, if any. """
+    if (value is None) or not (value.startswith('bytes=') and value.endswith('-')):
+        return None
+
+    try:
+        return int(value[6:-1])
+    except ValueError:
+        return None
+
+
+def main(argv=None):
+    # type: (List[str]) -> None
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the server API.")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on. [%(default)s]")
+    parser.add_argument('--port', type=int, default=8000, help="Port to listen on. [%(default)s]")
+    parser.add_argument('--latency', type=float, default=0, help="Seconds to delay each response. [%(default)s]")
+    parser.add_argument('--error-rate', type=float, default=0, help="Fraction of requests to fail with 503. [%(default)s]")
+    parser.add_argument('--peers', type=int, default=0, help="Number of WireGuard peers to serve. [%(default)s]")
+    parser.add_argument('--crls', type=int, default=0, help="Number of CRLs to serve. [%(default)s]")
+    parser.add_argument('--crl-revoked', type=int, default=1000, help="Revoked certificates in each CRL. [%(default)s]")
+    parser.add_argument('--crl-drop-after', type=int, default=0, help="Drop CRL connections after this many bytes. [%(default)s]")
+    parser.add_argument('--certfile', help="Serve HTTPS with this certificate.")
+    parser.add_argument('--keyfile', help="The private key for --certfile.")
+    args = parser.parse_args(argv)
+
+    server = StandInServer(
+        args.host, args.port, latency=args.latency, error_rate=args.error_rate,
+        peers=args.peers, crls=args.crls, crl_revoked=args.crl_revoked,
+        crl_drop_after=args.crl_drop_after, certfile=args.certfile, keyfile=args.keyfile,
+    )
+    server_id, auth_token = server.session.provision()
+
+    print("Serving the server API at {}".format(server.base_url))
+    print("")
+    print("[serverapi]")
+    print("base_url = {}".format(server.base_url))
+    print("server_id = {}".format(server_id))
+    print("auth_token = {}".format(auth_token))
+    sys.stdout.flush()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
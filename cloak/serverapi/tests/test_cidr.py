@@ -0,0 +1,66 @@
+import unittest
+
+from cloak.serverapi.utils.cidr import aggregate_peers, aggregate_routes, parse_network
+
+
+class ParseNetworkTestCase(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(parse_network('10.1.2.3/16'), (4, 16, b'\x0a\x01\x00\x00'))
+        self.assertEqual(parse_network('fd00::1'), (6, 128, b'\xfd' + b'\x00' * 14 + b'\x01'))
+
+    def test_invalid(self):
+        for value in ['bogus', '10.0.0.0/33', '10.0.0.0/x', '::/129']:
+            with self.assertRaises(ValueError):
+                parse_network(value)
+
+
+class AggregateRoutesTestCase(unittest.TestCase):
+    def test_adjacent(self):
+        peers = [{'public_key': str(i), 'allowed_ips': ['10.0.0.{}/32'.format(i)]} for i in range(2, 12)]
+
+        self.assertEqual(aggregate_routes(peers), ['10.0.0.2/31', '10.0.0.4/30', '10.0.0.8/30'])
+
+    def test_overlapping(self):
+        peers = [
+            {'public_key': 'a', 'allowed_ips': ['10.0.0.0/24', 'fd00::/64']},
+            {'public_key': 'b', 'allowed_ips': ['10.0.0.7/32', '10.0.1.0/24', 'fd00::1/128']},
+        ]
+
+        self.assertEqual(aggregate_routes(peers), ['10.0.0.0/23', 'fd00::/64'])
+
+
+class AggregatePeersTestCase(unittest.TestCase):
+    def test_collapse(self):
+        peers = [
+            {'public_key': 'a', 'allowed_ips': ['10.0.0.128/25', '10.0.0.0/25', '10.0.0.9/32']},
+            {'public_key': 'b', 'allowed_ips': ['10.0.1.0/24']},
+        ]
+
+        self.assertEqual(aggregate_peers(peers), [
+            {'public_key': 'a', 'allowed_ips': ['10.0.0.0/24']},
+            {'public_key': 'b', 'allowed_ips': ['10.0.1.0/24']},
+        ])
+
+    def test_other_peer_inside(self):
+        # b's /26 beats a's /25 today, so a can still become a /24.
+        peers = [
+            {'public_key': 'a', 'allowed_ips': ['10.0.0.0/25', '10.0.0.128/25']},
+            {'public_key': 'b', 'allowed_ips': ['10.0.0.64/26']},
+        ]
+
+        self.assertEqual(aggregate_peers(peers)[0]['allowed_ips'], ['10.0.0.0/24'])
+
+    def test_conflict(self):
+        # a's /32 beats b's /28, which would no longer be true if it were
+        # dropped in favor of a's /24.
+        peers = [
+            {'public_key': 'a', 'allowed_ips': ['10.0.0.0/24', '10.0.0.5/32']},
+            {'public_key': 'b', 'allowed_ips': ['10.0.0.0/28']},
+        ]
+
+        self.assertEqual(aggregate_peers(peers), peers)
+
+    def test_unchanged(self):
+        peers = [{'public_key': 'a', 'allowed_ips': ['10.0.0.3/32', '10.0.0.1/32']}]
+
+        self.assertIs(aggregate_peers(peers)[0], peers[0])
@@ -1,12 +1,30 @@
+from base64 import b64decode
 from functools import partial
+import glob
+import io
 import json
+import os
 import os.path
 import shutil
+import socket
+import stat
+import subprocess
+import sys
 import tempfile
+import threading
+import time
+from unittest import mock
 
+from asn1crypto.csr import CertificationRequest
+import requests
 from six.moves.configparser import NoOptionError
 
+from cloak.serverapi.cli.commands import render, serve, sync
+from cloak.serverapi.cli.commands._base import CommandError
+from cloak.serverapi.server import default_api_version
 from cloak.serverapi.tests.base import TestCase
+from cloak.serverapi.utils import http
+from cloak.serverapi.utils.peerindex import PeerIndex
 
 
 class RegisterTestCase(TestCase):
@@ -95,6 +113,188 @@ class InfoTestCase(TestCase):
         self.assertEqual(returncode, 0)
         json.loads(self.stdout.getvalue())
 
+    def test_cache_fallback(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, cache_dir))
+
+        self.main([
+            'register',
+            '-k', 'secret_onetime_reg_key',
+        ])
+        self.main(['--cache-dir', cache_dir, 'info'])
+        self.stdout.seek(0)
+        self.stdout.truncate()
+
+        with mock.patch.object(self.session, 'get', side_effect=requests.ConnectionError()):
+            returncode = self.main(['--cache-dir', cache_dir, 'info'])
+
+        self.assertEqual(returncode, 0)
+        self.assertIn(self.session.server_id, self.stdout.getvalue())
+
+    def test_bad_max_rate(self):
+        for value in ['0', '-1']:
+            with self.assertRaises(SystemExit), mock.patch('sys.stderr', io.StringIO()) as stderr:
+                self.main(['--max-rate', value, 'info'])
+
+            self.assertIn('not a positive number', stderr.getvalue())
+
+    def test_profile(self):
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, profile_dir))
+
+        self.main([
+            'register',
+            '-k', 'secret_onetime_reg_key',
+        ])
+        returncode = self.main(['--profile', profile_dir, '--profile-http', 'info'])
+
+        self.assertEqual(returncode, 0)
+        names = sorted(os.listdir(profile_dir))
+        self.assertEqual(len(names), 3)
+        self.assertTrue(names[0].startswith('info-'))
+        self.assertTrue(names[0].endswith('-alloc.txt'))
+        self.assertTrue(names[1].endswith('-http.txt'))
+        self.assertTrue(names[2].endswith('.pstats'))
+        self.assertIn(profile_dir, self.stderr.getvalue())
+
+        with open(os.path.join(profile_dir, names[1]), 'r') as f:
+            self.assertIn('GET  200 ', f.read())
+
+
+class RenderTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, self.path))
+
+        self.openvpn_template = self._template('openvpn.tmpl', "proto $proto\nport $port\ncipher ${cipher}\n")
+        self.ikev2_template = self._template('ikev2.tmpl', "conn $fqdn\n  leftid=@$server_id\n  rightca=\"$client_ca_dn\"\n  # $$target_id\n")
+        self.hook_path = os.path.join(self.path, 'reloaded.txt')
+
+        self.main(['register', '-k', 'secret_onetime_reg_key'])
+        self._clear_stdout()
+
+    def test_render(self):
+        returncode = self._render()
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.stdout.getvalue().split(), ['openvpn', 'ikev2'])
+        with open(os.path.join(self.path, 'openvpn-tcp-443.conf'), 'r') as f:
+            self.assertEqual(f.read(), "proto tcp\nport 443\ncipher AES-CBC-256\n")
+        with open(os.path.join(self.path, 'ipsec.conf'), 'r') as f:
+            self.assertEqual(f.read(), 'conn team.example.com\n  leftid=@team.example.com\n  rightca="O=Cloak, OU=Teams, CN=Example Clients"\n  # $target_id\n')
+        self.assertTrue(os.path.exists(self.hook_path))
+
+    def test_unchanged(self):
+        self._render()
+        os.remove(self.hook_path)
+        self._clear_stdout()
+        returncode = self._render()
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.stdout.getvalue(), '')
+        self.assertFalse(os.path.exists(self.hook_path))
+
+    def test_one_changed(self):
+        self._render()
+        os.remove(self.hook_path)
+        self._clear_stdout()
+        self._template('ikev2.tmpl', "conn $fqdn\n")
+        returncode = self._render()
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.stdout.getvalue().split(), ['ikev2'])
+        self.assertFalse(os.path.exists(self.hook_path))
+
+    def test_endpoint_removed(self):
+        self._render()
+        os.remove(self.hook_path)
+        self._clear_stdout()
+        with self._openvpn_endpoints(lambda endpoints: endpoints[1:]):
+            returncode = self._render()
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.stdout.getvalue().split(), ['openvpn'])
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'openvpn-udp-443.conf')))
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'openvpn-tcp-443.conf')))
+        self.assertTrue(os.path.exists(self.hook_path))
+
+    def test_out_changed(self):
+        self._render()
+        self._clear_stdout()
+        returncode = self.main([
+            'render',
+            '--openvpn', self.openvpn_template, os.path.join(self.path, 'server-{proto}.conf'),
+            '--ikev2', self.ikev2_template, os.path.join(self.path, 'ipsec.conf'),
+        ])
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.stdout.getvalue().split(), ['openvpn'])
+        self.assertEqual(sorted(name for name in os.listdir(self.path) if name.endswith('.conf')), [
+            'ipsec.conf', 'server-tcp.conf', 'server-udp.conf',
+        ])
+
+    def test_endpoint_index(self):
+        self._template('openvpn.tmpl', "index $index\n")
+        with self._openvpn_endpoints(lambda endpoints: [dict(endpoint, index=i + 10) for i, endpoint in enumerate(endpoints)]):
+            returncode = self._render()
+
+        self.assertEqual(returncode, 0)
+        with open(os.path.join(self.path, 'openvpn-udp-443.conf'), 'r') as f:
+            self.assertEqual(f.read(), "index 10\n")
+
+    def test_missing_value(self):
+        self._template('ikev2.tmpl', "conn $bogus\n")
+        returncode = self._render()
+
+        self.assertNotEqual(returncode, 0)
+        self.assertIn('bogus', self.stderr.getvalue())
+        self.assertEqual(sorted(os.listdir(self.path)), ['ikev2.tmpl', 'openvpn.tmpl'])
+
+    def test_bad_template(self):
+        self._template('ikev2.tmpl', "conn $fqdn\n  $ bogus\n")
+        returncode = self._render()
+
+        self.assertNotEqual(returncode, 0)
+        self.assertIn('line 2', self.stderr.getvalue())
+
+    def test_template_cache(self):
+        template = render._load_template(self.openvpn_template)
+
+        self.assertIs(render._load_template(self.openvpn_template), template)
+        self._template('openvpn.tmpl', "proto $proto\n")
+        self.assertIsNot(render._load_template(self.openvpn_template), template)
+
+    def _openvpn_endpoints(self, change):
+        server_result = self.session._server_result
+
+        def changed_result():
+            result = server_result()
+            result['target']['openvpn'] = change(result['target']['openvpn'])
+            return result
+
+        return mock.patch.object(self.session, '_server_result', changed_result)
+
+    def _template(self, name, content):
+        path = os.path.join(self.path, name)
+        with open(path, 'w') as f:
+            f.write(content)
+
+        return path
+
+    def _clear_stdout(self):
+        self.stdout.seek(0)
+        self.stdout.truncate()
+
+    def _render(self):
+        return self.main([
+            'render',
+            '--openvpn', self.openvpn_template, os.path.join(self.path, 'openvpn-{proto}-{port}.conf'),
+            '--ikev2', self.ikev2_template, os.path.join(self.path, 'ipsec.conf'),
+            '--reload-hook', 'openvpn', 'touch {}'.format(self.hook_path),
+        ])
+
 
 class UpdateTestCase(TestCase):
     def test_update_noop(self):
@@ -157,6 +357,53 @@ class CSRTestCase(TestCase):
         self.assertEqual(returncode, 0)
         self.assertIsNotNone(self.session.csr)
 
+    def test_ec_keys(self):
+        key_dir = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, key_dir))
+        self.main(['register', '-k', 'secret_onetime_reg_key'])
+
+        for key_type, algorithm in [('ec-p256', 'sha256_ecdsa'), ('ec-p384', 'sha512_ecdsa')]:
+            key_path = os.path.join(key_dir, '{}.pem'.format(key_type))
+            returncode = self.main(['req', '-k', key_path, '-t', key_type])
+
+            self.assertEqual(returncode, 0)
+            csr = CertificationRequest.load(b64decode(self.session.csr))
+            self.assertEqual(csr['signature_algorithm']['algorithm'].native, algorithm)
+
+    def test_key_pool(self):
+        key_dir = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, key_dir))
+        pool_path = os.path.join(key_dir, 'pool')
+        key_path = os.path.join(key_dir, 'privkey.pem')
+
+        self.main(['keys', '--key-pool', pool_path, '-t', 'ec-p256', '--pool-size', '1'])
+        pooled_path = glob.glob(os.path.join(pool_path, 'ec-p256', '*.pem'))[0]
+        self.assertEqual(stat.S_IMODE(os.stat(pooled_path).st_mode), 0o600)
+        with open(pooled_path, 'rb') as f:
+            pooled = f.read()
+
+        self.main(['register', '-k', 'secret_onetime_reg_key'])
+        returncode = self.main([
+            'req', '-k', key_path, '-t', 'ec-p256', '--key-pool', pool_path,
+        ])
+
+        self.assertEqual(returncode, 0)
+        with open(key_path, 'rb') as f:
+            self.assertEqual(f.read(), pooled)
+        self.assertEqual(glob.glob(os.path.join(pool_path, 'ec-p256', '*.pem')), [])
+
+    def test_empty_key_pool(self):
+        key_dir = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, key_dir))
+        key_path = os.path.join(key_dir, 'privkey.pem')
+
+        self.main(['register', '-k', 'secret_onetime_reg_key'])
+        returncode = self.main(['req', '-k', key_path, '-t', 'ec-p256', '--key-pool', os.path.join(key_dir, 'pool')])
+
+        self.assertEqual(returncode, 0)
+        self.assertIsNotNone(self.session.csr)
+        self.assertFalse(os.path.exists(os.path.join(key_dir, 'pool')))
+
     def test_bogus_key(self):
         with tempfile.NamedTemporaryFile('wb', 0) as key_file:
             key_file.write(b'bogus')
@@ -235,6 +482,27 @@ class PKITestCase(TestCase):
         self.assertPKISaved()
         self.assertIsNotNone(self.get_config().get('serverapi', 'pki_tag'))
 
+    def test_get_pki_unbundled(self):
+        self.session.bundle_supported = False
+
+        with tempfile.NamedTemporaryFile('wb', 0) as key_file:
+            key_file.write(self.privkey_rsa_2048)
+
+            self.main([
+                'register',
+                '-k', 'secret_onetime_reg_key',
+            ])
+            self.main([
+                'req', '-k', key_file.name,
+            ])
+            returncode = self.main([
+                'pki', '-o', self.out_path
+            ])
+
+        self.assertEqual(returncode, 0)
+        self.assertPKISaved()
+        self.assertIsNotNone(self.get_config().get('serverapi', 'pki_tag'))
+
     def test_post_hook(self):
         with tempfile.NamedTemporaryFile('wb', 0) as key_file:
             key_file.write(self.privkey_rsa_2048)
@@ -279,6 +547,35 @@ class PKITestCase(TestCase):
         with self.assertRaises(NoOptionError):
             self.get_config().get('serverapi', 'pki_tag')
 
+    def test_post_hook_timeout(self):
+        with tempfile.NamedTemporaryFile('wb', 0) as key_file:
+            key_file.write(self.privkey_rsa_2048)
+
+            self.main([
+                'register',
+                '-k', 'secret_onetime_reg_key',
+            ])
+            self.main([
+                'req', '-k', key_file.name,
+            ])
+            returncode = self.main([
+                '--hook-timeout', '0.1',
+                'pki',
+                '--out', self.out_path,
+                '--post-hook', 'sleep 10',
+            ])
+
+        self.assertNotEqual(returncode, 0)
+        self.assertIn('timed out', self.stderr.getvalue())
+        with self.assertRaises(NoOptionError):
+            self.get_config().get('serverapi', 'pki_tag')
+
+    def test_hook_window_requires_dir(self):
+        returncode = self.main(['--hook-window', '5', 'pki', '--out', self.out_path])
+
+        self.assertNotEqual(returncode, 0)
+        self.assertIn('--hook-dir', self.stderr.getvalue())
+
     def test_not_modified(self):
         with tempfile.NamedTemporaryFile('wb', 0) as key_file:
             key_file.write(self.privkey_rsa_2048)
@@ -353,6 +650,510 @@ class PKITestCase(TestCase):
     ]
 
 
+class SyncTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.out_path = tempfile.mkdtemp()
+        self.peers_path = os.path.join(self.out_path, 'peers.json')
+        self.hook_path = os.path.join(self.out_path, 'hooks.txt')
+        self.addCleanup(partial(shutil.rmtree, self.out_path))
+
+        with tempfile.NamedTemporaryFile('wb', 0) as key_file:
+            key_file.write(PKITestCase.privkey_rsa_2048)
+
+            self.main([
+                'register',
+                '-k', 'secret_onetime_reg_key',
+            ])
+            self.main([
+                'req', '-k', key_file.name,
+            ])
+
+        self.session.generate_wireguard_peers(10)
+
+    def test_sync(self):
+        returncode = self.sync()
+
+        self.assertEqual(returncode, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.out_path, 'server.pem')))
+        with open(self.peers_path, 'r') as f:
+            self.assertEqual(json.load(f), self.session.wireguard_peers)
+        self.assertEqual(self.hooks(), ['pki', 'peers', 'reload'])
+        self.assertIsNotNone(self.get_config().get('serverapi', 'pki_tag'))
+        self.assertIsNotNone(self.get_config().get('serverapi', 'wireguard_peers_tag'))
+
+    def test_sync_noop(self):
+        self.sync()
+        os.remove(self.hook_path)
+        returncode = self.sync()
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.hooks(), [])
+        self.assertIn('No changes', self.stdout.getvalue())
+
+    def test_sync_peers_changed(self):
+        self.sync()
+        os.remove(self.hook_path)
+        self.session.generate_wireguard_peers(11)
+        returncode = self.sync()
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.hooks(), ['peers', 'reload'])
+
+    def test_sync_lost_files(self):
+        self.sync()
+        os.remove(self.hook_path)
+        os.remove(self.peers_path)
+        returncode = self.sync()
+
+        self.assertEqual(returncode, 0)
+        self.assertTrue(os.path.exists(self.peers_path))
+        self.assertEqual(self.hooks(), ['peers', 'reload'])
+
+    def test_sync_peers_index(self):
+        index_path = os.path.join(self.out_path, 'peers.idx')
+        self.sync('--peers-index', index_path)
+        os.remove(index_path)
+        returncode = self.sync('--peers-index', index_path)
+
+        self.assertEqual(returncode, 0)
+        with PeerIndex(index_path) as index:
+            self.assertEqual(len(index), 10)
+
+    def test_watch(self):
+        with self.watching(lambda: self.session.rotate_pki()):
+            returncode = self.sync('--watch')
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(len(self.syncs), 2)
+        self.assertEqual(self.hooks(), ['pki', 'peers', 'reload', 'pki', 'reload'])
+        self.assertEqual(self.get_config().get('serverapi', 'pki_tag'), self.session.pki_tag)
+
+    def test_watch_polling(self):
+        self.session.changes_supported = False
+        with self.watching():
+            returncode = self.sync('--watch', '--interval', '0.2')
+
+        self.assertEqual(returncode, 0)
+        self.assertGreaterEqual(self.syncs[1] - self.syncs[0], 0.2)
+        self.assertEqual(self.hooks(), ['pki', 'peers', 'reload'])
+
+    def test_watch_hook_fail(self):
+        flag_path = os.path.join(self.out_path, 'fail')
+
+        def after_first():
+            open(flag_path, 'w').close()
+            self.session.rotate_pki()
+
+        with self.watching(after_first, count=3):
+            returncode = self.sync('--watch', '--interval', '0.2', '--reload-hook', 'test ! -e {}'.format(flag_path))
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(len(self.syncs), 3)
+        self.assertIn('Error syncing', self.stderr.getvalue())
+
+    def test_watch_crl_session(self):
+        real_session = sync.Command._crl_session
+        sessions = []
+
+        def _crl_session(command, jobs):
+            session = real_session(command, jobs)
+            sessions.append(session)
+            return session
+
+        with self.watching(count=3), mock.patch.object(sync.Command, '_crl_session', _crl_session):
+            returncode = self.sync('--watch', '--interval', '0.1')
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(len(sessions), 1)
+
+    def test_shared_hook(self):
+        hook = self.hook('reload')
+        returncode = self.main([
+            'sync',
+            '--pki-out', self.out_path,
+            '--peers-out', self.peers_path,
+            '--pki-hook', hook,
+            '--peers-hook', hook,
+            '--reload-hook', hook,
+        ])
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.hooks(), ['reload'])
+
+    def test_hook_fail(self):
+        returncode = self.main([
+            'sync',
+            '--pki-out', self.out_path,
+            '--reload-hook', 'false',
+        ])
+
+        self.assertNotEqual(returncode, 0)
+        with self.assertRaises(NoOptionError):
+            self.get_config().get('serverapi', 'pki_tag')
+
+    def sync(self, *options):
+        return self.main([
+            'sync',
+            '--pki-out', self.out_path,
+            '--peers-out', self.peers_path,
+            '--pki-hook', self.hook('pki'),
+            '--peers-hook', self.hook('peers'),
+            '--reload-hook', self.hook('reload'),
+        ] + list(options))
+
+    def watching(self, after_first=None, count=2):
+        """
+        Lets sync --watch sync count times, whether or not they succeed.
+        after_first is called after the first sync.
+        """
+        self.syncs = []
+        real_sync = sync.Command._sync
+
+        def _sync(command, *args):
+            try:
+                real_sync(command, *args)
+            finally:
+                self.syncs.append(time.monotonic())
+                if len(self.syncs) >= count:
+                    raise KeyboardInterrupt()
+            if after_first is not None:
+                after_first()
+
+        return mock.patch.object(sync.Command, '_sync', _sync)
+
+    def hook(self, name):
+        return 'sh -c "echo {} >> {}"'.format(name, self.hook_path)
+
+    def hooks(self):
+        try:
+            with open(self.hook_path, 'r') as f:
+                names = f.read().split()
+        except IOError:
+            names = []
+
+        return names
+
+
+class WireGuardTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.main([
+            'register',
+            '-k', 'secret_onetime_reg_key',
+        ])
+        self.session.generate_wireguard_peers(10)
+
+        self.out_path = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, self.out_path))
+        self.index_path = os.path.join(self.out_path, 'peers.idx')
+
+    def test_peers(self):
+        self._clear_stdout()
+        returncode = self.main(['wireguard'])
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.stdout.getvalue(), json.dumps(self.session.wireguard_peers))
+
+    def test_routes(self):
+        self._clear_stdout()
+        returncode = self.main(['wireguard', '--routes'])
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.stdout.getvalue().split(), ['100.64.0.2/31', '100.64.0.4/30', '100.64.0.8/30'])
+        self.assertIn('7 saved', self.stderr.getvalue())
+
+    def test_aggregate(self):
+        self.session.wireguard_peers[0]['allowed_ips'] = ['10.0.0.0/25', '10.0.0.128/25']
+        self._clear_stdout()
+        returncode = self.main(['wireguard', '--aggregate'])
+
+        self.assertEqual(returncode, 0)
+        peers = json.loads(self.stdout.getvalue())
+        self.assertEqual(peers[0]['allowed_ips'], ['10.0.0.0/24'])
+        self.assertEqual(peers[1:], self.session.wireguard_peers[1:])
+        self.assertIn('1 saved', self.stderr.getvalue())
+
+    def test_lookup_ip(self):
+        self.main(['wireguard', '--index', self.index_path])
+        self._clear_stdout()
+        returncode = self.main(['wireguard', '--index', self.index_path, 'lookup', '100.64.0.5'])
+
+        self.assertEqual(returncode, 0)
+        peer = json.loads(self.stdout.getvalue())
+        self.assertEqual(peer['public_key'], self.session.wireguard_peers[3]['public_key'])
+        self.assertEqual(peer['match'], '100.64.0.5/32')
+
+    def test_lookup_key(self):
+        self.main(['wireguard', '--index', self.index_path])
+        self._clear_stdout()
+        public_key = self.session.wireguard_peers[7]['public_key']
+        returncode = self.main(['wireguard', '--index', self.index_path, 'lookup', public_key])
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(json.loads(self.stdout.getvalue()), self.session.wireguard_peers[7])
+
+    def test_lookup_no_match(self):
+        self.main(['wireguard', '--index', self.index_path])
+        returncode = self.main(['wireguard', '--index', self.index_path, 'lookup', '10.0.0.1'])
+
+        self.assertNotEqual(returncode, 0)
+        self.assertIn('No peer', self.stderr.getvalue())
+
+    def test_lookup_bad_query(self):
+        self.main(['wireguard', '--index', self.index_path])
+        returncode = self.main(['wireguard', '--index', self.index_path, 'lookup', 'bogus'])
+
+        self.assertNotEqual(returncode, 0)
+        self.assertIn('public key', self.stderr.getvalue())
+
+    def test_lookup_no_index(self):
+        returncode = self.main(['wireguard', '--index', self.index_path, 'lookup', '100.64.0.5'])
+
+        self.assertNotEqual(returncode, 0)
+
+    def _clear_stdout(self):
+        self.stdout.seek(0)
+        self.stdout.truncate()
+
+
+class StatsTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.main([
+            'register',
+            '-k', 'secret_onetime_reg_key',
+        ])
+        self.session.generate_wireguard_peers(1000)
+
+        self.out_path = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, self.out_path))
+        self.dump_path = os.path.join(self.out_path, 'dump.txt')
+        self.spool_path = os.path.join(self.out_path, 'spool')
+
+    def test_baseline(self):
+        returncode = self.stats(0)
+
+        self.assertEqual(returncode, 0)
+        self.assertIn('Collected 0 of 1000 peers', self.stdout.getvalue())
+        self.assertEqual(self.session.peer_stats, [])
+
+    def test_upload(self):
+        self.stats(0)
+        returncode = self.stats(1, '--flush')
+
+        self.assertEqual(returncode, 0)
+        self.assertIn('Uploaded 1 batches', self.stdout.getvalue())
+        self.assertEqual(len(self.session.peer_stats), 1)
+        peers = self.session.peer_stats[0]['peers']
+        self.assertEqual(len(peers), 1000)
+        self.assertEqual(peers[self.session.wireguard_peers[0]['public_key']], [1700000001, 1000, 2000])
+
+    def test_upload_interval(self):
+        self.stats(0)
+        self.stats(1)
+        self.stats(2)
+
+        self.assertEqual(self.session.peer_stats, [])
+
+        self.stats(3, '--upload-interval', '0')
+
+        self.assertEqual(len(self.session.peer_stats), 3)
+
+    def test_backoff(self):
+        self.stats(0)
+        self.session.injected = [(429, {'Retry-After': '3600'})]
+        returncode = self.stats(1, '--flush')
+
+        self.assertEqual(returncode, 0)
+        self.assertIn('retrying in 3600s', self.stderr.getvalue())
+        self.assertEqual(self.session.peer_stats, [])
+
+        # The batch is kept, but we wait for the API.
+        self.stats(2, '--upload-interval', '0')
+
+        self.assertEqual(self.session.peer_stats, [])
+
+        self.stats(3, '--flush')
+
+        self.assertEqual(len(self.session.peer_stats), 3)
+
+    def test_refused(self):
+        self.stats(0)
+        self.session.injected = [(400, {})]
+        self.stats(1, '--flush')
+        self.stats(2, '--flush')
+
+        self.assertIn('refused 1 batches', self.stderr.getvalue())
+        self.assertEqual(len(self.session.peer_stats), 1)
+
+    def test_no_spool(self):
+        self._write_dump(0)
+        returncode = self.main(['stats', '--dump', self.dump_path])
+
+        self.assertNotEqual(returncode, 0)
+
+    def stats(self, n, *options):
+        self._write_dump(n)
+
+        return self.main(['stats', '--dump', self.dump_path, '--spool', self.spool_path] + list(options))
+
+    def _write_dump(self, n):
+        """ Writes 'wg show all dump' output after n rounds of traffic. """
+        lines = ['wg0\tprivate\tpublic\t51820\toff']
+        for peer in self.session.wireguard_peers:
+            lines.append('wg0\t{}\t(none)\t(none)\t{}\t{}\t{}\t{}\t0'.format(
+                peer['public_key'], ','.join(peer['allowed_ips']), 1700000000 + n, n * 1000, n * 2000
+            ))
+
+        with open(self.dump_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+class ServeTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.main([
+            'register',
+            '-k', 'secret_onetime_reg_key',
+        ])
+
+        socket_dir = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, socket_dir))
+        self.socket_path = os.path.join(socket_dir, 'cloak-server.sock')
+
+        client = http.Client(
+            api_version=default_api_version, session=self.session,
+            single_flight=True, single_flight_ttl=60,
+        )
+        self.server = serve.CommandServer(self.socket_path, os.environ['CLOAK_CONFIG'], client)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+
+    def test_info(self):
+        returncode, stdout, stderr = serve.call(self.socket_path, ['info', '--json'])
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(json.loads(stdout)['server_id'], self.session.server_id)
+
+    def test_warm(self):
+        with mock.patch.object(self.session, 'get', wraps=self.session.get) as get:
+            serve.call(self.socket_path, ['info'])
+            returncode, stdout, stderr = serve.call(self.socket_path, ['info'])
+
+        self.assertEqual(returncode, 0)
+        self.assertIn(self.session.server_id, stdout)
+        self.assertEqual(get.call_count, 1)
+
+    def test_update(self):
+        serve.call(self.socket_path, ['info'])
+        serve.call(self.socket_path, ['update', '-n', 'srv2.example.com'])
+        returncode, stdout, stderr = serve.call(self.socket_path, ['info'])
+
+        self.assertEqual(returncode, 0)
+        self.assertIn('srv2.example.com', stdout)
+
+    def test_not_servable(self):
+        returncode, stdout, stderr = serve.call(self.socket_path, ['serve'])
+
+        self.assertNotEqual(returncode, 0)
+        self.assertIn("can't be served", stderr)
+
+    def test_client_options(self):
+        returncode, stdout, stderr = serve.call(self.socket_path, ['--timeout', '5', '--cache-dir', '/tmp', 'info'])
+
+        self.assertNotEqual(returncode, 0)
+        self.assertIn("--timeout, --cache-dir can't be given", stderr)
+
+    def test_other_options(self):
+        returncode, stdout, stderr = serve.call(self.socket_path, ['--quiet', 'info'])
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(stdout, '')
+
+    def test_watch(self):
+        returncode, stdout, stderr = serve.call(self.socket_path, ['sync', '--watch'])
+
+        self.assertNotEqual(returncode, 0)
+        self.assertIn("can't be served", stderr)
+
+    def test_usage_error(self):
+        returncode, stdout, stderr = serve.call(self.socket_path, ['bogus'])
+
+        self.assertEqual(returncode, 2)
+        self.assertIn('usage:', stderr)
+
+    def test_bad_request(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            sock.sendall(b'bogus\n')
+            with sock.makefile('rb') as f:
+                response = json.loads(f.readline().decode('utf-8'))
+
+        self.assertEqual(response['returncode'], 2)
+
+    def test_already_serving(self):
+        with self.assertRaises(CommandError):
+            serve.CommandServer(self.socket_path, os.environ['CLOAK_CONFIG'], None)
+
+    def test_stale_socket(self):
+        stale_path = self.socket_path + '.stale'
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(stale_path)
+        sock.close()
+
+        server = serve.CommandServer(stale_path, os.environ['CLOAK_CONFIG'], None)
+        server.server_close()
+
+        self.assertFalse(os.path.exists(stale_path))
+
+    def test_client_script(self):
+        script = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'bin', 'cloak-server-client')
+        if not os.path.exists(script):
+            self.skipTest("bin/cloak-server-client is not available.")
+
+        env = dict(os.environ, CLOAK_SERVER_SOCKET=self.socket_path)
+        output = subprocess.check_output([sys.executable, script, 'info', '--json'], env=env)
+
+        self.assertEqual(json.loads(output.decode('utf-8'))['server_id'], self.session.server_id)
+
+    def test_client_script_no_response(self):
+        script = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'bin', 'cloak-server-client')
+        if not os.path.exists(script):
+            self.skipTest("bin/cloak-server-client is not available.")
+
+        # A server that dies without answering.
+        dead_path = self.socket_path + '.dead'
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(dead_path)
+        listener.listen(1)
+        self.addCleanup(listener.close)
+
+        def hang_up():
+            conn, _ = listener.accept()
+            conn.recv(1024)
+            conn.sendall(b'{"returncode"')
+            conn.close()
+
+        thread = threading.Thread(target=hang_up)
+        thread.start()
+        self.addCleanup(thread.join)
+
+        env = dict(os.environ, CLOAK_SERVER_SOCKET=dead_path)
+        process = subprocess.Popen([sys.executable, script, 'info'], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+
+        self.assertEqual(process.returncode, 1)
+        self.assertIn(b'No response', stderr)
+
+
 class CRLsTestCase(TestCase):
     """
     Breaking the rules and testing with live CRLs.
@@ -0,0 +1,97 @@
+import json
+import unittest
+from unittest import mock
+
+from cloak.serverapi.server import Server
+from cloak.serverapi.tests.mock import MockSession
+from cloak.serverapi.utils import codec, http
+
+
+class CodecTestCase(unittest.TestCase):
+    value = {'name': 'café', 'peers': [{'allowed_ips': ['100.64.0.2/32'], 'port': 51820}], 'ok': True, 'none': None}
+
+    def test_round_trip(self):
+        self.assertEqual(codec.loads(codec.dumps(self.value)), self.value)
+        self.assertEqual(codec.loads(codec.dumps(self.value).encode('utf-8')), self.value)
+
+    def test_compact(self):
+        self.assertEqual(codec.dumps_compact({'a': [1, 'b/c']}), '{"a":[1,"b/c"]}')
+        self.assertEqual(codec.dumps_compact('café'), '"café"')
+        self.assertEqual(codec.loads(codec.dumps_compact(self.value)), self.value)
+
+    def test_user_format(self):
+        self.assertEqual(codec.dumps(self.value), json.dumps(self.value))
+        self.assertEqual(codec.dumps('café'), '"caf\\u00e9"')
+
+    def test_stdlib(self):
+        with mock.patch.object(codec, 'orjson', None), mock.patch.object(codec, 'ujson', None):
+            encoded = codec.dumps_compact(self.value)
+            decoded = codec.loads(encoded.encode('utf-8'))
+
+        self.assertEqual(encoded, codec.dumps_compact(self.value))
+        self.assertEqual(decoded, self.value)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            codec.loads(b'{')
+
+    def test_decode_json(self):
+        self.assertEqual(codec.decode(b'[1]', 'application/json; charset=utf-8'), [1])
+        self.assertEqual(codec.decode(b'[1]'), [1])
+
+    def test_decode_without_msgpack(self):
+        with mock.patch.object(codec, 'msgpack', None):
+            with self.assertRaises(ValueError):
+                codec.decode(b'\x91\x01', codec.MSGPACK)
+
+    @unittest.skipIf(codec.msgpack is None, "msgpack isn't installed")
+    def test_msgpack(self):
+        encoded = codec.encode(self.value, codec.MSGPACK)
+
+        self.assertEqual(codec.decode(encoded, 'application/x-msgpack'), self.value)
+
+    def test_accepts_msgpack(self):
+        self.assertTrue(codec.accepts_msgpack('application/msgpack, application/json;q=0.5'))
+        self.assertTrue(codec.accepts_msgpack('application/json, application/x-msgpack'))
+        self.assertFalse(codec.accepts_msgpack('application/msgpack;q=0'))
+        self.assertFalse(codec.accepts_msgpack('application/json'))
+        self.assertFalse(codec.accepts_msgpack(None))
+
+
+class NegotiationTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.session = MockSession(def_target_id='tgt_one')
+        self.session.generate_wireguard_peers(10)
+        self.server_id, self.auth_token = self.session.provision()
+        self.client = http.Client(session=self.session)
+
+    def test_json(self):
+        response = self._get('application/json')
+
+        self.assertNotIn('Content-Type', response.headers)
+        self.assertEqual(http.decode(response), self.session.wireguard_peers)
+
+    @unittest.skipIf(codec.msgpack is None, "msgpack isn't installed")
+    def test_msgpack(self):
+        response = self._get(codec.ACCEPT_COMPACT)
+
+        self.assertEqual(response.headers['Content-Type'], codec.MSGPACK)
+        self.assertEqual(http.decode(response), self.session.wireguard_peers)
+
+    def test_without_msgpack(self):
+        with mock.patch.object(codec, 'msgpack', None):
+            response = self._get('{}, application/json;q=0.5'.format(codec.MSGPACK))
+
+        self.assertEqual(http.decode(response), self.session.wireguard_peers)
+
+    def test_peers(self):
+        peers = Server.wireguard_peers(self.server_id, self.auth_token, client=self.client)
+
+        self.assertEqual(peers, self.session.wireguard_peers)
+
+    def _get(self, accept):
+        return self.client.get(
+            'server/wireguard-peers/', auth=(self.server_id, self.auth_token), headers={'Accept': accept}
+        )
@@ -0,0 +1,209 @@
+from functools import partial
+import os
+import os.path
+import shutil
+import stat
+import tempfile
+import unittest
+
+from asn1crypto import pem, x509
+
+from cloak.serverapi.tests.mock import make_crl
+from cloak.serverapi.utils.crlbundle import CRLBundle, HashedDir, name_hash
+
+
+class NameHashTestCase(unittest.TestCase):
+    # Compared with `openssl crl -hash`.
+    def test_hash(self):
+        self.assertEqual(name_hash(x509.Name.build({'common_name': 'CA 0'})), 'a4fc3018')
+
+    def test_canonical(self):
+        self.assertEqual(name_hash(x509.Name.build({'common_name': '  ca   0 '})), 'a4fc3018')
+
+    def test_attributes(self):
+        name = x509.Name.build({
+            'country_name': 'US',
+            'organization_name': 'Example  Inc',
+            'common_name': 'Root CA',
+            'email_address': 'Admin@Example.com',
+        })
+        self.assertEqual(name_hash(name), 'e786d13e')
+
+
+class CRLBundleTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, self.path))
+
+        self.bundle_path = os.path.join(self.path, 'crls.pem')
+        self.crls = {name: make_crl(name) for name in ['one', 'two', 'three']}
+        self.loaded = []
+
+    def load(self, name):
+        self.loaded.append(name)
+        return self.crls.get(name)
+
+    def update(self, names, changed={}):
+        return CRLBundle(self.bundle_path).update(names, changed, self.load)
+
+    def read(self):
+        with open(self.bundle_path, 'rb') as f:
+            content = f.read()
+
+        return [pem.unarmor(block)[2] for block in _split(content)]
+
+    def test_build(self):
+        updated = self.update(['one', 'two', 'missing', 'three'])
+
+        self.assertTrue(updated)
+        self.assertEqual(self.read(), [self.crls['one'], self.crls['two'], self.crls['three']])
+
+    def test_unchanged(self):
+        self.update(['one', 'two'])
+        self.loaded = []
+        updated = self.update(['one', 'two'])
+
+        self.assertFalse(updated)
+        self.assertEqual(self.loaded, [])
+
+    def test_mode(self):
+        self.addCleanup(os.umask, os.umask(0o022))
+
+        self.update(['one'])
+        self.assertEqual(stat.S_IMODE(os.stat(self.bundle_path).st_mode), 0o644)
+
+        # An existing file keeps its permissions.
+        os.chmod(self.bundle_path, 0o640)
+        self.update(['one', 'two'])
+        self.assertEqual(stat.S_IMODE(os.stat(self.bundle_path).st_mode), 0o640)
+
+    def test_incremental(self):
+        self.update(['one', 'two', 'three'])
+        self.loaded = []
+        renewed = make_crl('two renewed')
+        updated = self.update(['one', 'two', 'three'], {'two': renewed})
+
+        self.assertTrue(updated)
+        self.assertEqual(self.loaded, [])
+        self.assertEqual(self.read(), [self.crls['one'], renewed, self.crls['three']])
+
+    def test_same_content(self):
+        self.update(['one', 'two'])
+        updated = self.update(['one', 'two'], {'two': self.crls['two']})
+
+        self.assertFalse(updated)
+
+    def test_removed(self):
+        self.update(['one', 'two', 'three'])
+        updated = self.update(['one', 'three'])
+
+        self.assertTrue(updated)
+        self.assertEqual(self.read(), [self.crls['one'], self.crls['three']])
+
+    def test_corrupt(self):
+        self.update(['one', 'two'])
+        with open(self.bundle_path, 'r+b') as f:
+            f.write(b'bogus')
+        self.loaded = []
+        updated = self.update(['one', 'two'])
+
+        self.assertTrue(updated)
+        self.assertEqual(self.loaded, ['one', 'two'])
+        self.assertEqual(self.read(), [self.crls['one'], self.crls['two']])
+
+
+class HashedDirTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, self.path))
+
+        self.hash_path = os.path.join(self.path, 'hashed')
+        self.crl_paths = []
+        for name in ['CA 0', 'CA 1']:
+            crl_path = os.path.join(self.path, '{}.crl'.format(name))
+            with open(crl_path, 'wb') as f:
+                f.write(make_crl(name))
+            self.crl_paths.append(crl_path)
+
+    def links(self):
+        return {
+            name: os.readlink(os.path.join(self.hash_path, name))
+            for name in os.listdir(self.hash_path)
+        }
+
+    def test_link(self):
+        updated = HashedDir(self.hash_path).update(self.crl_paths, {})
+
+        self.assertTrue(updated)
+        self.assertEqual(self.links()['a4fc3018.r0'], self.crl_paths[0])
+        self.assertEqual(len(self.links()), 2)
+
+    def test_unchanged(self):
+        HashedDir(self.hash_path).update(self.crl_paths, {})
+        updated = HashedDir(self.hash_path).update(self.crl_paths, {})
+
+        self.assertFalse(updated)
+
+    def test_same_issuer(self):
+        other_path = os.path.join(self.path, 'other.crl')
+        HashedDir(self.hash_path).update(self.crl_paths + [other_path], {other_path: make_crl('CA 0')})
+
+        self.assertEqual(self.links()['a4fc3018.r1'], other_path)
+
+    def test_changed_issuer(self):
+        HashedDir(self.hash_path).update(self.crl_paths, {})
+        updated = HashedDir(self.hash_path).update(self.crl_paths, {self.crl_paths[0]: make_crl('CA 2')})
+
+        self.assertTrue(updated)
+        self.assertNotIn('a4fc3018.r0', self.links())
+        self.assertEqual(len(self.links()), 2)
+
+    def test_removed(self):
+        HashedDir(self.hash_path).update(self.crl_paths, {})
+        os.unlink(self.crl_paths[0])
+        HashedDir(self.hash_path).update(self.crl_paths[1:], {})
+
+        self.assertEqual(list(self.links().values()), self.crl_paths[1:])
+
+    def test_changed_in_place(self):
+        HashedDir(self.hash_path).update(self.crl_paths, {})
+        before = os.lstat(os.path.join(self.hash_path, 'a4fc3018.r0'))
+        updated = HashedDir(self.hash_path).update(self.crl_paths, {self.crl_paths[0]: make_crl('CA 0', revoked=1)})
+
+        # The link already points at the right file, so it's left alone.
+        self.assertTrue(updated)
+        self.assertEqual(os.lstat(os.path.join(self.hash_path, 'a4fc3018.r0')).st_ino, before.st_ino)
+
+    def test_dropped(self):
+        HashedDir(self.hash_path).update(self.crl_paths, {})
+        updated = HashedDir(self.hash_path).update(self.crl_paths[1:], {})
+
+        self.assertTrue(updated)
+        self.assertEqual(list(self.links().values()), self.crl_paths[1:])
+
+    def test_contiguous(self):
+        other_path = os.path.join(self.path, 'other.crl')
+        with open(other_path, 'wb') as f:
+            f.write(make_crl('CA 0'))
+        HashedDir(self.hash_path).update(self.crl_paths + [other_path], {})
+        HashedDir(self.hash_path).update([other_path], {})
+
+        self.assertEqual(self.links(), {'a4fc3018.r0': other_path})
+
+    def test_other_files(self):
+        os.mkdir(self.hash_path)
+        with open(os.path.join(self.hash_path, 'README'), 'w') as f:
+            f.write('hello')
+        HashedDir(self.hash_path).update(self.crl_paths, {})
+
+        self.assertTrue(os.path.exists(os.path.join(self.hash_path, 'README')))
+
+
+def _split(content):
+    blocks = content.split(b'-----END X509 CRL-----')
+
+    return [block + b'-----END X509 CRL-----' for block in blocks if block.strip()]
@@ -0,0 +1,102 @@
+from functools import partial
+import glob
+import json
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from cloak.serverapi.utils.hooks import HookRunner
+
+
+class HookRunnerTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, self.state_dir))
+
+        self.log_path = os.path.join(self.state_dir, 'log.txt')
+
+    def test_exec(self):
+        runner = HookRunner()
+        result = runner.run('touch {}'.format(self.log_path))
+
+        self.assertEqual(result.returncode, 0)
+        self.assertFalse(result.timed_out)
+        self.assertTrue(os.path.exists(self.log_path))
+        self.assertEqual(runner.results, [result])
+
+    def test_shell(self):
+        result = HookRunner().run('echo hello > {}'.format(self.log_path))
+
+        self.assertEqual(result.returncode, 0)
+        with open(self.log_path, 'r') as f:
+            self.assertEqual(f.read(), 'hello\n')
+
+    def test_fail(self):
+        result = HookRunner().run('false')
+
+        self.assertEqual(result.returncode, 1)
+
+    def test_builtin(self):
+        result = HookRunner().run('exit 3')
+
+        self.assertEqual(result.returncode, 3)
+
+    def test_missing(self):
+        result = HookRunner().run('no-such-program')
+
+        self.assertEqual(result.returncode, 127)
+
+    def test_timeout(self):
+        start = time.perf_counter()
+        result = HookRunner(timeout=0.2).run('sleep 10')
+
+        self.assertTrue(result.timed_out)
+        self.assertIsNone(result.returncode)
+        self.assertLess(time.perf_counter() - start, 5)
+
+    def test_stats(self):
+        runner = HookRunner(state_dir=self.state_dir)
+        runner.run('true')
+        runner.run('true')
+
+        paths = glob.glob(os.path.join(self.state_dir, 'hook-*.json'))
+        self.assertEqual(len(paths), 1)
+        with open(paths[0], 'r') as f:
+            stats = json.load(f)
+        self.assertEqual(stats['command'], 'true')
+        self.assertEqual(stats['runs'], 2)
+        self.assertEqual(stats['last_returncode'], 0)
+        self.assertGreaterEqual(stats['last_duration'], 0)
+
+    def test_coalesce(self):
+        command = 'sh -c "echo run >> {}"'.format(self.log_path)
+        results = []
+
+        def run():
+            results.append(HookRunner(window=0.5, state_dir=self.state_dir).run(command))
+
+        first = threading.Thread(target=run)
+        first.start()
+        time.sleep(0.1)
+        run()
+        first.join()
+
+        # The second request arrived during the first one's window.
+        self.assertIsNone(results[0])
+        self.assertEqual(results[1].returncode, 0)
+        with open(self.log_path, 'r') as f:
+            self.assertEqual(f.read(), 'run\n')
+
+    def test_no_coalesce_after_run(self):
+        command = 'sh -c "echo run >> {}"'.format(self.log_path)
+        runner = HookRunner(state_dir=self.state_dir)
+        runner.run(command)
+        runner.run(command)
+
+        with open(self.log_path, 'r') as f:
+            self.assertEqual(f.read(), 'run\nrun\n')
@@ -0,0 +1,502 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from cloak.serverapi.errors import ServerApiError
+from cloak.serverapi.server import Bundle, PKI, Server
+from cloak.serverapi.tests.mock import MockSession
+from cloak.serverapi.tests import test_cli
+from cloak.serverapi.utils import http
+from cloak.serverapi.utils.fallback import LastKnownGood
+from cloak.serverapi.utils.ratelimit import RateLimiter, jitter, parse_retry_after
+from cloak.serverapi.utils.singleflight import SingleFlight
+
+
+class ClientTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.session1 = MockSession(def_target_id='tgt_one')
+        self.session2 = MockSession(def_target_id='tgt_two')
+        self.client1 = http.Client(
+            base_url='https://one.example.com/', api_version='2017-02-28',
+            session=self.session1,
+        )
+        self.client2 = http.Client(
+            base_url='https://two.example.com/', api_version='2050-01-01',
+            session=self.session2,
+        )
+
+    def test_register(self):
+        server = Server.register('key', 'srv1.example.com', api_version=None, client=self.client2)
+
+        self.assertIs(server.client, self.client2)
+        self.assertEqual(self.session2.api_version, '2050-01-01')
+        self.assertIsNone(self.session1.server_id)
+
+    def test_concurrent_clients(self):
+        server1 = Server.register('key', 'srv1.example.com', client=self.client1)
+        server2 = Server.register('key', 'srv2.example.com', client=self.client2)
+
+        def retrieve(i):
+            if i % 2 == 0:
+                server = Server.retrieve(server1.server_id, server1.auth_token, client=self.client1)
+            else:
+                server = Server.retrieve(server2.server_id, server2.auth_token, client=self.client2)
+            return server
+
+        with ThreadPoolExecutor(8) as executor:
+            servers = list(executor.map(retrieve, range(32)))
+
+        for i, server in enumerate(servers):
+            expected = 'tgt_one' if (i % 2 == 0) else 'tgt_two'
+            self.assertEqual(server.target.target_id, expected)
+
+    def test_headers_not_modified(self):
+        server = Server.register('key', client=self.client1)
+        headers = {'Accept': 'application/json'}
+
+        self.client1.get('server/', headers=headers, auth=server._api_auth)
+
+        self.assertEqual(headers, {'Accept': 'application/json'})
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.session = SlowMockSession(def_target_id='tgt_one')
+        self.client = http.Client(session=self.session, single_flight=True)
+        self.server = Server.register('key', client=self.client)
+
+    def test_coalesce(self):
+        def retrieve(i):
+            return Server.retrieve(self.server.server_id, self.server.auth_token, client=self.client)
+
+        with ThreadPoolExecutor(8) as executor:
+            servers = list(executor.map(retrieve, range(8)))
+
+        self.assertEqual(self.session.gets, 1)
+        for server in servers:
+            self.assertEqual(server.server_id, self.server.server_id)
+
+    def test_sequential(self):
+        Server.retrieve(self.server.server_id, self.server.auth_token, client=self.client)
+        Server.retrieve(self.server.server_id, self.server.auth_token, client=self.client)
+
+        self.assertEqual(self.session.gets, 2)
+
+    def test_ttl(self):
+        now = [0.0]
+        self.client._flight = SingleFlight(ttl=5, clock=lambda: now[0])
+
+        Server.retrieve(self.server.server_id, self.server.auth_token, client=self.client)
+        Server.retrieve(self.server.server_id, self.server.auth_token, client=self.client)
+        now[0] = 6.0
+        Server.retrieve(self.server.server_id, self.server.auth_token, client=self.client)
+
+        self.assertEqual(self.session.gets, 2)
+
+    def test_post_clears(self):
+        self.client._flight = SingleFlight(ttl=60)
+
+        Server.retrieve(self.server.server_id, self.server.auth_token, client=self.client)
+        self.server.update_server(name='srv2.example.com')
+        server = Server.retrieve(self.server.server_id, self.server.auth_token, client=self.client)
+
+        self.assertEqual(self.session.gets, 2)
+        self.assertEqual(server.name, 'srv2.example.com')
+
+    def test_distinct_auth(self):
+        Server.retrieve(self.server.server_id, self.server.auth_token, client=self.client)
+        with self.assertRaises(Exception):
+            Server.retrieve(self.server.server_id, 'bogus', client=self.client)
+
+        self.assertEqual(self.session.gets, 2)
+
+    def test_errors_not_cached(self):
+        flight = SingleFlight(ttl=60)
+
+        with self.assertRaises(ValueError):
+            flight.do('key', self._fail)
+        result = flight.do('key', lambda: 'ok')
+
+        self.assertEqual(result, 'ok')
+
+    def _fail(self):
+        raise ValueError()
+
+
+class BundleTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.session = SlowMockSession(def_target_id='tgt_one')
+        self.session.wireguard_peers = [
+            {'public_key': 'peer1', 'allowed_ips': ['100.64.0.2/32']},
+        ]
+        self.client = http.Client(session=self.session)
+        self.server = Server.register('key', client=self.client)
+        self.server.request_certificate(test_cli.PKITestCase.privkey_rsa_2048)
+
+    def test_bundle(self):
+        bundle = self._bundle()
+
+        self.assertEqual(self.session.gets, 1)
+        self.assertBundle(bundle)
+
+    def test_not_modified(self):
+        bundle = self._bundle()
+        bundle = self._bundle(**self._tags(bundle))
+
+        self.assertIs(bundle.server, Bundle.NOT_MODIFIED)
+        self.assertIs(bundle.pki, Bundle.NOT_MODIFIED)
+        self.assertIs(bundle.wireguard_peers, Bundle.NOT_MODIFIED)
+
+    def test_peers_modified(self):
+        bundle = self._bundle()
+        self.session.wireguard_peers = []
+        bundle = self._bundle(**self._tags(bundle))
+
+        self.assertIs(bundle.server, Bundle.NOT_MODIFIED)
+        self.assertEqual(bundle.wireguard_peers, [])
+
+    def test_parts(self):
+        bundle = self._bundle(parts=['pki'])
+
+        self.assertIsNone(bundle.server)
+        self.assertIsNone(bundle.wireguard_peers)
+        self.assertEqual(bundle.pki.tag, self.session.pki_tag)
+
+    def test_unbundled(self):
+        self.session.bundle_supported = False
+
+        bundle = self._bundle()
+        self.assertBundle(bundle)
+        self.assertEqual(self.session.gets, 4)
+
+        # We shouldn't try the bundle endpoint again.
+        bundle = self._bundle(**self._tags(bundle))
+        self.assertEqual(self.session.gets, 7)
+        self.assertIs(bundle.server, Bundle.NOT_MODIFIED)
+        self.assertIs(bundle.pki, Bundle.NOT_MODIFIED)
+        self.assertIs(bundle.wireguard_peers, Bundle.NOT_MODIFIED)
+
+    def _bundle(self, **kwargs):
+        return Server.bundle(self.server.server_id, self.server.auth_token, client=self.client, **kwargs)
+
+    def _tags(self, bundle):
+        return {'{}_tag'.format(part): tag for part, tag in bundle.tags.items()}
+
+    def assertBundle(self, bundle):
+        self.assertEqual(bundle.server.server_id, self.server.server_id)
+        self.assertEqual(bundle.server.target.target_id, 'tgt_one')
+        self.assertEqual(bundle.pki.tag, self.session.pki_tag)
+        self.assertEqual(bundle.wireguard_peers, self.session.wireguard_peers)
+
+
+class ChangesTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.session = SlowMockSession(def_target_id='tgt_one')
+        self.client = http.Client(session=self.session)
+        self.server = Server.register('key', client=self.client)
+        self.server.request_certificate(test_cli.PKITestCase.privkey_rsa_2048)
+        self.tags = Server.bundle(self.server.server_id, self.server.auth_token, client=self.client).tags
+
+    def test_unchanged(self):
+        changed = self._wait(self.tags)
+
+        self.assertEqual(changed, {})
+
+    def test_changed(self):
+        self.session.rotate_pki()
+        self.session.wireguard_peers = [{'public_key': 'peer1', 'allowed_ips': ['100.64.0.2/32']}]
+        changed = self._wait(self.tags)
+
+        self.assertEqual(set(changed), {'pki', 'wireguard_peers'})
+        self.assertEqual(changed['pki'], self.session.pki_tag)
+
+    def test_parts(self):
+        self.session.rotate_pki()
+        changed = self._wait({'server': self.tags['server']})
+
+        self.assertEqual(changed, {})
+
+    def test_missing_tag(self):
+        changed = self._wait({'pki': None})
+
+        self.assertEqual(changed, {'pki': self.session.pki_tag})
+
+    def test_unsupported(self):
+        self.session.changes_supported = False
+        gets = self.session.gets
+
+        self.assertIsNone(self._wait(self.tags))
+        self.assertIsNone(self._wait(self.tags))
+        self.assertEqual(self.session.gets, gets + 1)
+
+    def _wait(self, tags):
+        return Server.wait_for_changes(self.server.server_id, self.server.auth_token, tags, client=self.client)
+
+
+class PeerStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.session = MockSession(def_target_id='tgt_one')
+        self.client = http.Client(session=self.session)
+        self.server = Server.register('key', client=self.client)
+        self.session.generate_wireguard_peers(10000)
+
+        peers = {peer['public_key']: [1700000000, 123456, 654321] for peer in self.session.wireguard_peers}
+        self.batches = [{'start': 1000, 'end': 1300, 'peers': peers}]
+
+    def test_upload(self):
+        with mock.patch.object(self.session, 'post', wraps=self.session.post) as post:
+            result = self._upload(self.server.auth_token)
+
+        self.assertEqual(result, {'accepted': 1})
+        self.assertEqual(self.session.peer_stats, self.batches)
+        self.assertEqual(post.call_count, 1)
+        # Mostly the keys, which don't compress.
+        self.assertLess(len(post.call_args[1]['data']), 10000 * 40)
+
+    def test_unauthorized(self):
+        with self.assertRaises(ServerApiError):
+            self._upload('bogus')
+
+        self.assertEqual(self.session.peer_stats, [])
+
+    def _upload(self, auth_token):
+        return Server.upload_peer_stats(self.server.server_id, auth_token, self.batches, client=self.client)
+
+
+class FallbackTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, self.cache_dir))
+
+        self.session = SlowMockSession(def_target_id='tgt_one')
+        self.session.delay = 0
+        self.fallback = LastKnownGood(self.cache_dir, deadline=0.1)
+        self.addCleanup(self.fallback.wait)
+        self.client = http.Client(session=self.session, fallback=self.fallback)
+        self.server = Server.register('key', client=self.client)
+        self.server.request_certificate(test_cli.PKITestCase.privkey_rsa_2048)
+
+    def test_down_uncached(self):
+        self.session.down = True
+
+        with self.assertRaises(requests.ConnectionError):
+            self._retrieve()
+
+    def test_down_cached(self):
+        self._retrieve()
+        self.session.down = True
+
+        server = self._retrieve()
+
+        self.assertEqual(server.server_id, self.server.server_id)
+
+    def test_auth_error(self):
+        self._retrieve()
+
+        with self.assertRaises(ServerApiError):
+            Server.retrieve(self.server.server_id, 'bogus', client=self.client)
+
+    def test_deadline(self):
+        self._retrieve()
+        self.session.name = 'renamed.example.com'
+        self.session.delay = 1
+
+        start = time.monotonic()
+        server = self._retrieve()
+        elapsed = time.monotonic() - start
+
+        self.assertLess(elapsed, 0.5)
+        self.assertNotEqual(server.name, 'renamed.example.com')
+
+        # The cache is revalidated in the background.
+        self.fallback.wait()
+        self.session.down = True
+        server = self._retrieve()
+        self.assertEqual(server.name, 'renamed.example.com')
+
+    def test_circuit_breaker(self):
+        self._retrieve()
+        self.session.down = True
+
+        for i in range(self.fallback.failure_threshold):
+            self._retrieve()
+        gets = self.session.gets
+        self.assertTrue(self.fallback.is_open())
+
+        self._retrieve()
+        self.assertEqual(self.session.gets, gets)
+
+    def test_circuit_breaker_reset(self):
+        now = [time.time()]
+        self.fallback.clock = lambda: now[0]
+        self._retrieve()
+        self.session.down = True
+        for i in range(self.fallback.failure_threshold):
+            self._retrieve()
+
+        now[0] += self.fallback.cooldown + 1
+        self.session.down = False
+        self._retrieve()
+
+        self.assertFalse(self.fallback.is_open())
+
+    def test_pki(self):
+        pki = self.server.get_pki()
+        self.session.down = True
+
+        self.assertEqual(self.server.get_pki().tag, pki.tag)
+        self.assertIs(self.server.get_pki(pki.tag), PKI.NOT_MODIFIED)
+
+    def test_bundle(self):
+        bundle = Server.bundle(self.server.server_id, self.server.auth_token, client=self.client)
+        self.session.down = True
+
+        cached = Server.bundle(self.server.server_id, self.server.auth_token, client=self.client)
+        self.assertEqual(cached.server.server_id, self.server.server_id)
+        self.assertEqual(cached.pki.tag, bundle.pki.tag)
+
+        cached = Server.bundle(self.server.server_id, self.server.auth_token, pki_tag=bundle.pki.tag, client=self.client)
+        self.assertIs(cached.pki, Bundle.NOT_MODIFIED)
+
+    def test_bundle_no_certificate(self):
+        self.session.csr = None
+        Server.bundle(self.server.server_id, self.server.auth_token, client=self.client)
+        self.session.down = True
+
+        cached = Server.bundle(self.server.server_id, self.server.auth_token, client=self.client)
+
+        self.assertIsNot(cached.pki, Bundle.NOT_MODIFIED)
+        self.assertIsNone(cached.pki.entity)
+
+    def _retrieve(self):
+        return Server.retrieve(self.server.server_id, self.server.auth_token, client=self.client)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.now = 0.0
+        self.sleeps = []
+        self.limiter = RateLimiter(rate=2, burst=2, clock=self._clock, sleep=self._sleep)
+
+        self.session = MockSession(def_target_id='tgt_one')
+        self.client = http.Client(session=self.session, rate_limiter=self.limiter)
+        self.server = Server.register('key', client=self.client)
+
+    def test_burst(self):
+        limiter = RateLimiter(rate=2, burst=2, clock=self._clock, sleep=self._sleep)
+
+        for i in range(3):
+            limiter.acquire()
+
+        self.assertEqual(self.sleeps, [0.5])
+
+    def test_bad_rate(self):
+        with self.assertRaises(ValueError):
+            RateLimiter(rate=0)
+
+    def test_retry_after(self):
+        self.session.injected = [(429, {'Retry-After': '7'})]
+
+        server = self._retrieve()
+
+        self.assertEqual(server.server_id, self.server.server_id)
+        self.assertEqual(sum(self.sleeps), 7)
+
+    def test_retry_backoff(self):
+        self.session.injected = [(503, {}), (503, {})]
+
+        self._retrieve()
+
+        self.assertEqual(sum(self.sleeps), 3)
+
+    def test_retry_after_too_long(self):
+        self.session.injected = [(429, {'Retry-After': '3600'})]
+
+        with self.assertRaises(ServerApiError) as cm:
+            self._retrieve()
+
+        self.assertEqual(cm.exception.response.status_code, 429)
+        self.assertEqual(self.sleeps, [])
+
+    def test_max_retries(self):
+        self.session.injected = [(503, {'Retry-After': '1'})] * (self.limiter.max_retries + 1)
+
+        with self.assertRaises(ServerApiError):
+            self._retrieve()
+
+    def test_no_limiter(self):
+        self.client.rate_limiter = None
+        self.session.injected = [(429, {'Retry-After': '1'})]
+
+        with self.assertRaises(ServerApiError):
+            self._retrieve()
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('120'), 120)
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT', now=1445412470), 10)
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertIsNone(parse_retry_after(None))
+
+    def test_jitter(self):
+        delays = [jitter('srv_{}'.format(i), 60) for i in range(100)]
+
+        self.assertEqual(delays[0], jitter('srv_0', 60))
+        self.assertTrue(all(0 <= delay < 60 for delay in delays))
+        self.assertGreater(len(set(delays)), 90)
+
+    def _retrieve(self):
+        return Server.retrieve(self.server.server_id, self.server.auth_token, client=self.client)
+
+    def _clock(self):
+        return self.now
+
+    def _sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class SlowMockSession(MockSession):
+    """
+    Counts GETs and holds them open long enough to overlap.
+
+    Set down to True to simulate an unreachable API.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.gets = 0
+        self.delay = 0.05
+        self.down = False
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        with self._lock:
+            self.gets += 1
+        time.sleep(self.delay)
+
+        if self.down:
+            raise requests.ConnectionError(url)
+
+        return super().get(url, **kwargs)
@@ -0,0 +1,112 @@
+from base64 import b64encode
+from functools import partial
+import os
+import os.path
+import shutil
+import stat
+import tempfile
+import unittest
+
+from cloak.serverapi.utils.peerindex import PeerIndex, write_index
+
+
+def _key(n):
+    return b64encode(bytes([n]) * 32).decode('ascii')
+
+
+class PeerIndexTestCase(unittest.TestCase):
+    peers = [
+        {'public_key': _key(1), 'allowed_ips': ['10.0.0.2/32', 'fd00::2/128']},
+        {'public_key': _key(2), 'allowed_ips': ['10.0.1.0/24']},
+        {'public_key': _key(3), 'allowed_ips': ['10.0.0.0/8', '::/0']},
+        {'public_key': _key(4), 'allowed_ips': []},
+    ]
+
+    def setUp(self):
+        super().setUp()
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, self.path))
+
+        self.index_path = os.path.join(self.path, 'peers.idx')
+        write_index(self.index_path, self.peers)
+
+        self.index = PeerIndex(self.index_path)
+        self.addCleanup(self.index.close)
+
+    def test_mode(self):
+        self.addCleanup(os.umask, os.umask(0o077))
+        os.remove(self.index_path)
+        write_index(self.index_path, self.peers)
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.index_path).st_mode), 0o644)
+
+    def test_len(self):
+        self.assertEqual(len(self.index), 4)
+
+    def test_key(self):
+        self.assertEqual(self.index.find_key(_key(2)), self.peers[1])
+        self.assertEqual(self.index.find_key(_key(4)), self.peers[3])
+
+    def test_key_missing(self):
+        self.assertIsNone(self.index.find_key(_key(5)))
+
+    def test_iter(self):
+        self.assertEqual(list(self.index), self.peers)
+
+    def test_views(self):
+        key = self.index.key(0)
+        networks = self.index.networks(0)
+
+        self.assertIsInstance(key, memoryview)
+        self.assertEqual(key.tobytes(), bytes([1]) * 32)
+        self.assertEqual([(family, prefixlen) for family, prefixlen, _ in networks], [(4, 32), (6, 128)])
+        self.assertEqual(networks[0][2].tobytes(), bytes([10, 0, 0, 2]))
+
+    def test_close_with_views(self):
+        key = self.index.key(0)
+        self.index.close()
+
+        self.assertEqual(key.tobytes(), bytes([1]) * 32)
+
+    def test_out_of_range(self):
+        with self.assertRaises(IndexError):
+            self.index.key(4)
+
+    def test_key_invalid(self):
+        with self.assertRaises(ValueError):
+            self.index.find_key('bogus')
+
+    def test_exact(self):
+        peer = self.index.find_ip('10.0.0.2')
+
+        self.assertEqual(peer['public_key'], _key(1))
+        self.assertEqual(peer['match'], '10.0.0.2/32')
+
+    def test_longest_prefix(self):
+        self.assertEqual(self.index.find_ip('10.0.1.9')['public_key'], _key(2))
+        self.assertEqual(self.index.find_ip('10.0.0.3')['match'], '10.0.0.0/8')
+
+    def test_ipv6(self):
+        self.assertEqual(self.index.find_ip('fd00::2')['public_key'], _key(1))
+        self.assertEqual(self.index.find_ip('2001:db8::1')['match'], '::/0')
+
+    def test_no_match(self):
+        self.assertIsNone(self.index.find_ip('192.168.0.1'))
+
+    def test_host_bits(self):
+        write_index(self.index_path, [{'public_key': _key(1), 'allowed_ips': ['10.1.2.3/16']}])
+
+        with PeerIndex(self.index_path) as index:
+            self.assertEqual(index.find_ip('10.1.200.1')['match'], '10.1.0.0/16')
+
+    def test_unchanged(self):
+        self.assertFalse(write_index(self.index_path, list(reversed(self.peers))))
+        self.assertTrue(write_index(self.index_path, self.peers[:2]))
+
+    def test_not_an_index(self):
+        with open(self.index_path, 'wb') as f:
+            f.write(b'[]')
+
+        with self.assertRaises(ValueError):
+            PeerIndex(self.index_path)
@@ -0,0 +1,136 @@
+from functools import partial
+import shutil
+import tempfile
+import unittest
+
+from cloak.serverapi.utils.peerstats import MAX_BACKOFF, StatsSpool, parse_dump
+
+
+DUMP = (
+    'wg0\tcHJpdmF0ZQ==\tcHVibGlj\t51820\toff\n'
+    'wg0\tpeer1=\t(none)\t192.0.2.1:51820\t10.0.0.2/32\t1700000000\t100\t200\t0\n'
+    'wg0\tpeer2=\t(none)\t(none)\t10.0.0.3/32,fd00::3/128\t0\t0\t0\t25\n'
+)
+
+
+class ParseDumpTestCase(unittest.TestCase):
+    def test_all(self):
+        samples = parse_dump(DUMP)
+
+        self.assertEqual(samples, {'peer1=': (1700000000, 100, 200), 'peer2=': (0, 0, 0)})
+
+    def test_interface(self):
+        text = 'cHJpdmF0ZQ==\tcHVibGlj\t51820\toff\npeer1=\t(none)\t(none)\t10.0.0.2/32\t0\t5\t6\toff\n'
+
+        self.assertEqual(parse_dump(text), {'peer1=': (0, 5, 6)})
+
+    def test_bad(self):
+        with self.assertRaises(ValueError):
+            parse_dump('wg0\tpeer1=\t(none)\t(none)\t10.0.0.2/32\tsoon\t0\t0\t0\n')
+
+
+class StatsSpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, self.path))
+
+        self.now = 1000.0
+        self.spool = self._spool()
+
+    def test_baseline(self):
+        changed = self.spool.collect({'a': (0, 100, 200)})
+
+        self.assertEqual(changed, 0)
+        self.assertEqual(self.spool.batches, [])
+
+    def test_deltas(self):
+        self.spool.collect({'a': (10, 100, 200), 'b': (0, 0, 0)})
+        self.now += 60
+        changed = self.spool.collect({'a': (10, 150, 210), 'b': (0, 0, 0), 'c': (1050, 7, 8)})
+
+        self.assertEqual(changed, 2)
+        self.assertEqual(self.spool.batches, [
+            {'start': 1000, 'end': 1060, 'peers': {'a': [10, 50, 10], 'c': [1050, 7, 8]}},
+        ])
+
+    def test_handshake(self):
+        self.spool.collect({'a': (10, 100, 200)})
+        self.spool.collect({'a': (20, 100, 200)})
+
+        self.assertEqual(self.spool.batches[0]['peers'], {'a': [20, 0, 0]})
+
+    def test_reset(self):
+        self.spool.collect({'a': (10, 100, 200)})
+        self.spool.collect({'a': (20, 30, 250)})
+
+        self.assertEqual(self.spool.batches[0]['peers'], {'a': [20, 30, 50]})
+
+    def test_persistent(self):
+        self.spool.collect({'a': (10, 100, 200)})
+        self._spool().collect({'a': (10, 150, 200)})
+
+        self.assertEqual(self.spool.batches[0]['peers'], {'a': [10, 50, 0]})
+
+    def test_bounded(self):
+        spool = self._spool(max_batches=3)
+        spool.collect({'a': (0, 0, 0)})
+        for i in range(1, 6):
+            self.now += 60
+            spool.collect({'a': (i, i * 10, 0), 'b': (0, i, 0)})
+
+        batches = spool.batches
+        self.assertEqual(len(batches), 3)
+        self.assertEqual(batches[0], {'start': 1000, 'end': 1180, 'peers': {'a': [3, 30, 0], 'b': [0, 3, 0]}})
+        self.assertEqual(sum(batch['peers']['a'][1] for batch in batches), 50)
+        self.assertEqual(sum(batch['peers']['b'][1] for batch in batches), 5)
+
+    def test_due(self):
+        self.spool.collect({'a': (0, 0, 0)})
+        self.now += 60
+        self.spool.collect({'a': (0, 10, 0)})
+
+        self.assertFalse(self.spool.due(300))
+        self.now += 240
+        self.assertTrue(self.spool.due(300))
+
+    def test_uploaded(self):
+        self.spool.collect({'a': (0, 0, 0)})
+        self.spool.collect({'a': (0, 10, 0)})
+        self.spool.uploaded(1)
+
+        self.assertEqual(self.spool.batches, [])
+        self.assertFalse(self.spool.due(0))
+
+    def test_backoff(self):
+        self.spool.collect({'a': (0, 0, 0)})
+        self.spool.collect({'a': (0, 10, 0)})
+
+        delays = [self.spool.failed(300) for i in range(6)]
+
+        self.assertEqual(delays, [300, 600, 1200, 2400, MAX_BACKOFF, MAX_BACKOFF])
+        self.assertFalse(self.spool.due(0))
+        self.now += MAX_BACKOFF
+        self.assertTrue(self.spool.due(0))
+
+    def test_retry_after(self):
+        self.spool.collect({'a': (0, 0, 0)})
+        self.spool.collect({'a': (0, 10, 0)})
+        self.spool.failed(300, retry_after=30)
+        self.now += 30
+
+        self.assertTrue(self.spool.due(0))
+
+    def test_recovered(self):
+        self.spool.collect({'a': (0, 0, 0)})
+        self.spool.collect({'a': (0, 10, 0)})
+        self.spool.failed(300)
+        self.spool.failed(300)
+        self.spool.uploaded(1)
+        self.spool.collect({'a': (0, 20, 0)})
+
+        self.assertEqual(self.spool.failed(300), 300)
+
+    def _spool(self, **kwargs):
+        return StatsSpool(self.path, clock=lambda: self.now, **kwargs)
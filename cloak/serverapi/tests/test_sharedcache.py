@@ -0,0 +1,174 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import glob
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from cloak.serverapi.server import Server
+from cloak.serverapi.tests.test_http import SlowMockSession
+from cloak.serverapi.utils import http
+from cloak.serverapi.utils.sharedcache import SharedCache
+
+
+class SharedCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, self.path))
+
+        self.now = 0.0
+        self.calls = []
+
+    def cache(self):
+        """ A new cache, as another container would have. """
+        return SharedCache(self.path, ttl=60, clock=lambda: self.now)
+
+    def download(self, content, etag=None):
+        def func(meta):
+            self.calls.append(meta)
+            if (etag is not None) and (meta.get('etag') == etag):
+                return None
+            return (content, {'etag': etag})
+
+        return func
+
+    def test_shared(self):
+        content, meta = self.cache().fetch('key', self.download(b'one'))
+        content2, meta2 = self.cache().fetch('key', self.download(b'two'))
+
+        self.assertEqual(content, b'one')
+        self.assertEqual(content2, b'one')
+        self.assertEqual(meta2['digest'], meta['digest'])
+        self.assertEqual(len(self.calls), 1)
+
+    def test_expired(self):
+        self.cache().fetch('key', self.download(b'one'))
+        self.now = 61
+        content, meta = self.cache().fetch('key', self.download(b'two'))
+
+        self.assertEqual(content, b'two')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_not_modified(self):
+        self.cache().fetch('key', self.download(b'one', '"1"'))
+        self.now = 61
+        content, meta = self.cache().fetch('key', self.download(b'one', '"1"'))
+        self.cache().fetch('key', self.download(b'one', '"1"'))
+
+        self.assertEqual(content, b'one')
+        self.assertEqual(self.calls[1]['etag'], '"1"')
+        self.assertEqual(meta['fetched'], 61)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_content_addressed(self):
+        self.cache().fetch('key1', self.download(b'same'))
+        self.cache().fetch('key2', self.download(b'same'))
+
+        self.assertEqual(len(glob.glob(os.path.join(self.path, 'objects', '*', '*'))), 1)
+        self.assertEqual(len(glob.glob(os.path.join(self.path, 'refs', '*'))), 2)
+
+    def test_no_plain_keys(self):
+        self.cache().fetch('secret_token', self.download(b'one'))
+
+        for path in glob.glob(os.path.join(self.path, '*', '*')):
+            self.assertNotIn('secret_token', path)
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    self.assertNotIn(b'secret_token', f.read())
+
+    def test_corrupt(self):
+        self.cache().fetch('key', self.download(b'one'))
+        for path in glob.glob(os.path.join(self.path, 'objects', '*', '*')):
+            with open(path, 'wb') as f:
+                f.write(b'bogus')
+        content, meta = self.cache().fetch('key', self.download(b'one'))
+
+        self.assertEqual(content, b'one')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_errors_not_cached(self):
+        def fail(meta):
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            self.cache().fetch('key', fail)
+        content, meta = self.cache().fetch('key', self.download(b'one'))
+
+        self.assertEqual(content, b'one')
+
+    def test_forget(self):
+        self.cache().fetch('key', self.download(b'one'))
+        self.cache().forget('key')
+        content, meta = self.cache().fetch('key', self.download(b'two'))
+
+        self.assertEqual(content, b'two')
+
+    def test_concurrent(self):
+        lock = threading.Lock()
+
+        def slow(meta):
+            with lock:
+                self.calls.append(meta)
+            time.sleep(0.1)
+            return (b'one', {})
+
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda i: self.cache().fetch('key', slow), range(8)))
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual({content for content, meta in results}, {b'one'})
+
+    def test_prune(self):
+        cache = self.cache()
+        cache.fetch('key', self.download(b'one'))
+        self.now = 61
+        cache.fetch('key', self.download(b'two'))
+
+        self.assertEqual(cache.prune(max_age=3600), 0)
+        self.assertEqual(cache.prune(max_age=-1), 1)
+        content, meta = self.cache().fetch('key', self.download(b'three'))
+        self.assertEqual(content, b'two')
+
+
+class SharedClientTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, path))
+
+        self.session = SlowMockSession(def_target_id='tgt_one')
+        self.clients = [
+            http.Client(session=self.session, shared_cache=SharedCache(path))
+            for i in range(2)
+        ]
+        self.server = Server.register('key', client=self.clients[0])
+
+    def test_shared(self):
+        for client in self.clients:
+            server = Server.retrieve(self.server.server_id, self.server.auth_token, client=client)
+            self.assertEqual(server.server_id, self.server.server_id)
+
+        self.assertEqual(self.session.gets, 1)
+
+    def test_distinct_auth(self):
+        Server.retrieve(self.server.server_id, self.server.auth_token, client=self.clients[0])
+        with self.assertRaises(Exception):
+            Server.retrieve(self.server.server_id, 'bogus', client=self.clients[1])
+
+        self.assertEqual(self.session.gets, 2)
+
+    def test_post_forgets(self):
+        client = self.clients[0]
+        Server.retrieve(self.server.server_id, self.server.auth_token, client=client)
+        self.server.client = client
+        self.server.update_server(name='srv2.example.com')
+        server = Server.retrieve(self.server.server_id, self.server.auth_token, client=client)
+
+        self.assertEqual(server.name, 'srv2.example.com')
@@ -0,0 +1,440 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import glob
+import os
+import os.path
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from asn1crypto import pem
+import requests
+
+from cloak.serverapi.errors import ServerApiError
+from cloak.serverapi.server import PKI, Server
+from cloak.serverapi.tests import test_cli
+from cloak.serverapi.tests.base import TestCase
+from cloak.serverapi.tests.mock import make_crl
+from cloak.serverapi.tests.standin import StandInServer
+from cloak.serverapi.utils import http
+
+
+class StandInTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.standin = StandInServer(peers=100).start()
+        self.addCleanup(self.standin.stop)
+
+        self.client = http.Client(base_url=self.standin.base_url, api_version='2017-02-28')
+
+    def test_lifecycle(self):
+        server = Server.register('key', 'srv1.example.com', client=self.client)
+        server = Server.retrieve(server.server_id, server.auth_token, client=self.client)
+        self.assertEqual(server.name, 'srv1.example.com')
+
+        server.update_server(name='srv2.example.com')
+        self.assertEqual(server.name, 'srv2.example.com')
+
+        server.request_certificate(test_cli.PKITestCase.privkey_rsa_2048)
+        pki = server.get_pki()
+        self.assertIsNotNone(pki.entity)
+        self.assertIs(server.get_pki(pki.tag), PKI.NOT_MODIFIED)
+
+        peers = Server.wireguard_peers(server.server_id, server.auth_token, client=self.client)
+        self.assertEqual(len(peers), 100)
+
+    def test_concurrent(self):
+        server_id, auth_token = self.standin.session.provision()
+
+        def retrieve(i):
+            return Server.retrieve(server_id, auth_token, client=self.client)
+
+        with ThreadPoolExecutor(8) as executor:
+            servers = list(executor.map(retrieve, range(64)))
+
+        self.assertEqual({server.server_id for server in servers}, {server_id})
+        self.assertEqual(self.standin.requests, 64)
+
+    def test_overlapping(self):
+        server_id, auth_token = self.standin.session.provision()
+
+        # Each request waits inside the server for the other one.
+        barrier = threading.Barrier(2, timeout=5)
+        get = self.standin.session.get
+
+        def wait_get(*args, **kwargs):
+            barrier.wait()
+            return get(*args, **kwargs)
+
+        def retrieve(i):
+            return Server.retrieve(server_id, auth_token, client=self.client)
+
+        with mock.patch.object(self.standin.session, 'get', wait_get):
+            with ThreadPoolExecutor(2) as executor:
+                servers = list(executor.map(retrieve, range(2)))
+
+        self.assertEqual({server.server_id for server in servers}, {server_id})
+
+    def test_auth_fail(self):
+        server_id, auth_token = self.standin.session.provision()
+
+        with self.assertRaises(ServerApiError) as cm:
+            Server.retrieve(server_id, 'bogus', client=self.client)
+
+        self.assertEqual(cm.exception.response.status_code, 401)
+
+    def test_error_rate(self):
+        server_id, auth_token = self.standin.session.provision()
+        self.standin.error_rate = 1
+
+        with self.assertRaises(ServerApiError) as cm:
+            Server.retrieve(server_id, auth_token, client=self.client)
+
+        self.assertEqual(cm.exception.response.status_code, 503)
+        self.assertEqual(cm.exception.response.headers['Retry-After'], '1')
+
+    def test_not_found(self):
+        with self.assertRaises(ServerApiError) as cm:
+            self.client.get('bogus/')
+
+        self.assertEqual(cm.exception.response.status_code, 404)
+
+
+class StandInTLSTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        if shutil.which('openssl') is None:
+            self.skipTest("openssl is not available.")
+
+        cert_dir = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, cert_dir))
+        certfile = os.path.join(cert_dir, 'cert.pem')
+        keyfile = os.path.join(cert_dir, 'key.pem')
+        subprocess.check_call([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1',
+            '-keyout', keyfile, '-out', certfile,
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        self.standin = StandInServer(certfile=certfile, keyfile=keyfile).start()
+        self.addCleanup(self.standin.stop)
+        self.certfile = certfile
+
+    def test_stalled_handshake(self):
+        host, port = self.standin.server_address[:2]
+        stalled = socket.create_connection((host, port))
+        self.addCleanup(stalled.close)
+
+        session = requests.Session()
+        self.addCleanup(session.close)
+        response = session.get(self.standin.base_url + 'crls/missing.crl', verify=self.certfile, timeout=5)
+
+        self.assertEqual(response.status_code, 404)
+
+
+class StandInChangesTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.standin = StandInServer().start()
+        self.addCleanup(self.standin.stop)
+
+        self.client = http.Client(base_url=self.standin.base_url, api_version='2017-02-28')
+        self.server_id, self.auth_token = self.standin.session.provision()
+        self.tags = {'pki': self.standin.session.pki_tag}
+
+    def test_held(self):
+        timer = threading.Timer(0.2, self.standin.session.rotate_pki)
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        start = time.monotonic()
+        changed = Server.wait_for_changes(self.server_id, self.auth_token, self.tags, timeout=10, client=self.client)
+
+        self.assertEqual(changed, {'pki': self.standin.session.pki_tag})
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self.standin.requests, 1)
+
+    def test_timeout(self):
+        start = time.monotonic()
+        changed = Server.wait_for_changes(self.server_id, self.auth_token, self.tags, timeout=1, client=self.client)
+
+        self.assertEqual(changed, {})
+        self.assertGreaterEqual(time.monotonic() - start, 1)
+
+
+class StandInCRLsTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.standin = StandInServer(crls=2, crl_revoked=10).start()
+        self.addCleanup(self.standin.stop)
+
+        self.out_path = tempfile.mkdtemp()
+        self.hook_path = os.path.join(self.out_path, 'changed.txt')
+        self.addCleanup(partial(shutil.rmtree, self.out_path))
+
+    def test_fetch_crls(self):
+        returncode = self._crls()
+
+        self.assertEqual(returncode, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.out_path, 'crl0.pem')))
+        self.assertTrue(os.path.exists(os.path.join(self.out_path, 'crl1.pem')))
+        self.assertTrue(os.path.exists(self.hook_path))
+
+    def test_crls_noop(self):
+        self._crls()
+        os.remove(self.hook_path)
+        returncode = self._crls()
+
+        self.assertEqual(returncode, 0)
+        self.assertFalse(os.path.exists(self.hook_path))
+
+    def test_crls_changed(self):
+        self._crls()
+        os.remove(self.hook_path)
+        self.standin.set_crl('crl1.crl', make_crl('CA 1 renewed', 20))
+        returncode = self._crls()
+
+        self.assertEqual(returncode, 0)
+        self.assertTrue(os.path.exists(self.hook_path))
+
+    def test_shared_dir(self):
+        shared_path = os.path.join(self.out_path, 'shared')
+        self._crls(['--shared-dir', shared_path])
+        requests = self.standin.requests
+        config_path = os.environ['CLOAK_CONFIG']
+
+        # Another container, with its own config, output and hook.
+        other_path = os.path.join(self.out_path, 'other')
+        os.mkdir(other_path)
+        with tempfile.NamedTemporaryFile() as config_file:
+            os.environ['CLOAK_CONFIG'] = config_file.name
+            try:
+                returncode = self.main([
+                    '--shared-dir', shared_path,
+                    'crls',
+                    '--out', other_path,
+                    '--post-hook', 'touch {}'.format(os.path.join(other_path, 'changed.txt')),
+                ] + self.standin.session.crl_urls)
+            finally:
+                os.environ['CLOAK_CONFIG'] = config_path
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.standin.requests, requests)
+        self.assertTrue(os.path.exists(os.path.join(other_path, 'crl0.pem')))
+        self.assertTrue(os.path.exists(os.path.join(other_path, 'changed.txt')))
+
+    def test_bundle(self):
+        bundle_path = os.path.join(self.out_path, 'bundle', 'crls.pem')
+        hash_path = os.path.join(self.out_path, 'hashed')
+        os.mkdir(os.path.dirname(bundle_path))
+        options = ['--bundle', bundle_path, '--hash-dir', hash_path]
+
+        self._crls(crls_options=options)
+
+        with open(bundle_path, 'rb') as f:
+            self.assertEqual(f.read().count(b'BEGIN X509 CRL'), 2)
+        self.assertEqual(len(os.listdir(hash_path)), 2)
+
+        # Nothing changed.
+        os.remove(self.hook_path)
+        mtime = os.path.getmtime(bundle_path)
+        self._crls(crls_options=options)
+
+        self.assertFalse(os.path.exists(self.hook_path))
+        self.assertEqual(os.path.getmtime(bundle_path), mtime)
+
+        # A new bundle.
+        os.remove(bundle_path)
+        self._crls(crls_options=options)
+
+        self.assertTrue(os.path.exists(bundle_path))
+        self.assertTrue(os.path.exists(self.hook_path))
+
+    def _crls(self, options=[], crls_options=[]):
+        return self.main(options + [
+            'crls',
+            '--out', self.out_path,
+            '--post-hook', 'touch {}'.format(self.hook_path),
+        ] + crls_options + self.standin.session.crl_urls)
+
+    def test_sync(self):
+        self.main(['register', '-k', 'secret_onetime_reg_key'])
+        self.session.csr = '<csr>'
+        self.session.rotate_pki()
+        self.session.crl_urls = self.standin.session.crl_urls
+
+        returncode = self._sync()
+
+        self.assertEqual(returncode, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.out_path, 'crl0.pem')))
+        self.assertTrue(os.path.exists(os.path.join(self.out_path, 'bundle.pem')))
+        self.assertTrue(os.path.exists(self.hook_path))
+
+        # Nothing changed.
+        os.remove(self.hook_path)
+        self._sync()
+        self.assertFalse(os.path.exists(self.hook_path))
+
+        # Only a CRL changed.
+        self.standin.set_crl('crl1.crl', make_crl('CA 1 renewed', 20))
+        self._sync()
+        self.assertTrue(os.path.exists(self.hook_path))
+
+    def _sync(self):
+        return self.main([
+            'sync',
+            '--pki-out', self.out_path,
+            '--crl-out', self.out_path,
+            '--crl-bundle', os.path.join(self.out_path, 'bundle.pem'),
+            '--crls-hook', 'touch {}'.format(self.hook_path),
+        ])
+
+
+class StandInCRLResumeTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.standin = StandInServer(crls=1, crl_revoked=1000, crl_drop_after=10000).start()
+        self.addCleanup(self.standin.stop)
+
+        self.out_path = tempfile.mkdtemp()
+        self.cache_path = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, self.out_path))
+        self.addCleanup(partial(shutil.rmtree, self.cache_path))
+
+        self.crl_path = os.path.join(self.out_path, 'crl0.pem')
+
+    def test_resume(self):
+        content = self.standin.crls['crl0.crl'][0]
+        for i in range(10):
+            try:
+                returncode = self._crls()
+            except requests.exceptions.RequestException:
+                self.assertFalse(os.path.exists(self.crl_path))
+            else:
+                break
+
+        self.assertEqual(returncode, 0)
+        with open(self.crl_path, 'rb') as f:
+            self.assertEqual(pem.unarmor(f.read())[2], content)
+        self.assertEqual(os.listdir(os.path.join(self.cache_path, 'crls')), [])
+
+    def test_changed(self):
+        with self.assertRaises(requests.exceptions.RequestException):
+            self._crls()
+        content = make_crl('CA 0 renewed', 10)
+        self.standin.set_crl('crl0.crl', content)
+        returncode = self._crls()
+
+        self.assertEqual(returncode, 0)
+        with open(self.crl_path, 'rb') as f:
+            self.assertEqual(pem.unarmor(f.read())[2], content)
+
+    def test_corrupt_partial(self):
+        with self.assertRaises(requests.exceptions.RequestException):
+            self._crls()
+        for path in glob.glob(os.path.join(self.cache_path, 'crls', '*.part')):
+            with open(path, 'r+b') as f:
+                f.write(b'bogus')
+        self.standin.crl_drop_after = 0
+        self._crls()
+
+        self.assertIn("This isn't a CRL", self.stderr.getvalue())
+        self.assertFalse(os.path.exists(self.crl_path))
+
+        # We start over.
+        returncode = self._crls()
+
+        self.assertEqual(returncode, 0)
+        self.assertTrue(os.path.exists(self.crl_path))
+
+    def test_no_cache_dir(self):
+        with self.assertRaises(requests.exceptions.RequestException):
+            self.main(['crls', '--out', self.out_path] + self.standin.session.crl_urls)
+
+        self.assertEqual(os.listdir(self.cache_path), [])
+
+    def _crls(self):
+        return self.main([
+            '--cache-dir', self.cache_path,
+            'crls',
+            '--out', self.out_path,
+        ] + self.standin.session.crl_urls)
+
+
+class StandInCRLMirrorsTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.slow = StandInServer(latency=1).start()
+        self.addCleanup(self.slow.stop)
+        self.fast = StandInServer().start()
+        self.addCleanup(self.fast.stop)
+
+        content = make_crl('CA 0', 10)
+        self.mirrors = [self.slow.set_crl('crl0.crl', content), self.fast.set_crl('crl0.crl', content)]
+
+        self.out_path = tempfile.mkdtemp()
+        self.addCleanup(partial(shutil.rmtree, self.out_path))
+
+    def test_race(self):
+        start = time.monotonic()
+        returncode = self._crls(self.mirrors)
+
+        self.assertEqual(returncode, 0)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertTrue(os.path.exists(os.path.join(self.out_path, 'crl0.pem')))
+
+    def test_fastest_first(self):
+        self._crls(self.mirrors)
+        requests = self.slow.requests
+        returncode = self._crls(self.mirrors)
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(self.slow.requests, requests)
+
+    def test_mirror_unchanged(self):
+        self._crls(self.mirrors)
+        os.remove(os.path.join(self.out_path, 'crl0.pem'))
+        self._crls(list(reversed(self.mirrors)))
+
+        self.assertFalse(os.path.exists(os.path.join(self.out_path, 'crl0.pem')))
+
+    def test_failed_mirror(self):
+        mirrors = [self.fast.base_url + 'crls/missing.crl'] + self.mirrors
+        returncode = self._crls(mirrors)
+
+        self.assertEqual(returncode, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.out_path, 'missing.pem')))
+        self.assertEqual(self.stderr.getvalue(), '')
+
+    def test_invalid_crl(self):
+        mirrors = [self.fast.set_crl('bogus.crl', b'<html></html>')] + self.mirrors
+        returncode = self._crls(mirrors)
+
+        self.assertEqual(returncode, 0)
+        with open(os.path.join(self.out_path, 'bogus.pem'), 'rb') as f:
+            self.assertIn(b'BEGIN X509 CRL', f.read())
+
+    def test_all_failed(self):
+        returncode = self._crls([self.fast.base_url + 'crls/missing.crl'])
+
+        self.assertEqual(returncode, 0)
+        self.assertIn('Error 404', self.stderr.getvalue())
+
+    def _crls(self, mirrors):
+        return self.main([
+            'crls',
+            '--out', self.out_path,
+            '--stagger', '0.1',
+            ' '.join(mirrors),
+        ])
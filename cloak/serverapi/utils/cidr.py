@@ -0,0 +1,202 @@
+"""
+Aggregation of WireGuard allowed IPs into fewer, larger prefixes.
+"""
+from bisect import bisect_left, bisect_right
+import socket
+
+from typing import Any, Dict, Iterable, List, Tuple  # noqa
+
+
+# (family, first address, prefix length)
+Network = Tuple[int, int, int]
+
+
+def parse_network(value):
+    # type: (str) -> Tuple[int, int, bytes]
+    """
+    Parses a CIDR network into (family, prefix length, packed address).
+
+    Host bits are cleared. This is much faster than ipaddress for big lists.
+
+    """
+    address, _, prefixlen = value.strip().partition('/')
+    family = 6 if (':' in address) else 4
+    try:
+        packed = socket.inet_pton(socket.AF_INET6 if (family == 6) else socket.AF_INET, address)
+        length = int(prefixlen) if prefixlen else len(packed) * 8
+    except (OSError, ValueError):
+        raise ValueError("{} isn't an IP network.".format(value))
+
+    bits = len(packed) * 8
+    if not (0 <= length <= bits):
+        raise ValueError("{} isn't an IP network.".format(value))
+
+    mask = ((1 << length) - 1) << (bits - length)
+    network = (int.from_bytes(packed, 'big') & mask).to_bytes(len(packed), 'big')
+
+    return (family, length, network)
+
+
+def format_network(family, prefixlen, packed):
+    # type: (int, int, bytes) -> str
+    """ The reverse of parse_network(). """
+    address = socket.inet_ntop(socket.AF_INET6 if (family == 6) else socket.AF_INET, packed)
+
+    return '{}/{}'.format(address, prefixlen)
+
+
+def aggregate_routes(peers):
+    # type: (Iterable[Dict[str, Any]]) -> List[str]
+    """
+    Returns the fewest prefixes that cover every peer's allowed IPs.
+
+    These are the routes to the WireGuard interface. WireGuard itself picks
+    the peer, so routes for neighboring peers can always be combined.
+
+    """
+    networks = [
+        _network(value)
+        for peer in peers
+        for value in peer.get('allowed_ips', [])
+    ]
+
+    return [_format(network) for network in _collapse(networks)]
+
+
+def aggregate_peers(peers):
+    # type: (Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]
+    """
+    Returns copies of the peers with their allowed IPs collapsed.
+
+    Each peer's own prefixes are combined where they're adjacent or overlap,
+    unless another peer has a prefix inside the combined one that would then
+    match some address that it didn't before (or vice versa). Longest prefix
+    match picks the same peer for every address before and after.
+
+    Peers whose allowed IPs can't be improved are returned unchanged.
+
+    """
+    peers = list(peers)
+    own = [sorted(set(_network(value) for value in peer.get('allowed_ips', []))) for peer in peers]
+
+    # Every prefix of every peer, for finding the ones inside a candidate.
+    owners = sorted(
+        (network, i)
+        for i, networks in enumerate(own)
+        for network in networks
+    )
+    starts = [network[:2] for network, _ in owners]
+
+    aggregated = []
+    for i, peer in enumerate(peers):
+        networks = []  # type: List[Network]
+        for candidate in _collapse(own[i]):
+            inputs = [network for network in own[i] if _contains(candidate, network)]
+            if (inputs == [candidate]) or _is_safe(candidate, inputs, i, owners, starts):
+                networks.append(candidate)
+            else:
+                networks.extend(inputs)
+
+        allowed_ips = peer.get('allowed_ips', [])
+        if len(networks) < len(allowed_ips):
+            peer = dict(peer, allowed_ips=[_format(network) for network in networks])
+        aggregated.append(peer)
+
+    return aggregated
+
+
+def count_allowed_ips(peers):
+    # type: (Iterable[Dict[str, Any]]) -> int
+    return sum(len(peer.get('allowed_ips', [])) for peer in peers)
+
+
+#
+# Internal
+#
+
+def _network(value):
+    # type: (str) -> Network
+    family, prefixlen, packed = parse_network(value)
+
+    return (family, int.from_bytes(packed, 'big'), prefixlen)
+
+
+def _format(network):
+    # type: (Network) -> str
+    family, start, prefixlen = network
+
+    return format_network(family, prefixlen, start.to_bytes(_address_size(family), 'big'))
+
+
+def _collapse(networks):
+    # type: (Iterable[Network]) -> List[Network]
+    """
+    Returns the fewest networks that cover exactly the same addresses.
+    """
+    collapsed = []  # type: List[Network]
+    for network in sorted(set(networks)):
+        if collapsed and _contains(collapsed[-1], network):
+            continue
+
+        collapsed.append(network)
+
+        # Merge with the sibling on our left, then again with the parent's.
+        while len(collapsed) >= 2:
+            left, right = collapsed[-2], collapsed[-1]
+            family, start, prefixlen = left
+            if (right[0] != family) or (right[2] != prefixlen) or (prefixlen == 0):
+                break
+            size = _size(family, prefixlen)
+            if (start % (size * 2) != 0) or (right[1] != start + size):
+                break
+            collapsed[-2:] = [(family, start, prefixlen - 1)]
+
+    return collapsed
+
+
+def _is_safe(candidate, inputs, peer, owners, starts):
+    # type: (Network, List[Network], int, List[Tuple[Network, int]], List[Tuple[int, int]]) -> bool
+    """
+    Returns True if a peer can replace inputs with candidate, which covers
+    them exactly.
+
+    Another peer's prefix inside candidate keeps the addresses that it has
+    now only if every one of our inputs that overlaps it is shorter.
+
+    """
+    family, start, prefixlen = candidate
+    end = start + _size(family, prefixlen) - 1
+
+    lo = bisect_left(starts, (family, start))
+    hi = bisect_right(starts, (family, end))
+    for (other_family, other_start, other_prefixlen), owner in owners[lo:hi]:
+        if (owner == peer) or (other_prefixlen < prefixlen):
+            continue
+
+        other = (other_family, other_start, other_prefixlen)
+        for network in inputs:
+            if _contains(other, network):
+                return False
+
+    return True
+
+
+def _contains(outer, inner):
+    # type: (Network, Network) -> bool
+    """ True if inner is the same as or inside outer. """
+    family, start, prefixlen = outer
+
+    return (
+        (inner[0] == family) and (inner[2] >= prefixlen) and
+        (start <= inner[1] < start + _size(family, prefixlen))
+    )
+
+
+def _size(family, prefixlen):
+    # type: (int, int) -> int
+    return 1 << (_address_size(family) * 8 - prefixlen)
+
+
+def _address_size(family):
+    # type: (int) -> int
+    return 4 if (family == 4) else 16
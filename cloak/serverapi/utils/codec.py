@@ -0,0 +1,130 @@
+"""
+Encoding and decoding of API results.
+
+JSON goes through orjson or ujson if either is installed, and the standard
+library otherwise. They all produce the same compact output for requests and
+our own files. JSON that we show to users is always in the standard library's
+default format, which scripts may depend on. MessagePack is available if
+msgpack is installed.
+
+"""
+import json
+
+from typing import Any, IO, Union  # noqa
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# The JSON implementation in use.
+if orjson is not None:
+    json_implementation = 'orjson'
+elif ujson is not None:
+    json_implementation = 'ujson'
+else:
+    json_implementation = 'json'
+
+# An Accept header for endpoints that can answer with MessagePack. We take
+# JSON too, in case they can't.
+if msgpack is not None:
+    ACCEPT_COMPACT = '{}, {};q=0.5'.format(MSGPACK, JSON)
+else:
+    ACCEPT_COMPACT = JSON
+
+
+def loads(content):
+    # type: (Union[bytes, str]) -> Any
+    """ Decodes JSON. Raises ValueError if it's invalid. """
+    if orjson is not None:
+        return orjson.loads(content)
+    elif ujson is not None:
+        return ujson.loads(content)
+    else:
+        return json.loads(content)
+
+
+def dumps(value):
+    # type: (Any) -> str
+    """
+    Encodes JSON for users, exactly as json.dumps() does by default: ASCII
+    only, with spaces after separators.
+    """
+    return json.dumps(value)
+
+
+def dump(value, f):
+    # type: (Any, IO[str]) -> None
+    """ Writes dumps(value) to f. """
+    f.write(dumps(value))
+
+
+def dumps_compact(value):
+    # type: (Any) -> str
+    """ Encodes JSON, compactly and without escaping non-ASCII text. """
+    if orjson is not None:
+        return orjson.dumps(value).decode('utf-8')
+    elif ujson is not None:
+        return ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False)
+    else:
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def decode(content, content_type=None):
+    # type: (bytes, str) -> Any
+    """
+    Decodes a response body. Anything that isn't MessagePack is assumed to
+    be JSON.
+    """
+    if _media_type(content_type) in _MSGPACK_TYPES:
+        if msgpack is None:
+            raise ValueError("Can't decode {} without msgpack.".format(content_type))
+        return msgpack.unpackb(content, raw=False)
+
+    return loads(content)
+
+
+def encode(value, content_type=JSON):
+    # type: (Any, str) -> bytes
+    """ Encodes value as JSON or MessagePack. """
+    if _media_type(content_type) in _MSGPACK_TYPES:
+        return msgpack.packb(value, use_bin_type=True)
+
+    return dumps_compact(value).encode('utf-8')
+
+
+def accepts_msgpack(accept):
+    # type: (str) -> bool
+    """ True if an Accept header asks for MessagePack. """
+    for item in (accept or '').split(','):
+        media_type, _, params = item.partition(';')
+        if (media_type.strip().lower() in _MSGPACK_TYPES) and ('q=0' not in params.replace(' ', '').split(';')):
+            return True
+
+    return False
+
+
+#
+# Internal
+#
+
+_MSGPACK_TYPES = frozenset([MSGPACK, 'application/x-msgpack'])
+
+
+def _media_type(content_type):
+    # type: (str) -> str
+    return (content_type or '').partition(';')[0].strip().lower()
@@ -0,0 +1,281 @@
+"""
+Combined views of a directory of CRLs.
+"""
+from hashlib import sha1, sha256
+import json
+import os
+import os.path
+import re
+import struct
+
+from asn1crypto import core, crl, pem, x509
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple  # noqa
+
+from cloak.serverapi.utils.files import atomic_write
+
+
+class CRLBundle:
+    """
+    A single PEM file with every CRL in it.
+
+    path: The bundle. An index of its sections is kept in path.index.
+
+    The bundle is only rewritten when its CRLs change, and then only the
+    changed sections are encoded; the rest are copied from the old bundle.
+
+    """
+    def __init__(self, path):
+        # type: (str) -> None
+        self.path = path
+        self.index_path = path + '.index'
+
+    def update(self, names, changed, load):
+        # type: (List[str], Dict[str, bytes], Callable[[str], Optional[bytes]]) -> bool
+        """
+        Brings the bundle up to date. Returns True if it was rewritten.
+
+        names: Every CRL in the bundle, in order.
+        changed: New content (DER or PEM) for some of the CRLs, by name.
+        load: Returns the content of a CRL that isn't in the bundle yet, or
+            None if there isn't one.
+
+        """
+        index, old = self._load()
+        old_names = [section['name'] for section in index]
+        old_sections = {section['name']: section for section in index}
+
+        if (old_names == names) and not changed:
+            return False
+
+        sections = []  # type: List[Dict[str, object]]
+        chunks = []  # type: List[bytes]
+        offset = 0
+        for name in names:
+            section = old_sections.get(name)
+            if name in changed:
+                content = _armor(changed[name])  # type: Optional[bytes]
+            elif section is not None:
+                content = old[section['offset']:section['offset'] + section['length']]
+            else:
+                content = load(name)
+                if content is not None:
+                    content = _armor(content)
+
+            if content is None:
+                continue
+
+            digest = sha256(content).hexdigest()
+            sections.append({'name': name, 'offset': offset, 'length': len(content), 'sha256': digest})
+            chunks.append(content)
+            offset += len(content)
+
+        if (sections == index) and os.path.exists(self.path):
+            return False
+
+        atomic_write(self.path, b''.join(chunks))
+        atomic_write(self.index_path, json.dumps(sections))
+
+        return True
+
+    def _load(self):
+        # type: () -> Tuple[List[Dict[str, object]], bytes]
+        """
+        Returns (index, content) for the current bundle.
+
+        If the bundle doesn't match its index, we forget about it.
+
+        """
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            with open(self.path, 'rb') as f:
+                content = f.read()
+        except (IOError, ValueError):
+            return ([], b'')
+
+        for section in index:
+            start = section['offset']
+            if sha256(content[start:start + section['length']]).hexdigest() != section['sha256']:
+                return ([], b'')
+
+        return (index, content)
+
+
+class HashedDir:
+    """
+    A directory of links to CRLs, named like OpenSSL's c_rehash.
+
+    path: The directory. It's created if necessary.
+
+    Each link is named for the hash of its CRL's issuer, with a suffix of
+    .r0, .r1, and so on, as OpenSSL expects in a CApath directory. Other
+    files in the directory are left alone.
+
+    """
+    def __init__(self, path):
+        # type: (str) -> None
+        self.path = path
+
+    def update(self, paths, changed):
+        # type: (List[str], Dict[str, bytes]) -> bool
+        """
+        Brings the links up to date. Returns True if anything changed.
+
+        paths: Every CRL that should be linked.
+        changed: New content for some of them, by path. Other CRLs are only
+            read if they aren't linked yet.
+
+        Each link is replaced atomically, so a reader never finds it
+        missing. Links to anything that isn't in paths are removed, and each
+        issuer's suffixes are kept contiguous, since OpenSSL stops looking
+        at the first one missing.
+
+        """
+        os.makedirs(self.path, exist_ok=True)
+
+        links = {}  # type: Dict[str, str]
+        for name in os.listdir(self.path):
+            link_path = os.path.join(self.path, name)
+            if _HASHED_NAME.match(name) and os.path.islink(link_path):
+                links[name] = os.path.abspath(os.path.join(self.path, os.readlink(link_path)))
+
+        changed = {os.path.abspath(path): content for path, content in changed.items()}
+        current = {target: name for name, target in sorted(links.items(), reverse=True)}
+        updated = False
+
+        # The CRLs to link, grouped by issuer hash.
+        issuers = {}  # type: Dict[str, List[str]]
+        for path in _unique(map(os.path.abspath, paths)):
+            if path in changed:
+                prefix = _issuer_hash(changed[path])
+                updated = updated or (path in current)
+            elif (path in current) and os.path.exists(path):
+                prefix = current[path].partition('.')[0]
+            elif os.path.exists(path):
+                with open(path, 'rb') as f:
+                    prefix = _issuer_hash(f.read())
+            else:
+                continue
+            issuers.setdefault(prefix, []).append(path)
+
+        # CRLs that are already linked under a suffix that we still need
+        # keep it. The rest fill the gaps.
+        wanted = {}  # type: Dict[str, str]
+        for prefix, targets in issuers.items():
+            names = ['{}.r{}'.format(prefix, n) for n in range(len(targets))]
+            unplaced = []
+            for path in targets:
+                name = current.get(path)
+                if (name in names) and (name not in wanted):
+                    wanted[name] = path
+                else:
+                    unplaced.append(path)
+            free = [name for name in names if name not in wanted]
+            wanted.update(zip(free, unplaced))
+
+        for name, path in sorted(wanted.items()):
+            if links.get(name) != path:
+                _symlink(path, os.path.join(self.path, name))
+                updated = True
+
+        for name in sorted(set(links) - set(wanted)):
+            os.unlink(os.path.join(self.path, name))
+            updated = True
+
+        return updated
+
+
+def name_hash(name):
+    # type: (x509.Name) -> str
+    """
+    Returns the hash that OpenSSL uses for name in directory lookups.
+
+    This is X509_NAME_hash: the first four bytes (little-endian) of the SHA-1
+    of the name's canonical encoding. Canonically, strings are lowercased
+    UTF8Strings with whitespace trimmed and collapsed, and the outer
+    SEQUENCE is left off.
+
+    """
+    canon = b''
+    for rdn in name.chosen:
+        attributes = []
+        for attribute in rdn:
+            value = attribute['value']
+            if isinstance(value, core.Choice):
+                value = value.chosen
+            if isinstance(value, core.AbstractString):
+                text = _WHITESPACE.sub(' ', value.native).strip(' \t\n\v\f\r')
+                encoded = core.UTF8String(text.encode('utf-8').lower().decode('utf-8')).dump()
+            else:
+                encoded = value.dump()
+            attributes.append(_der(0x30, attribute['type'].dump() + encoded))
+        canon += _der(0x31, b''.join(sorted(attributes)))
+
+    return '{:08x}'.format(struct.unpack('<I', sha1(canon).digest()[:4])[0])
+
+
+#
+# Internal
+#
+
+_HASHED_NAME = re.compile(r'^[0-9a-f]{8}\.r[0-9]+$')
+
+_WHITESPACE = re.compile(r'[ \t\n\v\f\r]+')
+
+
+def _armor(content):
+    # type: (bytes) -> bytes
+    if not pem.detect(content):
+        content = pem.armor('X509 CRL', content)
+
+    return content
+
+
+def _load_crl(content):
+    # type: (bytes) -> crl.CertificateList
+    if pem.detect(content):
+        _, _, content = pem.unarmor(content)
+
+    return crl.CertificateList.load(content)
+
+
+def _issuer_hash(content):
+    # type: (bytes) -> str
+    return name_hash(_load_crl(content)['tbs_cert_list']['issuer'])
+
+
+def _unique(items):
+    # type: (Iterable[str]) -> List[str]
+    """ Drops repeated items, keeping the first of each. """
+    seen = set()  # type: Set[str]
+    unique = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            unique.append(item)
+
+    return unique
+
+
+def _symlink(target, path):
+    # type: (str, str) -> None
+    """ Replaces path with a link to target. """
+    tmp_path = os.path.join(os.path.dirname(path), '.{}.tmp'.format(os.path.basename(path)))
+    try:
+        os.unlink(tmp_path)
+    except OSError:
+        pass
+    os.symlink(target, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _der(tag, content):
+    # type: (int, bytes) -> bytes
+    length = len(content)
+    if length < 0x80:
+        header = bytes([tag, length])
+    else:
+        encoded = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+        header = bytes([tag, 0x80 | len(encoded)]) + encoded
+
+    return header + content
@@ -0,0 +1,215 @@
+"""
+Last-known-good API results for when the API is slow or unreachable.
+"""
+from hashlib import sha1
+import json
+import os
+import os.path
+import threading
+import time
+
+import requests
+from typing import Any, Callable, Dict, List  # noqa
+
+from cloak.serverapi.errors import ServerApiError
+from cloak.serverapi.utils.files import atomic_write, file_lock
+
+
+class LastKnownGood:
+    """
+    A local cache of API results, served when the API lets us down.
+
+    path: A directory to keep the cache in. It will be created if necessary.
+    deadline: How long (in seconds) to wait for the API before serving a
+        cached result. The request continues in the background and refreshes
+        the cache when it completes. None waits indefinitely.
+    failure_threshold: After this many consecutive failures, the circuit
+        breaker opens and the API is skipped entirely in favor of the cache.
+    cooldown: How long (in seconds) the circuit breaker stays open.
+
+    If nothing is cached for a request, we always wait for the API.
+
+    The cache can be shared by several processes (or containers) using the
+    same API; they share the circuit breaker too.
+
+    """
+    def __init__(self, path, deadline=None, failure_threshold=3, cooldown=300, clock=time.time):
+        # type: (str, float, int, float, Callable[[], float]) -> None
+        self.path = path
+        self.deadline = deadline
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._threads = []  # type: List[threading.Thread]
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def call(self, func, fallback):
+        # type: (Callable[[], Any], Callable[[], Any]) -> Any
+        """
+        Returns func(), or fallback() if the API is down or too slow.
+
+        func: Fetches a fresh result. This should call put() on success.
+        fallback: Builds a result from get(). If it raises KeyError, there is
+            nothing to fall back on and we'll wait for func().
+
+        """
+        if self.is_open():
+            try:
+                return fallback()
+            except KeyError:
+                pass
+
+        call = _Call(func, self)
+        call.start()
+        call.join(self.deadline)
+
+        if call.is_alive():
+            try:
+                result = fallback()
+            except KeyError:
+                call.join()
+            else:
+                with self._lock:
+                    self._threads.append(call)
+                return result
+
+        if call.error is not None:
+            if is_outage(call.error):
+                try:
+                    return fallback()
+                except KeyError:
+                    pass
+            raise call.error
+
+        return call.result
+
+    def wait(self, timeout=None):
+        # type: (float) -> None
+        """
+        Waits for any background revalidation to finish.
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+
+        for thread in threads:
+            thread.join(timeout)
+
+    #
+    # Storage
+    #
+
+    def get(self, key):
+        # type: (str) -> Any
+        """
+        Returns the cached result for key. Raises KeyError if there isn't one.
+        """
+        try:
+            with open(self._key_path(key), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            raise KeyError(key)
+
+    def put(self, key, result):
+        # type: (str, Any) -> None
+        atomic_write(self._key_path(key), json.dumps(result))
+
+    #
+    # Circuit breaker
+    #
+
+    def is_open(self):
+        # type: () -> bool
+        """
+        True if the circuit breaker is open and the API should be skipped.
+        """
+        return self._breaker().get('open_until', 0) > self.clock()
+
+    def record_success(self):
+        # type: () -> None
+        with self._lock, self._breaker_lock():
+            if self._breaker():
+                self._save_breaker({})
+
+    def record_failure(self):
+        # type: () -> None
+        with self._lock, self._breaker_lock():
+            state = self._breaker()
+            state['failures'] = state.get('failures', 0) + 1
+            if state['failures'] >= self.failure_threshold:
+                state['open_until'] = self.clock() + self.cooldown
+            self._save_breaker(state)
+
+    def _breaker_lock(self):
+        # type: () -> Any
+        """
+        Locks the breaker state against other processes sharing our path.
+        """
+        return file_lock(os.path.join(self.path, 'breaker.lock'))
+
+    def _breaker(self):
+        # type: () -> Dict[str, Any]
+        try:
+            with open(os.path.join(self.path, 'breaker.json'), 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = {}
+
+        return state
+
+    def _save_breaker(self, state):
+        # type: (Dict[str, Any]) -> None
+        atomic_write(os.path.join(self.path, 'breaker.json'), json.dumps(state))
+
+    def _key_path(self, key):
+        # type: (str) -> str
+        return os.path.join(self.path, sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def is_outage(error):
+    # type: (BaseException) -> bool
+    """
+    True if error means that the API is unavailable, as opposed to rejecting
+    our request.
+    """
+    if isinstance(error, ServerApiError):
+        status = error.response.status_code
+        outage = (status >= 500) or (status == 429)
+    else:
+        outage = isinstance(error, requests.RequestException)
+
+    return outage
+
+
+class _Call(threading.Thread):
+    """
+    Runs an API call and reports the outcome to the circuit breaker.
+
+    This is not a daemon thread: if we've served a cached result, the process
+    will wait for the revalidation to finish before exiting.
+
+    """
+    def __init__(self, func, lkg):
+        # type: (Callable[[], Any], LastKnownGood) -> None
+        super().__init__()
+
+        self.func = func
+        self.lkg = lkg
+        self.result = None  # type: Any
+        self.error = None  # type: BaseException
+
+    def run(self):
+        # type: () -> None
+        try:
+            self.result = self.func()
+        except BaseException as e:
+            self.error = e
+            if is_outage(e):
+                self.lkg.record_failure()
+            else:
+                self.lkg.record_success()
+        else:
+            self.lkg.record_success()
@@ -0,0 +1,85 @@
+"""
+Filesystem helpers.
+"""
+from contextlib import contextmanager
+import fcntl
+import os
+import os.path
+import stat
+import tempfile
+import threading
+
+from typing import Iterator, Optional, Union  # noqa
+
+
+def atomic_write(path, content, mode=None):
+    # type: (str, Union[str, bytes], Optional[int]) -> None
+    """
+    Replaces the file at path with content.
+
+    The content is written to a temporary file in the same directory and then
+    renamed over path, so readers will see either the old file or the new
+    one, never a partial write.
+
+    mode: The permissions of the new file. By default, an existing file
+        keeps its permissions and a new one gets what open() would give it.
+
+    """
+    file_mode = 'wb' if isinstance(content, bytes) else 'w'
+    dirname = os.path.dirname(os.path.abspath(path))
+
+    if mode is None:
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except OSError:
+            mode = 0o666 & ~_umask()
+
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, file_mode) as f:
+            f.write(content)
+            f.flush()
+            os.fchmod(f.fileno(), mode)
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    # type: (str, bool) -> Iterator[None]
+    """
+    Holds an advisory lock on path for the duration of a with block.
+
+    The lock file is created if necessary. Locks are shared with any process
+    that can see the same file, including other containers on the host.
+
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+#
+# Internal
+#
+
+_umask_lock = threading.Lock()
+
+
+def _umask():
+    # type: () -> int
+    """ The process's umask, which can only be read by setting it. """
+    with _umask_lock:
+        umask = os.umask(0o022)
+        os.umask(umask)
+
+    return umask
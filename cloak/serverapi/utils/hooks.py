@@ -0,0 +1,184 @@
+"""
+Running post-hooks.
+
+Commands like pki and crls run a hook (typically a VPN daemon reload) when
+they change something. A HookRunner runs these without a shell where
+possible, enforces a timeout and coalesces runs of the same hook, including
+runs requested by other processes sharing its state directory.
+
+"""
+from collections import namedtuple
+from hashlib import sha1
+import fcntl
+import json
+import os
+import os.path
+import shlex
+import signal
+import subprocess
+import time
+import uuid
+
+from typing import Any, Dict, List, Tuple  # noqa
+
+from cloak.serverapi.utils.files import atomic_write
+
+
+HookResult = namedtuple('HookResult', ['command', 'returncode', 'duration', 'timed_out'])
+
+# A hook that uses any of these needs a shell.
+SHELL_CHARS = frozenset('|&;<>()$`*?[]#~{}\n')
+
+
+class HookRunner:
+    """
+    Runs post-hook commands.
+
+    timeout: Seconds to let a hook run before killing it. None for no limit.
+    window: Seconds to wait for more requests to run the same hook before
+        running it. Requests that arrive while a hook is waiting or running
+        are coalesced into a single additional run.
+    state_dir: A directory for locks and statistics, shared by every process
+        whose hooks should be coalesced. Without it, every request runs the
+        hook immediately and no statistics are saved.
+
+    Statistics for each hook are saved to <state_dir>/hook-<hash>.json.
+
+    """
+    def __init__(self, timeout=None, window=0, state_dir=None, clock=time.time, sleep=time.sleep):
+        # type: (float, float, str, Any, Any) -> None
+        self.timeout = timeout
+        self.window = window
+        self.state_dir = state_dir
+        self.clock = clock
+        self.sleep = sleep
+
+        # Hooks run by this runner, in order.
+        self.results = []  # type: List[HookResult]
+
+    def run(self, command):
+        # type: (str) -> HookResult
+        """
+        Runs command, or arranges for it to be run.
+
+        Returns the result of the last run that this call performed. Returns
+        None if another process took over the request.
+
+        """
+        if self.state_dir is None:
+            return self._execute(command)
+
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+
+        prefix = os.path.join(self.state_dir, 'hook-{}'.format(
+            sha1(command.encode('utf-8')).hexdigest()[:16]
+        ))
+        self._write_token(prefix + '.pending')
+
+        # Whoever holds the lock runs the hook until no requests are
+        # outstanding. We check again after releasing the lock, in case a
+        # request came in just before we let go.
+        result = None  # type: HookResult
+        while self._outstanding(prefix):
+            with open(prefix + '.lock', 'a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    break
+
+                while self._outstanding(prefix):
+                    token, requested = self._read_token(prefix + '.pending')
+                    delay = requested + self.window - self.clock()
+                    if delay > 0:
+                        self.sleep(delay)
+                        continue
+
+                    result = self._execute(command)
+                    atomic_write(prefix + '.done', token)
+                    self._save_stats(prefix + '.json', result)
+
+        return result
+
+    #
+    # Internal
+    #
+
+    def _execute(self, command):
+        # type: (str) -> HookResult
+        if SHELL_CHARS.intersection(command):
+            args = command  # type: Any
+        else:
+            args = shlex.split(command)
+            if (not args) or ('=' in args[0]):
+                args = command
+        shell = not isinstance(args, list)
+
+        # The hook gets its own process group, so that a timeout can kill
+        # anything it started.
+        start = time.perf_counter()
+        try:
+            process = subprocess.Popen(args, shell=shell, start_new_session=True)
+        except OSError:
+            if shell:
+                raise
+            # Let the shell handle builtins and report missing programs.
+            process = subprocess.Popen(command, shell=True, start_new_session=True)
+        try:
+            returncode = process.wait(self.timeout)
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            process.wait()
+            result = HookResult(command, None, time.perf_counter() - start, True)
+        else:
+            result = HookResult(command, returncode, time.perf_counter() - start, False)
+
+        self.results.append(result)
+
+        return result
+
+    def _outstanding(self, prefix):
+        # type: (str) -> bool
+        pending, _ = self._read_token(prefix + '.pending')
+        done, _ = self._read_token(prefix + '.done')
+
+        return pending != done
+
+    def _write_token(self, path):
+        # type: (str) -> None
+        atomic_write(path, '{} {!r}'.format(uuid.uuid4().hex, self.clock()))
+
+    def _read_token(self, path):
+        # type: (str) -> Tuple[str, float]
+        """
+        Returns (token, time requested). Returns (None, 0) if there's no token.
+        """
+        try:
+            with open(path, 'r') as f:
+                token = f.read()
+        except IOError:
+            return (None, 0)
+
+        return (token, float(token.partition(' ')[2]))
+
+    def _save_stats(self, path, result):
+        # type: (str, HookResult) -> None
+        try:
+            with open(path, 'r') as f:
+                stats = json.load(f)  # type: Dict[str, Any]
+        except (IOError, ValueError):
+            stats = {'runs': 0}
+
+        stats.update({
+            'command': result.command,
+            'runs': stats.get('runs', 0) + 1,
+            'last_run': self.clock(),
+            'last_duration': result.duration,
+            'last_returncode': result.returncode,
+            'timed_out': result.timed_out,
+        })
+
+        atomic_write(path, json.dumps(stats, indent=2, sort_keys=True))
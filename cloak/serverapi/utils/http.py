@@ -3,22 +3,37 @@ A simple HTTP wrapper that manages standard headers and error responses.
 
 Most clients will want to include the 'auth' keyword argument with credentials.
 
+New code should create a Client, which owns its base URL, API version and
+connection pool and can be shared between threads. The module-level functions
+and globals are kept for compatibility and operate on default_client.
+
 """
 import os
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
 from six.moves import xrange
 from six.moves.urllib.parse import urljoin
-from typing import Any  # noqa
+from typing import Any, Dict, Set  # noqa
 
 from cloak.serverapi.errors import ServerApiError
+from cloak.serverapi.utils import codec
+from cloak.serverapi.utils.fallback import LastKnownGood  # noqa
+from cloak.serverapi.utils.profiling import Profiler  # noqa
+from cloak.serverapi.utils.ratelimit import RateLimiter  # noqa
+from cloak.serverapi.utils.sharedcache import SharedCache  # noqa
+from cloak.serverapi.utils.singleflight import SingleFlight
+
+
+DEFAULT_BASE_URL = 'https://app.encrypt.me/'
 
 
 session = requests.Session()
 
 
 # This can be overridden for test environments.
-base_url = 'https://app.encrypt.me/'
+base_url = DEFAULT_BASE_URL
 
 # Set this to send the X-Cloak-API-Version with every request. This can still
 # be overridden for individual requests.
@@ -29,37 +44,285 @@ if not container_version and os.path.isfile('/container-version-id'):
     container_version = open('/container-version-id', 'r').read().strip()
 
 
+class Client:
+    """
+    A connection to the server API.
+
+    base_url: The root URL of the Encrypt.me service.
+    api_version: Sent as X-Cloak-API-Version with every request unless a
+        request overrides it.
+    container_version: Sent as X-Cloak-Container-Version. Defaults to the
+        version detected from the environment.
+    session: A requests.Session to send requests through. By default, the
+        client creates its own with a connection pool of pool_size.
+    timeout: Default timeout (in seconds) for each request.
+    single_flight: If True, concurrent identical calls to get_json() are
+        collapsed into a single request and share the decoded result.
+    single_flight_ttl: With single_flight, the number of seconds that a
+        decoded result continues to be shared after the request completes.
+        Any POST drops the shared results.
+    fallback: An optional fallback.LastKnownGood. Server uses it to serve
+        cached results when the API is slow or unavailable.
+    rate_limiter: An optional ratelimit.RateLimiter. Requests wait for it,
+        and requests rejected with 429 or 503 are retried after Retry-After.
+    profiler: An optional profiling.Profiler to record the timing of each
+        request with.
+    shared_cache: An optional sharedcache.SharedCache. get_json() results
+        are shared through it with other processes (and other containers),
+        so that only one of them requests each resource per interval.
+
+    A client's configuration doesn't change after it's created, so a single
+    instance can be used from any number of threads.
+
+    """
+    fallback = None  # type: LastKnownGood
+    rate_limiter = None  # type: RateLimiter
+    profiler = None  # type: Profiler
+    shared_cache = None  # type: SharedCache
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, api_version=None,
+                 container_version=container_version, session=None,
+                 pool_size=10, timeout=None, single_flight=False,
+                 single_flight_ttl=0, fallback=None, rate_limiter=None,
+                 profiler=None, shared_cache=None):
+        # type: (str, str, str, requests.Session, int, float, bool, float, LastKnownGood, RateLimiter, Profiler, SharedCache) -> None
+        if session is None:
+            session = self._new_session(pool_size)
+        if single_flight:
+            self._flight = SingleFlight(single_flight_ttl)
+
+        self.base_url = base_url
+        self.api_version = api_version
+        self.container_version = container_version
+        self.session = session
+        self.timeout = timeout
+        self.fallback = fallback
+        self.rate_limiter = rate_limiter
+        self.profiler = profiler
+        self.shared_cache = shared_cache
+        self._shared_keys = set()  # type: Set[str]
+
+    def get(self, path, api_version=None, **kwargs):
+        # type: (str, str, **Any) -> requests.Response
+        return self._call('GET', path, api_version, **kwargs)
+
+    def post(self, path, api_version=None, **kwargs):
+        # type: (str, str, **Any) -> requests.Response
+        try:
+            return self._call('POST', path, api_version, **kwargs)
+        finally:
+            # The server state may have changed.
+            if self._flight is not None:
+                self._flight.clear()
+            for key in list(self._shared_keys):
+                self.shared_cache.forget(key)
+
+    def get_json(self, path, api_version=None, **kwargs):
+        # type: (str, str, **Any) -> Any
+        """
+        GETs a resource and returns the decoded result. This is usually JSON,
+        but MessagePack can be asked for with an Accept header.
+
+        With single_flight enabled, the result may be shared with other
+        callers and must not be modified.
+
+        """
+        key = self._flight_key(path, api_version, kwargs)
+        if key is None:
+            result = self._get_decoded(path, api_version, kwargs)
+        else:
+            result = self._flight.do(
+                key, lambda: self._get_decoded(path, api_version, kwargs)
+            )
+
+        return result
+
+    #
+    # Internal
+    #
+
+    _flight = None  # type: SingleFlight
+    _shared_keys = frozenset()  # type: Set[str]
+
+    # Requests with any other arguments are never coalesced.
+    _FLIGHT_KWARGS = frozenset(['params', 'headers', 'auth'])
+
+    def _call(self, method, path, api_version=None, **kwargs):
+        # type: (str, str, str, **Any) -> requests.Response
+        url = urljoin(self.base_url, '/api/server/')
+        url = urljoin(url, path)
+
+        # Copy the headers so that we never modify the caller's dict.
+        headers = kwargs['headers'] = dict(kwargs.get('headers') or {})
+        if api_version is not None:
+            headers['X-Cloak-API-Version'] = api_version
+        elif self.api_version is not None:
+            headers['X-Cloak-API-Version'] = self.api_version
+        if self.container_version:
+            headers['X-Cloak-Container-Version'] = self.container_version
+
+        if self.timeout is not None:
+            kwargs.setdefault('timeout', self.timeout)
+
+        attempt = 0
+        while True:
+            response = self._send(method, url, **kwargs)
+            delay = self._retry_delay(response, attempt)
+            if delay is None:
+                break
+            self.rate_limiter.defer(delay)
+            attempt += 1
+
+        if response.status_code not in xrange(200, 400):
+            raise ServerApiError(response)
+
+        return response
+
+    def _send(self, method, url, **kwargs):
+        # type: (str, str, **Any) -> requests.Response
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        if self.profiler is None:
+            return self._request(method, url, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            response = self._request(method, url, **kwargs)
+        except Exception as e:
+            self.profiler.record_http(method, url, type(e).__name__, time.perf_counter() - start)
+            raise
+        self.profiler.record_http(method, url, response.status_code, time.perf_counter() - start)
+
+        return response
+
+    def _request(self, method, url, **kwargs):
+        # type: (str, str, **Any) -> requests.Response
+        if method == 'GET':
+            response = self.session.get(url, **kwargs)
+        elif method == 'POST':
+            response = self.session.post(url, **kwargs)
+        else:
+            raise NotImplementedError()
+
+        return response
+
+    # Responses that mean we should slow down and try again.
+    RETRY_STATUSES = frozenset([429, 503])
+
+    def _retry_delay(self, response, attempt):
+        # type: (requests.Response, int) -> float
+        """
+        Returns how long to wait before retrying, or None to give up.
+        """
+        if (self.rate_limiter is None) or (response.status_code not in self.RETRY_STATUSES):
+            return None
+
+        return self.rate_limiter.retry_delay(attempt, response.headers.get('Retry-After'))
+
+    def _get_decoded(self, path, api_version, kwargs):
+        # type: (str, str, Dict[str, Any]) -> Any
+        key = self._request_key(path, api_version, kwargs)
+        if (self.shared_cache is None) or (key is None):
+            return decode(self.get(path, api_version, **kwargs))
+
+        def fetch(meta):
+            response = self.get(path, api_version, **kwargs)
+            return (response.content, {'content_type': response.headers.get('Content-Type')})
+
+        key = ' '.join([self.base_url, key])
+        self._shared_keys.add(key)
+        content, meta = self.shared_cache.fetch(key, fetch)
+
+        return codec.decode(content, meta.get('content_type'))
+
+    def _flight_key(self, path, api_version, kwargs):
+        # type: (str, str, Dict[str, Any]) -> str
+        """
+        Returns a key identifying a GET request for single-flight purposes.
+
+        Returns None if the request should not be coalesced.
+
+        """
+        if self._flight is None:
+            return None
+
+        return self._request_key(path, api_version, kwargs)
+
+    def _request_key(self, path, api_version, kwargs):
+        # type: (str, str, Dict[str, Any]) -> str
+        """
+        Returns a key identifying a GET request's result, or None if it
+        shouldn't be shared.
+        """
+        if not self._FLIGHT_KWARGS.issuperset(kwargs):
+            return None
+
+        return repr((
+            path,
+            api_version,
+            kwargs.get('auth'),
+            sorted((kwargs.get('params') or {}).items()),
+            sorted((kwargs.get('headers') or {}).items()),
+        ))
+
+    @staticmethod
+    def _new_session(pool_size):
+        # type: (int) -> requests.Session
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        return session
+
+
+class _ModuleClient(Client):
+    """
+    The default client, configured by this module's globals.
+    """
+    def __init__(self):
+        # type: () -> None
+        self.timeout = None
+
+    @property
+    def base_url(self):
+        return base_url
+
+    @property
+    def api_version(self):
+        return default_api_version
+
+    @property
+    def container_version(self):
+        return container_version
+
+    @property
+    def session(self):
+        return session
+
+
+default_client = _ModuleClient()  # type: Client
+
+
+def decode(response):
+    # type: (requests.Response) -> Any
+    """ Decodes a response body according to its Content-Type. """
+    return codec.decode(response.content, response.headers.get('Content-Type'))
+
+
 def get(path, api_version=None, **kwargs):
     # type: (str, str, **Any) -> requests.Response
-    return _call('GET', path, api_version, **kwargs)
+    return default_client.get(path, api_version, **kwargs)
 
 
 def post(path, api_version=None, **kwargs):
     # type: (str, str, **Any) -> requests.Response
-    return _call('POST', path, api_version, **kwargs)
+    return default_client.post(path, api_version, **kwargs)
 
 
 def _call(method, path, api_version=None, **kwargs):
     # type: (str, str, str, **Any) -> requests.Response
-    url = urljoin(base_url, '/api/server/')
-    url = urljoin(url, path)
-
-    headers = kwargs.setdefault('headers', {})
-    if api_version is not None:
-        headers['X-Cloak-API-Version'] = api_version
-    elif default_api_version is not None:
-        headers['X-Cloak-API-Version'] = default_api_version
-    if container_version:
-        headers['X-Cloak-Container-Version'] = container_version
-
-    if method == 'GET':
-        response = session.get(url, **kwargs)
-    elif method == 'POST':
-        response = session.post(url, **kwargs)
-    else:
-        raise NotImplementedError()
-
-    if response.status_code not in xrange(200, 400):
-        raise ServerApiError(response)
-
-    return response
+    return default_client._call(method, path, api_version, **kwargs)
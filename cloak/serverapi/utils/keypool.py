@@ -0,0 +1,97 @@
+"""
+Private keys, generated ahead of time.
+"""
+import os
+import os.path
+import uuid
+
+from oscrypto import asymmetric
+from typing import Dict, Optional, Tuple  # noqa
+
+from cloak.serverapi.utils.files import atomic_write
+
+
+# Key types that we can generate, with the arguments for generate_pair().
+KEY_TYPES = {
+    'rsa': ('rsa', {'bit_size': 2048}),
+    'ec-p256': ('ec', {'curve': 'secp256r1'}),
+    'ec-p384': ('ec', {'curve': 'secp384r1'}),
+}  # type: Dict[str, Tuple[str, Dict[str, object]]]
+
+
+def generate_key(key_type):
+    # type: (str) -> bytes
+    """
+    Returns a new PEM-encoded private key of one of the KEY_TYPES.
+    """
+    algorithm, kwargs = KEY_TYPES[key_type]
+    _, privkey = asymmetric.generate_pair(algorithm, **kwargs)
+
+    return asymmetric.dump_private_key(privkey, None, 'pem')
+
+
+class KeyPool:
+    """
+    A directory of pregenerated private keys.
+
+    path: The pool. Keys of each type are kept in a subdirectory, readable
+        only by us. It's created if necessary.
+    size: How many keys of each type fill() keeps on hand.
+
+    Any number of processes can take keys from the same pool; each key is
+    only handed out once.
+
+    """
+    def __init__(self, path, size=2):
+        # type: (str, int) -> None
+        self.path = path
+        self.size = size
+
+    def take(self, key_type):
+        # type: (str) -> Optional[bytes]
+        """
+        Removes a key from the pool and returns it, or None if it's empty.
+        """
+        dirname = self._dirname(key_type)
+        try:
+            names = sorted(name for name in os.listdir(dirname) if name.endswith('.pem'))
+        except OSError:
+            names = []
+
+        for name in names:
+            claimed = os.path.join(dirname, '.{}.claimed'.format(name))
+            try:
+                os.rename(os.path.join(dirname, name), claimed)
+            except OSError:
+                # Someone else got it first.
+                continue
+
+            try:
+                with open(claimed, 'rb') as f:
+                    return f.read()
+            finally:
+                os.unlink(claimed)
+
+        return None
+
+    def fill(self, key_type):
+        # type: (str) -> int
+        """
+        Generates keys until there are self.size of them. Returns the number
+        generated.
+        """
+        dirname = self._dirname(key_type)
+        os.makedirs(dirname, 0o700, exist_ok=True)
+
+        count = len([name for name in os.listdir(dirname) if name.endswith('.pem')])
+        for i in range(self.size - count):
+            atomic_write(os.path.join(dirname, '{}.pem'.format(uuid.uuid4().hex)), generate_key(key_type), mode=0o600)
+
+        return max(self.size - count, 0)
+
+    def _dirname(self, key_type):
+        # type: (str) -> str
+        if key_type not in KEY_TYPES:
+            raise ValueError(key_type)
+
+        return os.path.join(self.path, key_type)
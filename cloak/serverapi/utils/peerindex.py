@@ -0,0 +1,293 @@
+"""
+An on-disk index of WireGuard peers by public key and allowed IP.
+
+The index doubles as a snapshot of the peers for other local processes,
+which can map it and read it in place rather than parsing JSON. It's made of
+fixed-size little-endian records, one section after another:
+
+    header: magic (4s), version (H), padding (2x), peer count (I), address
+        count (I), table count (I)
+    table directory, one per table: family (B), prefix length (B), padding
+        (2x), entry count (I), offset of the table from the start (I)
+    peers, sorted by key: public key (32s), index of the first address (I),
+        address count (I)
+    addresses, each peer's in order: family (B), prefix length (B), network
+        address (16s, with IPv4 in the first four bytes)
+    tables, longest prefix first: network address (4 or 16 bytes) and
+        peer index (I) for each entry, sorted by address
+
+Readers should reject a file whose magic or version they don't know. The
+file is always replaced atomically, so a reader that has it open keeps a
+consistent snapshot.
+
+"""
+from base64 import b64decode, b64encode
+import ipaddress
+import mmap
+import struct
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union  # noqa
+
+from cloak.serverapi.utils.cidr import format_network, parse_network
+from cloak.serverapi.utils.files import atomic_write
+
+
+MAGIC = b'CWGI'
+VERSION = 2
+
+KEY_SIZE = 32
+
+_HEADER = struct.Struct('<4sHxxIII')
+_TABLE = struct.Struct('<BBxxII')
+_PEER = struct.Struct('<{}sII'.format(KEY_SIZE))
+_ADDRESS = struct.Struct('<BB16s')
+
+
+def build_index(peers):
+    # type: (Iterable[Dict[str, Any]]) -> bytes
+    """
+    Returns the index of a list of peers, as from Server.wireguard_peers().
+    """
+    records = sorted(
+        (_decode_key(peer['public_key']), [parse_network(value) for value in peer.get('allowed_ips', [])])
+        for peer in peers
+    )
+
+    peer_records = []
+    address_records = []
+    # (family, prefix length) -> {network: peer}
+    tables = {}  # type: Dict[Tuple[int, int], Dict[bytes, int]]
+    for i, (key, networks) in enumerate(records):
+        peer_records.append(_PEER.pack(key, len(address_records), len(networks)))
+        for family, prefixlen, network in networks:
+            address_records.append(_ADDRESS.pack(family, prefixlen, network))
+            tables.setdefault((family, prefixlen), {}).setdefault(network, i)
+
+    # Longest prefixes first, which is the order that we search them.
+    layout = sorted(tables, key=lambda table: (table[0], -table[1]))
+    offset = (
+        _HEADER.size + _TABLE.size * len(layout) +
+        _PEER.size * len(peer_records) + _ADDRESS.size * len(address_records)
+    )
+    directory = []
+    chunks = []
+    for family, prefixlen in layout:
+        entries = sorted(tables[(family, prefixlen)].items())
+        directory.append(_TABLE.pack(family, prefixlen, len(entries), offset))
+        chunk = b''.join(network + struct.pack('<I', peer) for network, peer in entries)
+        chunks.append(chunk)
+        offset += len(chunk)
+
+    header = _HEADER.pack(MAGIC, VERSION, len(peer_records), len(address_records), len(layout))
+
+    return b''.join([header] + directory + peer_records + address_records + chunks)
+
+
+def write_index(path, peers):
+    # type: (str, Iterable[Dict[str, Any]]) -> bool
+    """
+    Writes the index of peers to path if it's changed. Returns True if it
+    was written.
+
+    The index is world-readable, so that processes running as other users
+    can map it.
+
+    """
+    content = build_index(peers)
+
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == content:
+                return False
+    except IOError:
+        pass
+
+    atomic_write(path, content, mode=0o644)
+
+    return True
+
+
+class PeerIndex:
+    """
+    Reads an index written by write_index().
+
+    The index is memory-mapped, so a lookup only reads the few pages that it
+    needs. Use it as a context manager or call close().
+
+    Peers are numbered from 0 to len() - 1 in order of their keys. key() and
+    networks() return views into the mapping rather than copies; the rest
+    return dicts with 'public_key' and 'allowed_ips', like the API's.
+
+    """
+    def __init__(self, path):
+        # type: (str) -> None
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+        try:
+            magic, version, self._peer_count, address_count, table_count = _HEADER.unpack_from(self._map, 0)
+        except struct.error:
+            magic, version = None, None
+        if (magic != MAGIC) or (version != VERSION):
+            self.close()
+            raise ValueError("{} isn't a peer index we can read.".format(path))
+
+        self._tables = [
+            _TABLE.unpack_from(self._map, _HEADER.size + _TABLE.size * i)
+            for i in range(table_count)
+        ]  # type: List[Tuple[int, int, int, int]]
+
+        self._peers_offset = _HEADER.size + _TABLE.size * table_count
+        self._addresses_offset = self._peers_offset + _PEER.size * self._peer_count
+
+    def __len__(self):
+        # type: () -> int
+        return self._peer_count
+
+    def __iter__(self):
+        # type: () -> Iterator[Dict[str, Any]]
+        for i in range(self._peer_count):
+            yield self.peer(i)
+
+    def key(self, i):
+        # type: (int) -> memoryview
+        """ The raw public key of peer i. """
+        offset = self._peer_offset(i)
+
+        return self._view[offset:offset + KEY_SIZE]
+
+    def networks(self, i):
+        # type: (int) -> List[Tuple[int, int, memoryview]]
+        """
+        The allowed IPs of peer i as (family, prefix length, packed network
+        address).
+        """
+        first, count = struct.unpack_from('<II', self._map, self._peer_offset(i) + KEY_SIZE)
+
+        networks = []
+        for n in range(first, first + count):
+            offset = self._addresses_offset + _ADDRESS.size * n
+            family, prefixlen = self._map[offset], self._map[offset + 1]
+            networks.append((family, prefixlen, self._view[offset + 2:offset + 2 + _address_size(family)]))
+
+        return networks
+
+    def peer(self, i):
+        # type: (int) -> Dict[str, Any]
+        return {
+            'public_key': b64encode(self.key(i)).decode('ascii'),
+            'allowed_ips': [
+                format_network(family, prefixlen, bytes(network))
+                for family, prefixlen, network in self.networks(i)
+            ],
+        }
+
+    def find_key(self, public_key):
+        # type: (str) -> Optional[Dict[str, Any]]
+        """
+        Returns the peer with a base64-encoded public key, or None.
+
+        Raises ValueError if public_key isn't a valid key.
+
+        """
+        key = _decode_key(public_key)
+
+        lo, hi = 0, self._peer_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = self._peer_offset(mid)
+            found = self._map[offset:offset + KEY_SIZE]
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return self.peer(mid)
+
+        return None
+
+    def find_ip(self, address):
+        # type: (Union[str, ipaddress.IPv4Address, ipaddress.IPv6Address]) -> Optional[Dict[str, Any]]
+        """
+        Returns the peer whose allowed IPs have the longest prefix matching
+        address, or None. The peer has the matching prefix in 'match'.
+        """
+        address = ipaddress.ip_address(address)
+        size = _address_size(address.version)
+        value = int(address)
+
+        for family, prefixlen, count, offset in self._tables:
+            if family != address.version:
+                continue
+
+            mask = ((1 << prefixlen) - 1) << (size * 8 - prefixlen)
+            network = (value & mask).to_bytes(size, 'big')
+            peer = self._search(network, count, offset, size + 4)
+            if peer is not None:
+                result = self.peer(peer)
+                result['match'] = format_network(family, prefixlen, network)
+                return result
+
+        return None
+
+    def close(self):
+        # type: () -> None
+        """
+        Unmaps the index. If views from key() or networks() are still
+        around, that waits until they're gone.
+        """
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        # type: () -> PeerIndex
+        return self
+
+    def __exit__(self, *exc_info):
+        # type: (*Any) -> None
+        self.close()
+
+    #
+    # Internal
+    #
+
+    def _peer_offset(self, i):
+        # type: (int) -> int
+        if not (0 <= i < self._peer_count):
+            raise IndexError(i)
+
+        return self._peers_offset + _PEER.size * i
+
+    def _search(self, network, count, offset, entry_size):
+        # type: (bytes, int, int, int) -> Optional[int]
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = offset + entry_size * mid
+            found = self._map[start:start + len(network)]
+            if found < network:
+                lo = mid + 1
+            elif found > network:
+                hi = mid
+            else:
+                return struct.unpack_from('<I', self._map, start + len(network))[0]
+
+        return None
+
+
+def _decode_key(public_key):
+    # type: (str) -> bytes
+    key = b64decode(public_key, validate=True)
+    if len(key) != KEY_SIZE:
+        raise ValueError("{} isn't a WireGuard key.".format(public_key))
+
+    return key
+
+
+def _address_size(family):
+    # type: (int) -> int
+    return 4 if (family == 4) else 16
@@ -0,0 +1,203 @@
+"""
+WireGuard peer statistics, collected locally and uploaded in batches.
+"""
+import os
+import os.path
+import time
+
+from typing import Any, Callable, Dict, List, Optional, Tuple  # noqa
+
+from cloak.serverapi.utils import codec
+from cloak.serverapi.utils.files import atomic_write, file_lock
+
+
+# A peer's latest handshake (a Unix time, or 0 for none) and bytes received
+# and sent.
+Sample = Tuple[int, int, int]
+
+# The longest we'll put off uploading after failures, in seconds.
+MAX_BACKOFF = 3600
+
+
+def parse_dump(text):
+    # type: (str) -> Dict[str, Sample]
+    """
+    Parses the output of `wg show <interface> dump` or `wg show all dump`.
+
+    Returns a sample for each peer by public key. Interface lines are
+    skipped.
+
+    """
+    samples = {}  # type: Dict[str, Sample]
+    for line in text.splitlines():
+        fields = line.split('\t')
+        if len(fields) == 9:
+            fields = fields[1:]
+        if len(fields) != 8:
+            continue
+
+        public_key, _, _, _, handshake, rx, tx, _ = fields
+        try:
+            samples[public_key] = (int(handshake), int(rx), int(tx))
+        except ValueError:
+            raise ValueError("Unexpected line in wg dump: {}".format(line))
+
+    return samples
+
+
+class StatsSpool:
+    """
+    Peer statistics waiting to be uploaded.
+
+    path: A directory for our state. It will be created if necessary.
+    max_batches: The most batches to keep. When there are more, the oldest
+        ones are merged, so an API outage costs resolution rather than data
+        or disk space.
+    clock: Returns the current time.
+
+    Each call to collect() adds a batch with the traffic of each peer since
+    the last one. Batches are kept until the caller uploads them and calls
+    uploaded(), or calls failed() to back off. Only one process uses the
+    spool at a time.
+
+    """
+    def __init__(self, path, max_batches=24, clock=time.time):
+        # type: (str, int, Callable[[], float]) -> None
+        self.path = path
+        self.max_batches = max_batches
+        self.clock = clock
+
+        os.makedirs(path, exist_ok=True)
+
+    def collect(self, samples):
+        # type: (Dict[str, Sample]) -> int
+        """
+        Records the changes since the last samples. Returns the number of
+        peers with any.
+
+        The first samples are only a baseline. A counter that goes down
+        means that the interface was reset, so all of it is new.
+
+        """
+        with self._locked() as state:
+            now = int(self.clock())
+            counters = state.get('counters')
+            peers = {}  # type: Dict[str, List[int]]
+
+            if counters is not None:
+                for public_key, (handshake, rx, tx) in samples.items():
+                    last_handshake, last_rx, last_tx = counters.get(public_key, (0, 0, 0))
+                    rx_delta = (rx - last_rx) if (rx >= last_rx) else rx
+                    tx_delta = (tx - last_tx) if (tx >= last_tx) else tx
+                    if rx_delta or tx_delta or (handshake != last_handshake):
+                        peers[public_key] = [handshake, rx_delta, tx_delta]
+
+                batches = state.setdefault('batches', [])
+                batches.append({'start': state.get('collected', now), 'end': now, 'peers': peers})
+                while len(batches) > max(self.max_batches, 1):
+                    batches[:2] = [_merge(batches[0], batches[1])]
+
+            state['counters'] = {public_key: list(sample) for public_key, sample in samples.items()}
+            state['collected'] = now
+
+        return len(peers)
+
+    @property
+    def batches(self):
+        # type: () -> List[Dict[str, Any]]
+        """
+        The batches waiting to be uploaded, oldest first. Each has the start
+        and end times that it covers, and the latest handshake and bytes
+        received and sent for each peer with any changes.
+        """
+        return self._load().get('batches', [])
+
+    def due(self, interval):
+        # type: (float) -> bool
+        """
+        True if the oldest batch is at least interval seconds old and we're
+        not backing off.
+        """
+        state = self._load()
+        batches = state.get('batches')
+        now = self.clock()
+
+        return bool(batches) and (now >= batches[0]['start'] + interval) and (now >= state.get('retry_at', 0))
+
+    def uploaded(self, count):
+        # type: (int) -> None
+        """ Drops the oldest count batches, which the API has accepted. """
+        with self._locked() as state:
+            del state.get('batches', [])[:count]
+            state.pop('retry_at', None)
+            state.pop('failures', None)
+
+    def failed(self, interval, retry_after=None):
+        # type: (float, Optional[float]) -> float
+        """
+        Puts off the next upload after a failure. Returns the delay, which is
+        retry_after if the API asked for one and otherwise doubles from
+        interval with each failure.
+        """
+        with self._locked() as state:
+            failures = state.get('failures', 0) + 1
+            if retry_after is None:
+                retry_after = min(interval * (2 ** (failures - 1)), MAX_BACKOFF)
+            state['failures'] = failures
+            state['retry_at'] = self.clock() + retry_after
+
+        return retry_after
+
+    #
+    # Internal
+    #
+
+    def _state_path(self):
+        # type: () -> str
+        return os.path.join(self.path, 'state.json')
+
+    def _load(self):
+        # type: () -> Dict[str, Any]
+        try:
+            with open(self._state_path(), 'rb') as f:
+                return codec.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def _locked(self):
+        # type: () -> _LockedState
+        return _LockedState(self)
+
+
+class _LockedState:
+    """ Loads the state and saves it again, holding the lock in between. """
+    def __init__(self, spool):
+        # type: (StatsSpool) -> None
+        self.spool = spool
+        self.lock = file_lock(os.path.join(spool.path, 'lock'))
+
+    def __enter__(self):
+        # type: () -> Dict[str, Any]
+        self.lock.__enter__()
+        self.state = self.spool._load()
+
+        return self.state
+
+    def __exit__(self, *exc_info):
+        # type: (*Any) -> None
+        try:
+            if exc_info[0] is None:
+                atomic_write(self.spool._state_path(), codec.dumps_compact(self.state))
+        finally:
+            self.lock.__exit__(*exc_info)
+
+
+def _merge(older, newer):
+    # type: (Dict[str, Any], Dict[str, Any]) -> Dict[str, Any]
+    """ Combines two consecutive batches. """
+    peers = {public_key: list(values) for public_key, values in older['peers'].items()}
+    for public_key, (handshake, rx, tx) in newer['peers'].items():
+        _, old_rx, old_tx = peers.get(public_key, (0, 0, 0))
+        peers[public_key] = [handshake, old_rx + rx, old_tx + tx]
+
+    return {'start': older['start'], 'end': newer['end'], 'peers': peers}
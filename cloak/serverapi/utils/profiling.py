@@ -0,0 +1,159 @@
+"""
+Profiling for CLI commands in the field.
+
+A Profiler wraps a block of code with cProfile and tracemalloc and writes the
+results to a directory when the block exits, whether or not it succeeded. If
+it's also given to an http.Client, it records the timing of each request.
+
+"""
+import cProfile
+import datetime
+import os
+import os.path
+import time
+import tracemalloc
+
+from typing import Any, List, Tuple  # noqa
+
+
+class Profiler:
+    """
+    Collects a CPU profile, allocation statistics and HTTP timings.
+
+    path: The directory to write reports to. It's created if necessary.
+    name: A prefix for the report file names, such as the command name.
+    top: The number of allocation sites to report.
+    http: If True, also write the timing of each recorded HTTP request.
+
+    Each run writes <name>-<timestamp>-<pid>.pstats (for the pstats module or
+    any compatible viewer), a matching -alloc.txt with the peak traced memory
+    and the lines whose allocations during the run were still live at the
+    end, and, with http, a matching -http.txt.
+
+    """
+    def __init__(self, path, name='cloak-server', top=25, http=False, clock=time.perf_counter):
+        # type: (str, str, int, bool, Any) -> None
+        self.path = path
+        self.name = name
+        self.top = top
+        self.http = http
+        self.clock = clock
+
+        # Reports written by the last run.
+        self.paths = []  # type: List[str]
+
+        # (method, url, status, seconds)
+        self.requests = []  # type: List[Tuple[str, str, Any, float]]
+
+        self._profile = None  # type: cProfile.Profile
+        self._started = None  # type: float
+        self._baseline = None  # type: tracemalloc.Snapshot
+        self._was_tracing = False
+
+    def __enter__(self):
+        # type: () -> Profiler
+        self.start()
+
+        return self
+
+    def __exit__(self, *exc_info):
+        # type: (*Any) -> None
+        self.stop()
+
+    def start(self):
+        # type: () -> None
+        self.requests = []
+        self._started = self.clock()
+
+        # Someone else may be tracing already, e.g. with PYTHONTRACEMALLOC.
+        self._was_tracing = tracemalloc.is_tracing()
+        if not self._was_tracing:
+            tracemalloc.start()
+        self._baseline = tracemalloc.take_snapshot()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self):
+        # type: () -> List[str]
+        """
+        Stops profiling and writes the reports. Returns their paths.
+        """
+        self._profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if not self._was_tracing:
+            tracemalloc.stop()
+        elapsed = self.clock() - self._started
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        prefix = os.path.join(self.path, '{}-{}-{}'.format(
+            self.name, datetime.datetime.now().strftime('%Y%m%dT%H%M%S'), os.getpid()
+        ))
+
+        self.paths = [prefix + '.pstats', prefix + '-alloc.txt']
+        self._profile.dump_stats(self.paths[0])
+        self._write_allocations(self.paths[1], snapshot, peak, elapsed)
+
+        if self.http:
+            self.paths.append(prefix + '-http.txt')
+            self._write_requests(self.paths[2])
+
+        return self.paths
+
+    def record_http(self, method, url, status, seconds):
+        # type: (str, str, Any, float) -> None
+        """
+        Records one HTTP request. status may be an exception name.
+        """
+        self.requests.append((method, url, status, seconds))
+
+    #
+    # Internal
+    #
+
+    def _write_allocations(self, path, snapshot, peak, elapsed):
+        # type: (str, tracemalloc.Snapshot, int, float) -> None
+        """
+        Reports the peak, and the memory allocated since start() that's
+        still live, by line. Memory that was allocated and freed during the
+        run only shows up in the peak.
+        """
+        filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+        baseline = self._baseline.filter_traces(filters)
+        stats = [
+            stat for stat in snapshot.filter_traces(filters).compare_to(baseline, 'lineno')
+            if stat.size_diff > 0
+        ]
+
+        with open(path, 'w') as f:
+            print("Wall time: {:.3f}s".format(elapsed), file=f)
+            print("Peak traced memory: {} KiB".format(peak // 1024), file=f)
+            print("Allocated and still live at the end: {} KiB in {} blocks".format(
+                sum(stat.size_diff for stat in stats) // 1024,
+                sum(max(stat.count_diff, 0) for stat in stats),
+            ), file=f)
+            print("", file=f)
+            print("Top {} lines by memory still live at the end:".format(self.top), file=f)
+            for stat in stats[:self.top]:
+                frame = stat.traceback[0]
+                print("{:>10} KiB {:>8} blocks  {}:{}".format(
+                    stat.size_diff // 1024, stat.count_diff, frame.filename, frame.lineno
+                ), file=f)
+
+    def _write_requests(self, path):
+        # type: (str) -> None
+        total = sum(seconds for _, _, _, seconds in self.requests)
+
+        with open(path, 'w') as f:
+            print("{} requests in {:.3f}s".format(len(self.requests), total), file=f)
+            print("", file=f)
+            for method, url, status, seconds in self.requests:
+                print("{:>8.1f} ms  {:<4} {:<3} {}".format(
+                    seconds * 1000, method, status, url
+                ), file=f)
@@ -0,0 +1,142 @@
+"""
+Client-side rate limiting.
+"""
+from email.utils import mktime_tz, parsedate_tz
+from hashlib import sha256
+import threading
+import time
+
+from typing import Callable  # noqa
+
+
+class RateLimiter:
+    """
+    A token bucket that also honors Retry-After from the API.
+
+    rate: Requests per second, on average.
+    burst: The number of requests that can be made back to back.
+    max_retries: How many times a request will be retried after a 429 or 503
+        response.
+    max_wait: The longest we'll wait before a retry. If the API asks us to
+        wait longer than this, the error is reported instead.
+
+    A single limiter can be shared by any number of threads.
+
+    """
+    def __init__(self, rate=10, burst=10, max_retries=3, max_wait=60,
+                 clock=time.monotonic, sleep=time.sleep):
+        # type: (float, int, int, float, Callable[[], float], Callable[[float], None]) -> None
+        if rate <= 0:
+            raise ValueError("rate must be positive, not {}".format(rate))
+
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.clock = clock
+        self.sleep = sleep
+
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._blocked_until = 0.0
+
+    def acquire(self):
+        # type: () -> None
+        """
+        Waits until we're allowed to send a request.
+        """
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._refill(now)
+
+                if now < self._blocked_until:
+                    delay = self._blocked_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    delay = 0
+                else:
+                    delay = (1 - self._tokens) / self.rate
+
+            if delay <= 0:
+                break
+
+            self.sleep(delay)
+
+    def defer(self, seconds):
+        # type: (float) -> None
+        """
+        Holds all requests for the given number of seconds.
+        """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, self.clock() + seconds)
+
+    def retry_delay(self, attempt, retry_after):
+        # type: (int, str) -> float
+        """
+        Returns how long to wait before retrying a rejected request.
+
+        attempt: The number of retries so far.
+        retry_after: The Retry-After header from the response, if any.
+
+        Returns None if the request should not be retried.
+
+        """
+        if attempt >= self.max_retries:
+            return None
+
+        delay = parse_retry_after(retry_after)
+        if delay is None:
+            delay = float(2 ** attempt)
+        if delay > self.max_wait:
+            delay = None
+
+        return delay
+
+    def _refill(self, now):
+        # type: (float) -> None
+        elapsed = max(now - self._updated, 0)
+        self._tokens = min(self._tokens + elapsed * self.rate, float(self.burst))
+        self._updated = now
+
+
+def parse_retry_after(value, now=None):
+    # type: (str, float) -> float
+    """
+    Returns the number of seconds requested by a Retry-After header.
+
+    The header may hold either a number of seconds or an HTTP date. Returns
+    None if value is missing or invalid.
+
+    """
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+
+    if now is None:
+        now = time.time()
+
+    return max(mktime_tz(parsed) - now, 0.0)
+
+
+def jitter(server_id, window):
+    # type: (str, float) -> float
+    """
+    Returns a delay between 0 and window that is fixed for server_id.
+
+    Scheduled work that waits this long first is spread evenly across a
+    fleet, but each server keeps a predictable schedule.
+
+    """
+    digest = sha256(server_id.encode('utf-8')).digest()
+    fraction = int.from_bytes(digest[:8], 'big') / float(2 ** 64)
+
+    return fraction * window
@@ -0,0 +1,179 @@
+"""
+A download cache that can be shared between processes and containers.
+"""
+from hashlib import sha256
+import json
+import os
+import os.path
+import time
+
+from typing import Any, Callable, Dict, Tuple  # noqa
+
+from cloak.serverapi.utils.files import atomic_write, file_lock
+
+
+class SharedCache:
+    """
+    Downloads that are refreshed at most once per ttl by all of their users.
+
+    path: A directory shared by every process (typically one per container)
+        that should reuse each other's downloads. It will be created if
+        necessary.
+    ttl: How long (in seconds) a download is used before it's refreshed.
+
+    Content is stored by its SHA-256 digest under objects/, so identical
+    content is only stored once. Each key has a small JSON ref under refs/
+    with the digest and any metadata (such as an ETag) needed to refresh it.
+    Keys are only stored as hashes, so they may contain credentials.
+
+    """
+    def __init__(self, path, ttl=60, clock=time.time):
+        # type: (str, float, Callable[[], float]) -> None
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+
+        # True if we've stored any new content.
+        self.written = False
+
+        for name in ['objects', 'refs', 'locks']:
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+
+    def fetch(self, key, func):
+        # type: (str, Callable[[Dict[str, Any]], Tuple[bytes, Dict[str, Any]]]) -> Tuple[bytes, Dict[str, Any]]
+        """
+        Returns (content, meta) for key, refreshing it if necessary.
+
+        func: Downloads the content. It's passed the metadata of the cached
+            content, or an empty dict if there isn't any. It returns
+            (content, meta), or None if the cached content is still current.
+            Exceptions propagate and nothing is cached.
+
+        The returned meta has the digest, size and fetch time of the content
+        in addition to whatever func returned. If another process is
+        refreshing the same key, this waits for it and shares its result.
+
+        """
+        name = sha256(key.encode('utf-8')).hexdigest()
+
+        content, ref = self._lookup(name)
+        if (content is not None) and self._fresh(ref):
+            return (content, ref)
+
+        with file_lock(os.path.join(self.path, 'locks', name + '.lock')):
+            content, ref = self._lookup(name)
+            if (content is not None) and self._fresh(ref):
+                return (content, ref)
+
+            result = func(ref if (content is not None) else {})
+            if result is None:
+                if content is None:
+                    raise ValueError("Nothing is cached for {}, but it wasn't downloaded.".format(key))
+            else:
+                content, meta = result
+                ref = dict(meta, digest=self._store(content), size=len(content))
+
+            ref['fetched'] = self.clock()
+            atomic_write(self._ref_path(name), json.dumps(ref))
+
+        return (content, ref)
+
+    def forget(self, key):
+        # type: (str) -> None
+        """
+        Forces key to be refreshed the next time it's fetched.
+        """
+        name = sha256(key.encode('utf-8')).hexdigest()
+        with file_lock(os.path.join(self.path, 'locks', name + '.lock')):
+            try:
+                os.unlink(self._ref_path(name))
+            except OSError:
+                pass
+
+    def prune(self, max_age=3600):
+        # type: (float) -> int
+        """
+        Removes content that no key refers to. Returns the number removed.
+
+        Content newer than max_age seconds is kept, because its ref may not
+        have been written yet.
+
+        """
+        referenced = set()
+        refs_path = os.path.join(self.path, 'refs')
+        for filename in os.listdir(refs_path):
+            try:
+                with open(os.path.join(refs_path, filename), 'r') as f:
+                    referenced.add(json.load(f)['digest'])
+            except (IOError, ValueError, KeyError):
+                pass
+
+        removed = 0
+        cutoff = time.time() - max_age
+        objects_path = os.path.join(self.path, 'objects')
+        for prefix in os.listdir(objects_path):
+            for digest in os.listdir(os.path.join(objects_path, prefix)):
+                path = os.path.join(objects_path, prefix, digest)
+                if (digest not in referenced) and (os.path.getmtime(path) < cutoff):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                    else:
+                        removed += 1
+
+        return removed
+
+    #
+    # Internal
+    #
+
+    def _lookup(self, name):
+        # type: (str) -> Tuple[bytes, Dict[str, Any]]
+        """
+        Returns (content, ref) for a key. content is None if it's missing or
+        corrupt.
+        """
+        try:
+            with open(self._ref_path(name), 'r') as f:
+                ref = json.load(f)  # type: Dict[str, Any]
+            with open(self._object_path(ref['digest']), 'rb') as f:
+                content = f.read()
+        except (IOError, ValueError, KeyError):
+            return (None, {})
+
+        if sha256(content).hexdigest() != ref['digest']:
+            content = None
+            try:
+                os.unlink(self._object_path(ref['digest']))
+            except OSError:
+                pass
+
+        return (content, ref)
+
+    def _store(self, content):
+        # type: (bytes) -> str
+        digest = sha256(content).hexdigest()
+        path = self._object_path(digest)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write(path, content)
+            self.written = True
+        else:
+            # Keep it from being pruned.
+            os.utime(path)
+
+        return digest
+
+    def _fresh(self, ref):
+        # type: (Dict[str, Any]) -> bool
+        return self.clock() < ref.get('fetched', 0) + self.ttl
+
+    def _ref_path(self, name):
+        # type: (str) -> str
+        return os.path.join(self.path, 'refs', name + '.json')
+
+    def _object_path(self, digest):
+        # type: (str) -> str
+        return os.path.join(self.path, 'objects', digest[:2], digest)
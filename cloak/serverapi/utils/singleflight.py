@@ -0,0 +1,99 @@
+"""
+Collapses concurrent identical calls into one.
+"""
+import threading
+import time
+
+from typing import Any, Callable, Dict, Hashable  # noqa
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time.
+
+    While a call for a key is in flight, other callers with the same key wait
+    for it and receive the same result (or exception). If ttl is greater than
+    zero, a successful result is also handed to any callers that arrive
+    within ttl seconds after the call completes.
+
+    Results are shared between callers, so they must be treated as read-only.
+
+    """
+    def __init__(self, ttl=0, clock=time.monotonic):
+        # type: (float, Callable[[], float]) -> None
+        self.ttl = ttl
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._calls = {}  # type: Dict[Hashable, _Call]
+
+    def do(self, key, func):
+        # type: (Hashable, Callable[[], Any]) -> Any
+        """
+        Returns func(), unless a call for key is already in flight or fresh.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if (call is not None) and call.expired(self.clock()):
+                call = None
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            try:
+                call.result = func()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    if (call.error is not None) or (self.ttl <= 0):
+                        self._forget(key, call)
+                    else:
+                        call.expires = self.clock() + self.ttl
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+
+        return call.result
+
+    def forget(self, key):
+        # type: (Hashable) -> None
+        """
+        Drops any cached result for key. In-flight calls are unaffected.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if (call is not None) and call.done.is_set():
+                del self._calls[key]
+
+    def clear(self):
+        # type: () -> None
+        """
+        Drops all cached results. In-flight calls are unaffected.
+        """
+        with self._lock:
+            for key, call in list(self._calls.items()):
+                if call.done.is_set():
+                    del self._calls[key]
+
+    def _forget(self, key, call):
+        # type: (Hashable, _Call) -> None
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+
+class _Call:
+    def __init__(self):
+        # type: () -> None
+        self.done = threading.Event()
+        self.result = None  # type: Any
+        self.error = None  # type: BaseException
+        self.expires = None  # type: float
+
+    def expired(self, now):
+        # type: (float) -> bool
+        return (self.expires is not None) and (now >= self.expires)
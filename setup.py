@@ -27,11 +27,17 @@ setup(
         'six>=1.10.0',
         'typing',
     ],
+    extras_require={
+        # Faster JSON and a more compact format for large peer lists.
+        'fast': ['orjson'],
+        'msgpack': ['msgpack'],
+    },
 
     packages=find_packages(),
     namespace_packages=['cloak'],
     scripts=[
-        'bin/cloak-server'
+        'bin/cloak-server',
+        'bin/cloak-server-client',
     ],
 
     test_suite='cloak.serverapi.tests',